@@ -1,3 +1,5 @@
+import os
+
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
@@ -124,6 +126,51 @@ app_settings = dict(
         'PROV_CHOICES': PROV_CHOICES,
         'DEFAULT_MARKER_COLOR': '#6C757D',
         'PAGINATION': 6,
+        # 'pages': pagine numerate; 'cursor': solo pagina precedente e successiva,
+        # senza contare le segnalazioni (vedi pagination.py)
+        'PAGINATION_MODE': 'pages',
+        # Durata (in secondi) delle copie in cache dei dati della mappa
+        'GEOJSON_CACHE_TIMEOUT': 60 * 60 * 24,
+        # Durata (in secondi) delle copie in cache dei popup già generati
+        'POPUP_CACHE_TIMEOUT': 60 * 60 * 24,
+        # Durata (in secondi) delle copie in cache dei conteggi dei filtri dell'elenco
+        'FACET_CACHE_TIMEOUT': 60 * 60 * 24,
+        # Salva in cache le pagine HTML servite agli utenti anonimi, e per quanto (in secondi)
+        'PAGE_CACHE': False,
+        'PAGE_CACHE_TIMEOUT': 60 * 60 * 24,
+        # Sotto questo livello di zoom la mappa scarica tutti gli indirizzi,
+        # sopra solo quelli visibili
+        'VIEWPORT_MIN_ZOOM': 10,
+        # Raggruppa gli indirizzi sul server invece che nel browser
+        'SERVER_CLUSTERING': False,
+        # Raggio (in pixel) dei cluster e zoom oltre il quale non si raggruppa più
+        'CLUSTER_RADIUS': 40,
+        'CLUSTER_MAX_ZOOM': 16,
+        # Cifre decimali delle coordinate nel formato binario a colonne
+        'COLUMNAR_PRECISION': 5,
+        # Lunghezza massima (in caratteri) degli estratti di descrizioni e testimonianze
+        'EXCERPT_LENGTH': 300,
+        # Percorso della classe del backend di ricerca (None: scelto in base al database)
+        'SEARCH_BACKEND': None,
+        # Segnalazioni restituite al più dall'indice di ricerca in memoria (None: tutte)
+        'SEARCH_MAX_RESULTS': 1000,
+        # Percorso della classe del backend per cercare le coordinate degli indirizzi
+        # (vedi geocoding.py)
+        'GEOCODING_BACKEND': 'djeography.geocoding.NominatimBackend',
+        # File CSV dei comuni (name, province, latitude, longitude) per GazetteerBackend
+        # e per la ricerca dei luoghi (None: i capoluoghi inclusi, vedi gazetteer.py)
+        'GEOCODING_GAZETTEER': None,
+        # La ricerca della mappa chiede a Photon i luoghi che non sono nell'elenco dei comuni
+        'PLACES_PHOTON_FALLBACK': False,
+        # Servizio compatibile con Nominatim per NominatimBackend
+        'GEOCODING_URL': 'https://nominatim.openstreetmap.org/search',
+        'GEOCODING_USER_AGENT': 'djeography',
+        # Chiamate al secondo e chiamate contemporanee al servizio HTTP
+        'GEOCODING_RATE': 1,
+        'GEOCODING_CONCURRENCY': 4,
+        # File GeoJSON dei confini delle province (None: la provincia non viene
+        # ricavata né controllata, vedi provinces.py)
+        'PROVINCE_BOUNDARIES': None,
     },
     **DJEOGRAPHY_CONFIG,
 )
@@ -138,6 +185,102 @@ except TypeError as err:
     raise ImproperlyConfigured(msg) from err
 
 
+if app_settings['PAGINATION_MODE'] not in ('pages', 'cursor'):
+    msg = "DJEOGRAPHY_CONFIG['PAGINATION_MODE'] should be 'pages' or 'cursor'."
+    raise ImproperlyConfigured(msg)
+
+
 if not isinstance(app_settings.get('DEFAULT_MARKER_COLOR'), str):
     msg = "DJEOGRAPHY_CONFIG['DEFAULT_MARKER_COLOR'] should be a HTML color name or a HEX string."
     raise ImproperlyConfigured(msg)
+
+
+for key in (
+    'GEOJSON_CACHE_TIMEOUT',
+    'POPUP_CACHE_TIMEOUT',
+    'FACET_CACHE_TIMEOUT',
+    'PAGE_CACHE_TIMEOUT',
+):
+    if app_settings[key] is not None and (
+        not isinstance(app_settings[key], int) or app_settings[key] < 0
+    ):
+        msg = f"DJEOGRAPHY_CONFIG['{key}'] should be an integer >= 0 or None."
+        raise ImproperlyConfigured(msg)
+
+
+if not isinstance(app_settings['PAGE_CACHE'], bool):
+    msg = "DJEOGRAPHY_CONFIG['PAGE_CACHE'] should be True or False."
+    raise ImproperlyConfigured(msg)
+
+
+if not isinstance(app_settings['PLACES_PHOTON_FALLBACK'], bool):
+    msg = "DJEOGRAPHY_CONFIG['PLACES_PHOTON_FALLBACK'] should be True or False."
+    raise ImproperlyConfigured(msg)
+
+
+if not isinstance(app_settings['VIEWPORT_MIN_ZOOM'], int):
+    msg = "DJEOGRAPHY_CONFIG['VIEWPORT_MIN_ZOOM'] should be an integer."
+    raise ImproperlyConfigured(msg)
+
+
+for key in ('CLUSTER_RADIUS', 'CLUSTER_MAX_ZOOM'):
+    if not isinstance(app_settings[key], int) or app_settings[key] < 0:
+        msg = f"DJEOGRAPHY_CONFIG['{key}'] should be an integer >= 0."
+        raise ImproperlyConfigured(msg)
+
+
+if not isinstance(app_settings['EXCERPT_LENGTH'], int) or app_settings['EXCERPT_LENGTH'] < 1:
+    msg = "DJEOGRAPHY_CONFIG['EXCERPT_LENGTH'] should be an integer >= 1."
+    raise ImproperlyConfigured(msg)
+
+
+# Con più di 6 cifre le differenze tra longitudini non entrano in un int32
+if app_settings['COLUMNAR_PRECISION'] not in range(7):
+    msg = "DJEOGRAPHY_CONFIG['COLUMNAR_PRECISION'] should be an integer between 0 and 6."
+    raise ImproperlyConfigured(msg)
+
+
+if app_settings['SEARCH_BACKEND'] is not None and not isinstance(
+    app_settings['SEARCH_BACKEND'],
+    str,
+):
+    msg = "DJEOGRAPHY_CONFIG['SEARCH_BACKEND'] should be a dotted path to a class or None."
+    raise ImproperlyConfigured(msg)
+
+
+if app_settings['SEARCH_MAX_RESULTS'] is not None and (
+    not isinstance(app_settings['SEARCH_MAX_RESULTS'], int)
+    or app_settings['SEARCH_MAX_RESULTS'] < 1
+):
+    msg = "DJEOGRAPHY_CONFIG['SEARCH_MAX_RESULTS'] should be an integer >= 1 or None."
+    raise ImproperlyConfigured(msg)
+
+
+for key in ('GEOCODING_BACKEND', 'GEOCODING_URL', 'GEOCODING_USER_AGENT'):
+    if not isinstance(app_settings[key], str):
+        msg = f"DJEOGRAPHY_CONFIG['{key}'] should be a string."
+        raise ImproperlyConfigured(msg)
+
+
+if app_settings['GEOCODING_RATE'] is not None and (
+    not isinstance(app_settings['GEOCODING_RATE'], (int, float))
+    or app_settings['GEOCODING_RATE'] <= 0
+):
+    msg = "DJEOGRAPHY_CONFIG['GEOCODING_RATE'] should be a number > 0 or None."
+    raise ImproperlyConfigured(msg)
+
+
+if (
+    not isinstance(app_settings['GEOCODING_CONCURRENCY'], int)
+    or app_settings['GEOCODING_CONCURRENCY'] < 1
+):
+    msg = "DJEOGRAPHY_CONFIG['GEOCODING_CONCURRENCY'] should be an integer >= 1."
+    raise ImproperlyConfigured(msg)
+
+
+if app_settings['PROVINCE_BOUNDARIES'] is not None and not isinstance(
+    app_settings['PROVINCE_BOUNDARIES'],
+    (str, os.PathLike),
+):
+    msg = "DJEOGRAPHY_CONFIG['PROVINCE_BOUNDARIES'] should be a path to a file or None."
+    raise ImproperlyConfigured(msg)
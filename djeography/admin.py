@@ -1,13 +1,23 @@
+import io
 from typing import Any
 
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
 from django.db import models
 from django.db.models.query import QuerySet
 from django.http import HttpRequest
+from django.template.response import TemplateResponse
+from django.urls import path
 from leaflet.admin import LeafletGeoAdminMixin
 from tinymce.widgets import AdminTinyMCE
 
+from djeography import app_settings
+
+from . import importing, provinces
+from . import search as text_search
 from .models import Address, Category, Contact, Entity, EvaluationLevel, Report
+from .pagination import EstimatedCountPaginator
 
 # Register your models here.
 
@@ -26,6 +36,13 @@ class AddressInline(LeafletGeoAdminMixin, admin.StackedInline):
     model = Address
     extra = 1
 
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_dbfield(db_field, request, **kwargs)
+        if db_field.name == 'province' and app_settings['PROVINCE_BOUNDARIES']:
+            # Può essere ricavata dalle coordinate (vedi Address.clean)
+            formfield.required = False
+        return formfield
+
 
 class ContactInline(admin.TabularInline):
     model = Contact
@@ -38,17 +55,36 @@ class ReportInline(admin.StackedInline):
     formfield_overrides = {models.TextField: {'widget': customTinyMce}}
 
 
+class ImportForm(forms.Form):
+    file = forms.FileField(
+        label='file',
+        help_text='CSV o FeatureCollection GeoJSON (vedi le colonne nel README)',
+    )
+    dry_run = forms.BooleanField(
+        label='solo verifica',
+        required=False,
+        help_text='Controlla le righe senza salvare nulla',
+    )
+
+
 @admin.register(Entity)
 class EntityAdmin(admin.ModelAdmin):
     model = Entity
 
     change_form_template = 'map/change_form.html'
+    change_list_template = 'map/change_list.html'
+    # Righe non valide mostrate dopo un'importazione
+    import_errors_shown = 100
 
     # List view
     list_display = ['title', 'category', 'evaluation', 'published']
     list_filter = ['category', 'published', 'evaluation']
-    search_fields = ['title', 'address__city']
+    # La ricerca usa l'indice del sito (vedi get_search_results)
+    search_fields = ['title']
     actions = ['publish', 'unpublish']
+    # Su tabelle grandi il numero di segnalazioni senza filtri viene stimato
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     # Detail view
     fields = ['category', ('title', 'evaluation'), 'description']
@@ -61,16 +97,106 @@ class EntityAdmin(admin.ModelAdmin):
 
     formfield_overrides = {models.TextField: {'widget': customTinyMce}}
 
+    def save_formset(self, request, form, formset, change):
+        super().save_formset(request, form, formset, change)
+        if formset.model is not Address:
+            return
+        # La provincia indicata viene mantenuta; senza confini configurati non c'è controllo
+        names = dict(app_settings['PROV_CHOICES'])
+        for address in [*formset.new_objects, *(obj for obj, _ in formset.changed_objects)]:
+            located = provinces.province_of(address.coords)
+            if located not in (None, address.province):
+                self.message_user(
+                    request,
+                    f'Le coordinate di {address} sono in provincia di '
+                    f'{names.get(located, located)}: controlla la provincia.',
+                    messages.WARNING,
+                )
+
+    def get_search_results(self, request, queryset, search_term):
+        # Titolo, città e vie dall'indice di ricerca: nessun join con DISTINCT
+        if not search_term:
+            return queryset, False
+        return text_search.search(queryset, search_term), False
+
     def get_queryset(self, request: HttpRequest) -> QuerySet[Any]:
-        return self.model.objects.all()
+        queryset = self.model.objects.all()
+        # L'elenco mostra solo le colonne di list_display
+        if request.resolver_match and request.resolver_match.url_name.endswith('_changelist'):
+            return queryset.for_admin()
+        return queryset
+
+    def get_urls(self):
+        opts = self.model._meta
+        return [
+            path(
+                'import/',
+                self.admin_site.admin_view(self.import_view),
+                name=f'{opts.app_label}_{opts.model_name}_import',
+            ),
+            *super().get_urls(),
+        ]
+
+    def import_view(self, request):
+        """Importa segnalazioni da un file caricato (per i file grandi c'è ``import_entities``)."""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = ImportForm(request.POST or None, request.FILES or None)
+        errors = []
+
+        def on_error(line, raw, message):
+            if len(errors) < self.import_errors_shown:
+                errors.append((line, raw.get('title') or '', message))
+
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            dry_run = form.cleaned_data['dry_run']
+            # Niente geocoding: con un servizio HTTP e il suo limite di chiamate
+            # supererebbe il timeout della richiesta (c'è geocode_addresses)
+            importer = importing.Importer(dry_run=dry_run, on_error=on_error)
+            try:
+                stats = importer.run(
+                    importing.read_rows(
+                        io.TextIOWrapper(upload, encoding='utf-8-sig', newline=''),
+                        importing.detect_format(upload.name),
+                    ),
+                )
+            except (importing.InvalidFile, UnicodeDecodeError) as e:
+                # I blocchi già salvati restano: il messaggio lo dice
+                form.add_error('file', f'File non valido, importazione interrotta: {e}')
+            else:
+                if dry_run:
+                    message = f'{stats.imported} righe valide, {stats.errors} righe con errori.'
+                else:
+                    message = (
+                        f'{stats.imported} segnalazioni importate, '
+                        f'{stats.errors} righe con errori, '
+                        f'{stats.unlocated} indirizzi senza coordinate, '
+                        f'{stats.mismatched} con la provincia diversa da quella delle coordinate.'
+                    )
+                    if stats.unlocated:
+                        message += ' Usa geocode_addresses per cercare le coordinate mancanti.'
+                level = messages.WARNING if stats.errors else messages.SUCCESS
+                self.message_user(request, message, level)
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Importa segnalazioni',
+            'form': form,
+            'errors': errors,
+        }
+        return TemplateResponse(request, 'map/import.html', context)
 
     @admin.action(description='Pubblica le segnalazioni selezionate')
     def publish(self, request, queryset):
-        queryset.update(published=True)
+        changed = queryset.set_published(True)
+        self.message_user(request, f'{changed} segnalazioni pubblicate.', messages.SUCCESS)
 
     @admin.action(description='Nascondi le segnalazioni selezionate')
     def unpublish(self, request, queryset):
-        queryset.update(published=False)
+        changed = queryset.set_published(False)
+        self.message_user(request, f'{changed} segnalazioni nascoste.', messages.WARNING)
 
 
 @admin.register(Category)
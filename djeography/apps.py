@@ -5,3 +5,7 @@ class DjeographyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'djeography'
     verbose_name = 'mappatura'
+
+    def ready(self):
+        # Registra i ricevitori dei segnali
+        from . import signals  # noqa: F401
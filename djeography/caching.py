@@ -0,0 +1,65 @@
+"""
+Cache dei contenuti serializzati.
+
+I contenuti vengono salvati nella cache di Django insieme al token della
+versione da cui sono stati generati (vedi ``versions.py``): quando la versione
+cambia la copia salvata non è più valida e viene ricostruita.
+
+Una sola richiesta alla volta ricostruisce un contenuto mancante (single-flight):
+le richieste concorrenti ricevono la copia precedente, se esiste, oppure
+attendono che la ricostruzione termini.
+"""
+
+import time
+from collections.abc import Callable
+from typing import Any
+
+from django.core.cache import cache
+
+# Durata massima del lock di ricostruzione, in secondi
+LOCK_TIMEOUT = 30
+# Tempo massimo di attesa per chi non ha ottenuto il lock e non ha una copia precedente
+WAIT_TIMEOUT = 10
+POLL_INTERVAL = 0.05
+
+
+def get_or_build(
+    key: str,
+    token: str,
+    build: Callable[[], Any],
+    timeout: int | None = None,
+) -> tuple[str, Any]:
+    """
+    Restituisce ``(token, valore)`` dalla cache, ricostruendo il valore se necessario.
+
+    Il token restituito può essere diverso da quello richiesto quando viene
+    servita la copia precedente durante una ricostruzione: il chiamante deve
+    usarlo per i propri validatori (ETag), così il client non associa
+    contenuti vecchi alla versione nuova.
+    """
+    entry = cache.get(key)
+    if entry is not None and entry[0] == token:
+        return entry
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, token, timeout=LOCK_TIMEOUT):
+        try:
+            entry = (token, build())
+            cache.set(key, entry, timeout=timeout)
+        finally:
+            cache.delete(lock_key)
+        return entry
+
+    # Un'altra richiesta sta già ricostruendo il contenuto
+    if entry is not None:
+        return entry
+
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == token:
+            return entry
+
+    # La ricostruzione sta impiegando troppo: meglio rispondere comunque
+    return token, build()
@@ -0,0 +1,185 @@
+"""
+Raggruppamento (clustering) degli indirizzi lato server.
+
+L'algoritmo è quello di supercluster: i punti vengono proiettati in Web
+Mercator e, a partire dallo zoom più alto, ogni livello raggruppa gli
+elementi del livello superiore che distano meno di ``radius`` pixel.
+La gerarchia viene costruita una volta per processo e riutilizzata finché
+la versione dei dati non cambia.
+"""
+
+import math
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from collections.abc import Callable, Iterable
+
+from . import geo
+
+# Dimensione in pixel di una tile
+TILE_EXTENT = 256
+
+
+class Cluster:
+    """
+    Un elemento di un livello della gerarchia: un punto singolo o un gruppo di punti.
+
+    ``x`` e ``y`` sono coordinate Web Mercator normalizzate tra 0 e 1; per i
+    punti singoli ``point`` contiene ``(pk, valutazione, pubblicata)``.
+    """
+
+    __slots__ = ('x', 'y', 'count', 'evaluations', 'bounds', 'point')
+
+    def __init__(self, x, y, count, evaluations, bounds, point=None):
+        self.x = x
+        self.y = y
+        self.count = count
+        self.evaluations = evaluations
+        self.bounds = bounds
+        self.point = point
+
+    @classmethod
+    def from_point(cls, pk, lng, lat, evaluation, published):
+        return cls(
+            geo.lng_to_tile_x(lng, 0),
+            geo.lat_to_tile_y(lat, 0),
+            1,
+            Counter({evaluation or 'default': 1}),
+            (lng, lat, lng, lat),
+            (pk, evaluation, published),
+        )
+
+    @property
+    def lng_lat(self) -> tuple[float, float]:
+        if self.point is not None:
+            # Evita gli errori di arrotondamento della proiezione
+            return self.bounds[0], self.bounds[1]
+        return geo.tile_x_to_lng(self.x, 0), geo.tile_y_to_lat(self.y, 0)
+
+
+def merge(items: list[Cluster]) -> Cluster:
+    count = sum(item.count for item in items)
+    evaluations = Counter()
+    for item in items:
+        evaluations.update(item.evaluations)
+    return Cluster(
+        sum(item.x * item.count for item in items) / count,
+        sum(item.y * item.count for item in items) / count,
+        count,
+        evaluations,
+        (
+            min(item.bounds[0] for item in items),
+            min(item.bounds[1] for item in items),
+            max(item.bounds[2] for item in items),
+            max(item.bounds[3] for item in items),
+        ),
+    )
+
+
+class ClusterIndex:
+    """Gerarchia dei cluster per tutti i livelli di zoom da 0 a ``max_zoom``."""
+
+    def __init__(
+        self,
+        points: Iterable[tuple],
+        radius: int = 40,
+        max_zoom: int = 16,
+    ):
+        self.max_zoom = max_zoom
+        items = [Cluster.from_point(*point) for point in points]
+        # Oltre max_zoom vengono restituiti i punti singoli
+        self.levels = {max_zoom + 1: self._sort(items)}
+        for zoom in range(max_zoom, -1, -1):
+            items = self._cluster(items, radius / (TILE_EXTENT * 2**zoom))
+            self.levels[zoom] = self._sort(items)
+
+    @staticmethod
+    def _sort(items: list[Cluster]) -> tuple[list[float], list[Cluster]]:
+        # Gli elementi sono ordinati per x, per selezionare un'area con bisect
+        items = sorted(items, key=lambda item: item.x)
+        return [item.x for item in items], items
+
+    @staticmethod
+    def _cluster(items: list[Cluster], radius: float) -> list[Cluster]:
+        """Raggruppa gli elementi che distano meno di ``radius`` usando una griglia di celle."""
+        xs = [item.x for item in items]
+        ys = [item.y for item in items]
+        # Le celle sono identificate da un intero: è più veloce di una tupla come chiave
+        width = int(1 / radius) + 3
+        cells = [int(x / radius) * width + int(y / radius) for x, y in zip(xs, ys)]
+        grid: dict[int, list[int]] = {}
+        for i, cell in enumerate(cells):
+            grid.setdefault(cell, []).append(i)
+        offsets = [dx * width + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+        visited = [False] * len(items)
+        clusters = []
+        radius2 = radius * radius
+        for i, cell in enumerate(cells):
+            if visited[i]:
+                continue
+            visited[i] = True
+            x, y = xs[i], ys[i]
+            neighbours = []
+            for offset in offsets:
+                for j in grid.get(cell + offset, ()):
+                    if not visited[j] and (xs[j] - x) ** 2 + (ys[j] - y) ** 2 <= radius2:
+                        visited[j] = True
+                        neighbours.append(items[j])
+            if neighbours:
+                clusters.append(merge([items[i], *neighbours]))
+            else:
+                clusters.append(items[i])
+        return clusters
+
+    def get_clusters(
+        self,
+        bbox: tuple[float, float, float, float],
+        zoom: int,
+    ) -> list[Cluster]:
+        """Restituisce gli elementi del livello ``zoom`` che cadono nel bounding box."""
+        xs, items = self.levels[max(0, min(zoom, self.max_zoom + 1))]
+        west, south, east, north = bbox
+        start = bisect_left(xs, geo.lng_to_tile_x(west, 0))
+        end = bisect_right(xs, geo.lng_to_tile_x(east, 0))
+        top = geo.lat_to_tile_y(north, 0) if north < geo.MAX_LATITUDE else -math.inf
+        bottom = geo.lat_to_tile_y(south, 0) if south > -geo.MAX_LATITUDE else math.inf
+        return [item for item in items[start:end] if top <= item.y <= bottom]
+
+
+# Gerarchie dalla meno alla più usata di recente
+_indexes: OrderedDict[str, tuple[str, ClusterIndex]] = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_index(
+    key: str,
+    token: str,
+    build: Callable[[], ClusterIndex],
+    max_size: int | None = None,
+) -> ClusterIndex:
+    """
+    Restituisce la gerarchia salvata per ``key`` se è della versione ``token``.
+
+    Le gerarchie restano in memoria nel processo: ricostruirle a ogni
+    richiesta costerebbe quanto il clustering nel browser. Oltre
+    ``max_size`` gerarchie viene scartata quella usata meno di recente.
+    """
+    entry = _indexes.get(key)
+    if entry is not None and entry[0] == token:
+        try:
+            _indexes.move_to_end(key)
+        except KeyError:
+            # Scartata nel frattempo da un altro thread
+            pass
+        return entry[1]
+    with _lock:
+        entry = _indexes.get(key)
+        if entry is not None and entry[0] == token:
+            return entry[1]
+        index = build()
+        _indexes[key] = (token, index)
+        _indexes.move_to_end(key)
+        while max_size is not None and len(_indexes) > max(max_size, 1):
+            _indexes.popitem(last=False)
+        return index
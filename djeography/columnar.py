@@ -0,0 +1,108 @@
+"""
+Formato binario a colonne per gli indirizzi della mappa.
+
+Alternativa compatta al GeoJSON: le coordinate vengono quantizzate e
+codificate come differenze rispetto al punto precedente, le proprietà
+vengono inviate come colonne parallele e i valori testuali come indici
+in un dizionario. Tutti i numeri sono little-endian.
+
+Struttura::
+
+    magic           4 byte, b'DJC1'
+    count           uint32, numero di indirizzi
+    scale           float64, unità per grado (10 ** precisione)
+    popup_url       stringa, URL dei popup con ``{}`` al posto dell'id
+    evaluations     lista di stringhe (la prima, vuota, indica nessuna valutazione)
+    categories      lista di stringhe (slug)
+    ids             int32[count], differenze tra id consecutivi
+    lngs            int32[count], differenze tra longitudini quantizzate
+    lats            int32[count], differenze tra latitudini quantizzate
+    evaluation      uint16[count], indici in evaluations
+    category        uint16[count], indici in categories
+    published       uint8[count], 1 se pubblicata
+
+Una stringa è un uint16 con la lunghezza seguito dai byte UTF-8; una lista
+di stringhe è un uint16 con il numero di elementi seguito dalle stringhe.
+Ogni colonna inizia a un offset multiplo di 4, per poter essere letta
+direttamente con i typed array di JavaScript.
+"""
+
+import struct
+import sys
+from array import array
+from collections.abc import Iterator
+
+from django.db.models import QuerySet
+
+from .serializers import CHUNK_SIZE, popup_url_template
+
+MAGIC = b'DJC1'
+MEDIA_TYPE = 'application/vnd.djeography.points'
+
+
+def _string(value: str) -> bytes:
+    encoded = value.encode()
+    return struct.pack('<H', len(encoded)) + encoded
+
+
+def _strings(values: list[str]) -> bytes:
+    return struct.pack('<H', len(values)) + b''.join(_string(value) for value in values)
+
+
+def encode_addresses(queryset: QuerySet, precision: int) -> bytes:
+    """Codifica gli indirizzi del queryset (con coordinate valide) nel formato a colonne."""
+    scale = 10**precision
+    rows = (
+        queryset.filter(latitude__isnull=False, longitude__isnull=False)
+        .order_by('pk')
+        .values_list(
+            'pk',
+            'longitude',
+            'latitude',
+            'entity__evaluation',
+            'entity__category__slug',
+            'entity__published',
+        )
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+    ids, lngs, lats = array('i'), array('i'), array('i')
+    evaluation_column, category_column = array('H'), array('H')
+    published_column = array('B')
+    evaluations: dict[str | None, int] = {None: 0}
+    categories: dict[str, int] = {}
+    previous_pk = previous_lng = previous_lat = 0
+    for pk, lng, lat, evaluation, category, published in rows:
+        lng, lat = round(lng * scale), round(lat * scale)
+        ids.append(pk - previous_pk)
+        lngs.append(lng - previous_lng)
+        lats.append(lat - previous_lat)
+        previous_pk, previous_lng, previous_lat = pk, lng, lat
+        evaluation_column.append(evaluations.setdefault(evaluation, len(evaluations)))
+        category_column.append(categories.setdefault(category, len(categories)))
+        published_column.append(published)
+
+    parts = [
+        MAGIC,
+        struct.pack('<Id', len(ids), scale),
+        _string(popup_url_template()),
+        _strings(['' if key is None else key for key in evaluations]),
+        _strings(list(categories)),
+    ]
+    size = sum(len(part) for part in parts)
+    for column in (ids, lngs, lats, evaluation_column, category_column, published_column):
+        padding = -size % 4
+        if sys.byteorder == 'big':
+            column.byteswap()
+        parts += [b'\0' * padding, column.tobytes()]
+        size += padding + len(column) * column.itemsize
+    return b''.join(parts)
+
+
+def stream_addresses(queryset: QuerySet, precision: int) -> Iterator[bytes]:
+    """
+    Come ``encode_addresses``, ma come generatore: la codifica avviene solo se letto.
+
+    Il formato a colonne va costruito per intero prima di essere inviato.
+    """
+    yield encode_addresses(queryset, precision)
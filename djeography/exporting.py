@@ -0,0 +1,239 @@
+"""
+Esportazione di massa delle segnalazioni in CSV, GeoJSON o NDJSON.
+
+Le segnalazioni vengono lette con ``iterator()`` (un cursore lato server su
+PostgreSQL), a blocchi di ``CHUNK_SIZE`` insieme a indirizzi, contatti e
+testimonianze, e scritte come testo un blocco alla volta: la memoria usata
+non dipende dal numero di segnalazioni.
+
+Ogni segnalazione può essere esportata:
+
+- annidata: un record per segnalazione, con le liste ``addresses``,
+  ``contacts`` e ``reports``;
+- appiattita: un record per indirizzo (uno solo se la segnalazione non ha
+  indirizzi), con i contatti nelle colonne ``phone``, ``email`` e
+  ``website`` separati da ``;`` e senza il testo delle testimonianze. Sono
+  le colonne lette da ``import_entities``.
+
+Il CSV è sempre appiattito.
+"""
+
+import csv
+import io
+import json
+import zlib
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+from django.db.models import QuerySet
+
+from . import facets, reference
+from .importing import CONTACT_COLUMNS
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'geojson': ('application/geo+json', 'geojson'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+# Segnalazioni lette dal database (e scritte) per ogni blocco
+CHUNK_SIZE = 500
+
+ENTITY_COLUMNS = ('id', 'title', 'category', 'evaluation', 'published', 'description')
+ADDRESS_COLUMNS = ('road', 'number', 'city', 'province', 'latitude', 'longitude')
+STATS_COLUMNS = ('n_reports', 'latest_update')
+FLAT_COLUMNS = (*ENTITY_COLUMNS, *ADDRESS_COLUMNS, *CONTACT_COLUMNS, *STATS_COLUMNS)
+
+# Tipo di contatto -> colonna
+_CONTACT_COLUMN = {typology: column for column, typology in CONTACT_COLUMNS.items()}
+
+
+def filter_entities(
+    queryset: QuerySet,
+    filters: dict[str, str] | None = None,
+    published: bool | None = None,
+) -> QuerySet:
+    """Segnalazioni da esportare: filtri dell'elenco (provincia, categoria, valutazione) e stato."""
+    queryset = facets.filter_entities(queryset, filters or {})
+    if published is not None:
+        queryset = queryset.filter(published=published)
+    return queryset.for_export()
+
+
+def _entity_fields(entity, categories) -> dict[str, Any]:
+    category = categories.get(entity.category_id)
+    return {
+        'id': entity.pk,
+        'title': entity.title,
+        'category': category.slug if category else None,
+        'evaluation': entity.evaluation_id,
+        'published': entity.published,
+        'description': entity.description,
+    }
+
+
+def _stats_fields(entity) -> dict[str, Any]:
+    return {
+        'n_reports': entity.n_reports,
+        'latest_update': entity.latest_update.isoformat() if entity.latest_update else None,
+    }
+
+
+def _address_fields(address) -> dict[str, Any]:
+    return {name: getattr(address, name) for name in ADDRESS_COLUMNS}
+
+
+def nested_record(entity, categories) -> dict[str, Any]:
+    return {
+        **_entity_fields(entity, categories),
+        **_stats_fields(entity),
+        'addresses': [_address_fields(address) for address in entity.address_set.all()],
+        'contacts': [
+            {'typology': contact.typology, 'contact': contact.contact}
+            for contact in entity.contact_set.all()
+        ],
+        'reports': [
+            {
+                'title': report.title,
+                'body': report.body,
+                'date_added': report.date_added.isoformat(),
+            }
+            for report in entity.report_set.all()
+        ],
+    }
+
+
+def flat_records(entity, categories) -> Iterator[dict[str, Any]]:
+    contacts = {column: [] for column in CONTACT_COLUMNS}
+    for contact in entity.contact_set.all():
+        if contact.typology in _CONTACT_COLUMN:
+            contacts[_CONTACT_COLUMN[contact.typology]].append(contact.contact)
+    fields = _entity_fields(entity, categories)
+    stats = _stats_fields(entity)
+    joined = {column: '; '.join(values) for column, values in contacts.items()}
+    addresses = entity.address_set.all() or [None]
+    for address in addresses:
+        yield {
+            **fields,
+            **(_address_fields(address) if address else dict.fromkeys(ADDRESS_COLUMNS)),
+            **joined,
+            **stats,
+        }
+
+
+def _geometry(record: dict[str, Any]) -> dict | None:
+    if 'addresses' in record:
+        points = [
+            [address['longitude'], address['latitude']]
+            for address in record['addresses']
+            if address['latitude'] is not None
+        ]
+        return {'type': 'MultiPoint', 'coordinates': points} if points else None
+    if record['latitude'] is None:
+        return None
+    return {'type': 'Point', 'coordinates': [record['longitude'], record['latitude']]}
+
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+class Export:
+    """
+    Testo dell'esportazione, generato un blocco alla volta.
+
+    Dopo l'iterazione ``entities`` e ``records`` contengono il numero di
+    segnalazioni e di record scritti.
+    """
+
+    def __init__(self, queryset: QuerySet, format: str, flat: bool = False):
+        if format not in FORMATS:
+            raise ValueError(f'Unknown export format: {format}')
+        self.queryset = queryset
+        self.format = format
+        # Il CSV non può contenere liste
+        self.flat = flat or format == 'csv'
+        self.entities = 0
+        self.records = 0
+
+    def iter_records(self) -> Iterator[list[dict[str, Any]]]:
+        """Record di ogni blocco di segnalazioni."""
+        categories = reference.get().categories_by_pk
+        chunk: list[dict[str, Any]] = []
+        entities = 0
+        for entity in self.queryset.iterator(chunk_size=CHUNK_SIZE):
+            if self.flat:
+                chunk.extend(flat_records(entity, categories))
+            else:
+                chunk.append(nested_record(entity, categories))
+            entities += 1
+            if entities == CHUNK_SIZE:
+                yield chunk
+                self.entities += entities
+                chunk, entities = [], 0
+        if chunk:
+            yield chunk
+        self.entities += entities
+
+    def __iter__(self) -> Iterator[str]:
+        return getattr(self, f'_write_{self.format}')()
+
+    def _write_csv(self) -> Iterator[str]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(FLAT_COLUMNS)
+        yield buffer.getvalue()
+        for chunk in self.iter_records():
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(
+                [_csv_value(record[column]) for column in FLAT_COLUMNS] for record in chunk
+            )
+            self.records += len(chunk)
+            yield buffer.getvalue()
+
+    def _write_ndjson(self) -> Iterator[str]:
+        for chunk in self.iter_records():
+            self.records += len(chunk)
+            yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in chunk)
+
+    def _write_geojson(self) -> Iterator[str]:
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ''
+        for chunk in self.iter_records():
+            features = (
+                json.dumps(
+                    {
+                        'type': 'Feature',
+                        'id': record['id'],
+                        'geometry': _geometry(record),
+                        'properties': record,
+                    },
+                    ensure_ascii=False,
+                )
+                for record in chunk
+            )
+            self.records += len(chunk)
+            yield separator + ', '.join(features)
+            separator = ', '
+        yield ']}'
+
+
+def encode(chunks: Iterable[str]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield chunk.encode()
+
+
+def compress(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Comprime i blocchi di testo in un unico file gzip, un blocco alla volta."""
+    # wbits=31: intestazione e coda gzip invece di zlib
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,124 @@
+"""
+Conteggi dei filtri dell'elenco delle segnalazioni (faccette).
+
+I filtri sono condizioni sulla sola tabella delle segnalazioni (la provincia
+con una subquery EXISTS sugli indirizzi): ogni segnalazione compare una volta.
+Per ogni filtro (provincia, categoria, valutazione) viene contato quante
+segnalazioni restituirebbe ciascuna opzione, tenendo conto degli altri filtri
+già scelti e della ricerca: una query raggruppata per filtro. I conteggi vengono salvati in
+cache per livello di visibilità e per combinazione di filtri, e ricalcolati
+quando cambia la versione del dataset (vedi ``versions.py``).
+"""
+
+import hashlib
+from collections.abc import Mapping
+
+from django.db.models import Count, Exists, OuterRef, Q, QuerySet
+
+from djeography import app_settings
+
+from . import caching, reference, versions
+from .models import Address
+
+# Parametro della richiesta -> colonna per cui raggruppare nei conteggi
+FACETS = {
+    'province': 'address__province',
+    'category': 'category_id',
+    'evaluation': 'evaluation_id',
+}
+
+
+def province_filter(value: str) -> Exists:
+    # EXISTS invece di un join: una segnalazione con più indirizzi compare una volta sola
+    return Exists(Address.objects.filter(entity=OuterRef('pk'), province=value))
+
+
+def category_filter(value: str) -> Q:
+    # L'id della categoria viene dalle tabelle di riferimento: nessun join
+    category = reference.get().categories.get(value)
+    return Q(category_id=category.pk) if category is not None else Q(pk__in=[])
+
+
+def evaluation_filter(value: str) -> Q:
+    return Q(evaluation_id=value)
+
+
+# Parametro della richiesta -> condizione sulla segnalazione
+FILTERS = {
+    'province': province_filter,
+    'category': category_filter,
+    'evaluation': evaluation_filter,
+}
+
+
+def filter_entities(queryset: QuerySet, selected: Mapping[str, str]) -> QuerySet:
+    """Applica al queryset delle segnalazioni i filtri scelti."""
+    for name, condition in FILTERS.items():
+        if selected.get(name):
+            queryset = queryset.filter(condition(selected[name]))
+    return queryset
+
+
+def count_facets(queryset: QuerySet, selected: Mapping[str, str]) -> dict[str, dict[str, int]]:
+    """
+    Restituisce, per ogni filtro, il numero di segnalazioni per ciascuna opzione.
+
+    Il conteggio di un filtro applica tutti gli altri filtri scelti ma non se
+    stesso, così si può vedere quante segnalazioni darebbe un'opzione diversa.
+    """
+    queryset = queryset.for_count()
+    categories = reference.get().categories_by_pk
+    facets = {}
+    for name, column in FACETS.items():
+        others = {key: value for key, value in selected.items() if key != name}
+        rows = filter_entities(queryset, others).values_list(column)
+        if name == 'province':
+            # Una segnalazione con più indirizzi nella stessa provincia conta una volta
+            rows = rows.annotate(n=Count('pk', distinct=True))
+        else:
+            rows = rows.annotate(n=Count('pk'))
+        facets[name] = {key: n for key, n in rows if key is not None}
+    # Le opzioni delle categorie sono identificate dallo slug
+    facets['category'] = {
+        categories[pk].slug: n for pk, n in facets['category'].items() if pk in categories
+    }
+    return facets
+
+
+def total(counts: Mapping[str, Mapping[str, int]], selected: Mapping[str, str]) -> int:
+    """
+    Numero di segnalazioni con tutti i filtri scelti, dai conteggi di ``count_facets``.
+
+    Ogni segnalazione ha una categoria: senza filtro per categoria il totale è
+    la somma dei conteggi delle categorie, altrimenti il conteggio di quella scelta.
+    """
+    category = selected.get('category')
+    if category:
+        return counts['category'].get(category, 0)
+    return sum(counts['category'].values())
+
+
+def get_facets(
+    queryset: QuerySet,
+    selected: Mapping[str, str],
+    tier: str,
+    search: str = '',
+) -> dict[str, dict[str, int]]:
+    """
+    Come ``count_facets``, ma dalla cache se il dataset non è cambiato.
+
+    ``queryset`` contiene già i risultati della ricerca ``search``, se c'è:
+    anche il testo cercato fa parte della chiave della cache.
+    """
+    selected = {name: selected.get(name) or '' for name in FILTERS}
+    digest = hashlib.sha1(repr((sorted(selected.items()), search)).encode()).hexdigest()
+    scopes = [versions.DATASET_SCOPE]
+    if search:
+        scopes.append(versions.SEARCH_SCOPE)
+    token = repr(versions.get_versions(*scopes))
+    return caching.get_or_build(
+        f'djeography:facets:{tier}:{digest}',
+        token,
+        lambda: count_facets(queryset, selected),
+        timeout=app_settings['FACET_CACHE_TIMEOUT'],
+    )[1]
@@ -0,0 +1,124 @@
+"""
+Elenco dei comuni italiani, con la sigla della provincia e le coordinate del centro.
+
+Il file incluso (``data/comuni.csv``) contiene solo i capoluoghi di provincia
+(gli altri comuni non vengono trovati, a meno di ``PLACES_PHOTON_FALLBACK``); con
+``DJEOGRAPHY_CONFIG['GEOCODING_GAZETTEER']`` si può indicare un file con
+tutti i comuni, con le stesse colonne: ``name``, ``province``, ``latitude``
+e ``longitude``. I nomi in più lingue sono separati da ``/`` (``Bolzano/Bozen``).
+
+I comuni vengono caricati una volta per processo in un indice per prefisso:
+un array ordinato dei nomi normalizzati (senza accenti né punteggiatura, in
+minuscolo) a partire da ogni parola, in cui i nomi che iniziano con il testo
+cercato sono consecutivi e si trovano con una ricerca binaria.
+"""
+
+import csv
+import re
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from typing import NamedTuple
+
+from djeography import app_settings
+
+from .search import normalize
+
+DEFAULT_PATH = Path(__file__).parent / 'data' / 'comuni.csv'
+
+_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalize_name(text: str) -> str:
+    """"L'Aquila" diventa "l aquila", "Forlì" diventa "forli"."""
+    return _SEPARATORS.sub(' ', normalize(text)).strip()
+
+
+class Place(NamedTuple):
+    name: str
+    province: str
+    latitude: float
+    longitude: float
+
+
+class Gazetteer:
+    def __init__(self, places: list[Place]):
+        self.places = places
+        entries = []
+        # Nome normalizzato (e provincia) -> comuni
+        self.names: dict[tuple[str, str], int] = {}
+        self.homonyms: dict[str, list[int]] = {}
+        for i, place in enumerate(places):
+            for name in place.name.split('/'):
+                words = normalize_name(name).split()
+                self.names[(' '.join(words), place.province)] = i
+                self.homonyms.setdefault(' '.join(words), []).append(i)
+                # Il nome intero e i nomi a partire da ogni parola ("calabria"
+                # trova "Reggio di Calabria"); 0 = inizio del nome
+                for start in range(len(words)):
+                    entries.append((' '.join(words[start:]), min(start, 1), i))
+        entries.sort()
+        # Array paralleli: chiavi ordinate, posizione della parola, comune
+        self.keys = [key for key, _, _ in entries]
+        self.word_starts = [word_start for _, word_start, _ in entries]
+        self.ids = [i for _, _, i in entries]
+        self.sort_keys = [normalize_name(place.name) for place in places]
+
+    @classmethod
+    def from_csv(cls, path) -> 'Gazetteer':
+        with open(path, encoding='utf-8-sig', newline='') as file:
+            return cls(
+                [
+                    Place(
+                        row['name'].strip(),
+                        row['province'].strip().upper(),
+                        float(row['latitude']),
+                        float(row['longitude']),
+                    )
+                    for row in csv.DictReader(file)
+                ],
+            )
+
+    def search(self, text: str, limit: int = 10) -> list[Place]:
+        """
+        Comuni il cui nome, o una parola del nome, inizia con ``text``.
+
+        Prima i comuni il cui nome inizia con il testo, poi gli altri, in ordine alfabetico.
+        """
+        prefix = normalize_name(text)
+        if not prefix:
+            return []
+        ranks: dict[int, int] = {}
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                break
+            place = self.ids[i]
+            ranks[place] = min(ranks.get(place, 1), self.word_starts[i])
+        best = sorted(ranks, key=lambda i: (ranks[i], self.sort_keys[i]))
+        return [self.places[i] for i in best[:limit]]
+
+    def lookup(self, name: str, province: str | None = None) -> Place | None:
+        """Il comune con il nome indicato (e nella provincia, se indicata)."""
+        key = normalize_name(name)
+        if province:
+            i = self.names.get((key, province.strip().upper()))
+            return self.places[i] if i is not None else None
+        # Senza provincia il nome deve essere univoco
+        matches = self.homonyms.get(key, [])
+        return self.places[matches[0]] if len(matches) == 1 else None
+
+
+_gazetteer: Gazetteer | None = None
+_lock = threading.Lock()
+
+
+def get() -> Gazetteer:
+    """L'elenco dei comuni, caricato alla prima richiesta."""
+    global _gazetteer
+    if _gazetteer is None:
+        with _lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer.from_csv(
+                    app_settings['GEOCODING_GAZETTEER'] or DEFAULT_PATH,
+                )
+    return _gazetteer
@@ -0,0 +1,94 @@
+"""
+Funzioni geografiche di supporto.
+
+Le coordinate sono sempre in gradi (WGS84); le tile seguono lo schema
+"slippy map" di OpenStreetMap, lo stesso usato da Leaflet.
+"""
+
+import math
+
+# Latitudine massima rappresentabile nella proiezione Web Mercator
+MAX_LATITUDE = 85.0511287798
+MAX_ZOOM = 22
+
+
+def coords_to_lat_lng(coords) -> tuple[float | None, float | None]:
+    """Estrae latitudine e longitudine da un punto GeoJSON (``None`` se non valido)."""
+    try:
+        lng, lat = coords['coordinates'][:2]
+        return float(lat), float(lng)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None, None
+
+
+def parse_bbox(raw: str) -> tuple[float, float, float, float]:
+    """
+    Interpreta un bounding box nel formato ``ovest,sud,est,nord``.
+
+    È il formato restituito da ``LatLngBounds.toBBoxString()`` in Leaflet.
+    Solleva ``ValueError`` se il valore non è valido.
+    """
+    west, south, east, north = (float(value) for value in raw.split(','))
+    if not all(math.isfinite(value) for value in (west, south, east, north)):
+        raise ValueError('bbox coordinates must be finite numbers')
+    if west > east or south > north:
+        raise ValueError('bbox must be ordered as west,south,east,north')
+    return (
+        max(west, -180.0),
+        max(south, -90.0),
+        min(east, 180.0),
+        min(north, 90.0),
+    )
+
+
+def lng_to_tile_x(lng: float, zoom: int) -> float:
+    return (lng + 180.0) / 360.0 * 2**zoom
+
+
+def lat_to_tile_y(lat: float, zoom: int) -> float:
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    rad = math.radians(lat)
+    return (1.0 - math.asinh(math.tan(rad)) / math.pi) / 2.0 * 2**zoom
+
+
+def tile_x_to_lng(x: float, zoom: int) -> float:
+    return x / 2**zoom * 360.0 - 180.0
+
+
+def tile_y_to_lat(y: float, zoom: int) -> float:
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2**zoom))))
+
+
+def tile_range(
+    bbox: tuple[float, float, float, float],
+    zoom: int,
+) -> tuple[int, int, int, int]:
+    """Restituisce le tile ``(x0, y0, x1, y1)`` che coprono il bounding box allo zoom dato."""
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError(f'zoom must be between 0 and {MAX_ZOOM}')
+    west, south, east, north = bbox
+    last = 2**zoom - 1
+    x0 = min(max(int(lng_to_tile_x(west, zoom)), 0), last)
+    x1 = min(max(int(lng_to_tile_x(east, zoom)), 0), last)
+    # L'asse y delle tile cresce verso sud
+    y0 = min(max(int(lat_to_tile_y(north, zoom)), 0), last)
+    y1 = min(max(int(lat_to_tile_y(south, zoom)), 0), last)
+    return x0, y0, x1, y1
+
+
+def tile_range_bbox(
+    zoom: int,
+    x0: int,
+    y0: int,
+    x1: int,
+    y1: int,
+) -> tuple[float, float, float, float]:
+    """Bounding box ``(ovest, sud, est, nord)`` di un intervallo di tile."""
+    last = 2**zoom - 1
+    # Le tile ai bordi includono anche i punti oltre la latitudine massima di Mercator
+    return (
+        tile_x_to_lng(x0, zoom),
+        -90.0 if y1 == last else tile_y_to_lat(y1 + 1, zoom),
+        tile_x_to_lng(x1 + 1, zoom),
+        90.0 if y0 == 0 else tile_y_to_lat(y0, zoom),
+    )
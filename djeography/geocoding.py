@@ -0,0 +1,255 @@
+"""
+Ricerca delle coordinate degli indirizzi (geocoding) sul server.
+
+Le coordinate vengono chieste a un backend, scelto con
+``DJEOGRAPHY_CONFIG['GEOCODING_BACKEND']``:
+
+- ``NominatimBackend`` (predefinito): un servizio HTTP compatibile con l'API
+  di ricerca di Nominatim (https://nominatim.org/release-docs/latest/api/Search/);
+- ``GazetteerBackend``: l'elenco dei comuni (``gazetteer.py``), senza rete;
+  le coordinate sono quelle del centro del comune, non della via, e con il
+  file incluso (i soli capoluoghi) gli altri comuni non vengono trovati.
+
+Le chiamate vengono fatte in parallelo con asyncio, al più
+``GEOCODING_CONCURRENCY`` alla volta e non più di ``GEOCODING_RATE`` al
+secondo. Ogni risultato, anche "non trovato", viene salvato nel database
+(``GeocodeResult``) con l'indirizzo normalizzato come chiave: lo stesso
+indirizzo non viene mai chiesto due volte allo stesso backend. Le chiamate
+non riuscite (ad es. per un errore di rete) non vengono salvate.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import time
+import urllib.parse
+import urllib.request
+from abc import ABC, abstractmethod
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from django.utils.module_loading import import_string
+
+from djeography import app_settings
+
+from . import gazetteer
+from .search import normalize
+
+# Indirizzi letti e salvati nella cache per ogni blocco
+CHUNK_SIZE = 500
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class GeocodingError(Exception):
+    """La chiamata al backend non è riuscita: il risultato non viene salvato."""
+
+
+class GeocodeQuery(NamedTuple):
+    road: str
+    number: str
+    city: str
+    province: str
+
+    @classmethod
+    def from_address(cls, address) -> 'GeocodeQuery':
+        return cls(address.road, address.number, address.city, address.province)
+
+    @property
+    def key(self) -> str:
+        """Indirizzo normalizzato: senza accenti, in minuscolo, con gli spazi compattati."""
+        parts = [f'{self.road} {self.number}', self.city, self.province]
+        return ', '.join(_WHITESPACE.sub(' ', normalize(part)).strip() for part in parts)
+
+
+class RateLimiter:
+    """Distanzia le chiamate in modo che non siano più di ``rate`` al secondo."""
+
+    def __init__(self, rate: float | None):
+        self.interval = 1 / rate if rate else 0.0
+        self.next = 0.0
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        # Nessun await tra lettura e aggiornamento: non serve un lock
+        now = time.monotonic()
+        delay = self.next - now
+        self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class GeocodingBackend(ABC):
+    # Nome con cui i risultati vengono salvati nella cache
+    name = ''
+    # Chiamate al secondo (None: nessun limite) e chiamate contemporanee
+    rate: float | None = None
+    concurrency = 1
+
+    @abstractmethod
+    async def geocode(self, query: GeocodeQuery) -> tuple[float, float] | None:
+        """Restituisce ``(latitudine, longitudine)``, ``None`` se l'indirizzo non esiste."""
+
+
+class GazetteerBackend(GeocodingBackend):
+    """
+    Coordinate del centro del comune, dall'elenco dei comuni (vedi ``gazetteer.py``).
+
+    Con ``path`` usa un file diverso da quello indicato nelle impostazioni.
+    """
+
+    def __init__(self, path=None):
+        self.gazetteer = gazetteer.Gazetteer.from_csv(path) if path else gazetteer.get()
+        source = path or app_settings['GEOCODING_GAZETTEER'] or gazetteer.DEFAULT_PATH
+        # Ogni file (e ogni sua versione) ha i propri risultati nella cache
+        with open(source, 'rb') as file:
+            self.name = f'gazetteer:{hashlib.sha256(file.read()).hexdigest()[:16]}'
+
+    async def geocode(self, query):
+        place = self.gazetteer.lookup(query.city, query.province)
+        return (place.latitude, place.longitude) if place is not None else None
+
+
+class NominatimBackend(GeocodingBackend):
+    """Servizio HTTP compatibile con Nominatim (``GEOCODING_URL``)."""
+
+    name = 'nominatim'
+    timeout = 10
+
+    def __init__(self):
+        self.url = app_settings['GEOCODING_URL']
+        self.rate = app_settings['GEOCODING_RATE']
+        self.concurrency = app_settings['GEOCODING_CONCURRENCY']
+        self.provinces = dict(app_settings['PROV_CHOICES'])
+
+    def request(self, query: GeocodeQuery) -> list:
+        road = ' '.join(part for part in (query.road, query.number) if part)
+        text = ', '.join(
+            part
+            for part in (road, query.city, self.provinces.get(query.province, query.province))
+            if part
+        )
+        params = urllib.parse.urlencode(
+            {'q': text, 'format': 'jsonv2', 'limit': 1, 'countrycodes': 'it'},
+        )
+        request = urllib.request.Request(
+            f'{self.url}?{params}',
+            headers={'User-Agent': app_settings['GEOCODING_USER_AGENT']},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+        except (OSError, ValueError) as err:
+            raise GeocodingError(str(err)) from err
+
+    async def geocode(self, query):
+        # urllib non è asincrono: la richiesta viene fatta in un thread
+        results = await asyncio.to_thread(self.request, query)
+        if not results:
+            return None
+        try:
+            return float(results[0]['lat']), float(results[0]['lon'])
+        except (KeyError, TypeError, ValueError) as err:
+            raise GeocodingError(f'Unexpected response: {results[0]!r}') from err
+
+
+_backend: GeocodingBackend | None = None
+
+
+def get_backend() -> GeocodingBackend:
+    global _backend
+    if _backend is None:
+        _backend = import_string(app_settings['GEOCODING_BACKEND'])()
+    return _backend
+
+
+async def _geocode_all(
+    backend: GeocodingBackend,
+    queries: list[GeocodeQuery],
+    limiter: RateLimiter,
+) -> dict[str, tuple[float, float] | None]:
+    semaphore = asyncio.Semaphore(backend.concurrency)
+    results: dict[str, tuple[float, float] | None] = {}
+
+    async def run(query):
+        async with semaphore:
+            await limiter.wait()
+            try:
+                results[query.key] = await backend.geocode(query)
+            except GeocodingError:
+                pass
+
+    await asyncio.gather(*(run(query) for query in queries))
+    return results
+
+
+def geocode(
+    queries: Iterable[GeocodeQuery],
+    backend: GeocodingBackend | None = None,
+) -> dict[str, tuple[float, float] | None]:
+    """
+    Coordinate degli indirizzi, per indirizzo normalizzato (``GeocodeQuery.key``).
+
+    I risultati già salvati vengono letti dal database, gli altri chiesti al
+    backend e salvati. Gli indirizzi per cui la chiamata non è riuscita non
+    compaiono nel risultato.
+    """
+    from .models import GeocodeResult
+
+    backend = backend or get_backend()
+    unique: dict[str, GeocodeQuery] = {}
+    for query in queries:
+        if query.city:
+            unique.setdefault(query.key, query)
+    queries = unique
+    keys = list(queries)
+    results: dict[str, tuple[float, float] | None] = {}
+    for start in range(0, len(keys), CHUNK_SIZE):
+        for key, lat, lng in GeocodeResult.objects.filter(
+            backend=backend.name,
+            query__in=keys[start : start + CHUNK_SIZE],
+        ).values_list('query', 'latitude', 'longitude'):
+            results[key] = (lat, lng) if lat is not None else None
+
+    missing = [query for key, query in queries.items() if key not in results]
+    # Il limite vale anche tra un blocco e l'altro
+    limiter = RateLimiter(backend.rate)
+    for start in range(0, len(missing), CHUNK_SIZE):
+        found = asyncio.run(
+            _geocode_all(backend, missing[start : start + CHUNK_SIZE], limiter),
+        )
+        GeocodeResult.objects.bulk_create(
+            [
+                GeocodeResult(
+                    backend=backend.name,
+                    query=key,
+                    latitude=coords[0] if coords else None,
+                    longitude=coords[1] if coords else None,
+                )
+                for key, coords in found.items()
+            ],
+            ignore_conflicts=True,
+        )
+        results.update(found)
+    return results
+
+
+def locate_addresses(addresses: Iterable, backend: GeocodingBackend | None = None) -> list:
+    """
+    Completa coords, latitudine e longitudine degli indirizzi senza coordinate.
+
+    Non salva gli indirizzi; restituisce quelli per cui sono state trovate le coordinate.
+    """
+    addresses = [address for address in addresses if address.coords is None]
+    results = geocode((GeocodeQuery.from_address(address) for address in addresses), backend)
+    located = []
+    for address in addresses:
+        coords = results.get(GeocodeQuery.from_address(address).key)
+        if coords is not None:
+            lat, lng = coords
+            address.coords = {'type': 'Point', 'coordinates': [lng, lat]}
+            address.latitude, address.longitude = lat, lng
+            located.append(address)
+    return located
@@ -0,0 +1,446 @@
+"""
+Importazione di massa delle segnalazioni da file CSV o GeoJSON.
+
+Ogni riga del CSV (o ogni feature di una FeatureCollection) descrive una
+segnalazione con al più un indirizzo e i suoi contatti. I file vengono letti
+un po' alla volta, anche i GeoJSON, e le righe valide vengono salvate a
+blocchi con ``bulk_create``, ognuno in una transazione: la memoria usata non
+dipende dalla dimensione del file.
+
+``bulk_create`` non chiama ``save()`` e non invia i segnali: le copie del
+testo formattato, latitudine e longitudine, i documenti di ricerca e le
+versioni dei contenuti vengono aggiornati qui, una volta per blocco.
+
+Colonne (o proprietà delle feature) riconosciute:
+
+- ``title`` (obbligatoria), ``description``, ``published``;
+- ``category`` (obbligatoria): slug o nome della categoria;
+- ``evaluation``: sigla o nome del livello di valutazione;
+- ``road``, ``number``, ``city``, ``province`` (sigla o nome), ``latitude``
+  e ``longitude`` (nei GeoJSON le coordinate vengono dalla geometria); se
+  mancano le coordinate possono essere cercate con ``geocoding.py``, se
+  manca la provincia viene ricavata dalle coordinate, quando i confini delle
+  province sono configurati (``provinces.py``);
+- ``phone``, ``email``, ``website``: uno o più contatti separati da ``;``.
+"""
+
+import csv
+import io
+import itertools
+import json
+import math
+import re
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from typing import IO, Any
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import NotSupportedError, connections, transaction
+
+from . import geocoding, provinces, reference, richtext, search, versions
+from .geo import coords_to_lat_lng
+from .models import Address, Contact, Entity
+
+FORMATS = ('csv', 'geojson')
+
+# Righe salvate per ogni transazione
+BATCH_SIZE = 1000
+# Caratteri letti dal file a ogni passo
+CHUNK_SIZE = 64 * 1024
+
+# Colonna -> tipo di contatto
+CONTACT_COLUMNS = {'phone': 'P', 'email': 'E', 'website': 'S'}
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'si', 'sì', 'x'}
+
+_NON_WHITESPACE = re.compile(r'\S')
+_decoder = json.JSONDecoder()
+
+
+class InvalidFile(ValueError):
+    """Il file non è nel formato atteso: l'importazione non può proseguire."""
+
+
+class InvalidRow(ValueError):
+    """La riga non è valida: viene segnalata e saltata."""
+
+
+def detect_format(filename: str) -> str:
+    """Formato del file in base all'estensione (``csv`` se non è un GeoJSON)."""
+    return 'geojson' if filename.lower().endswith(('.geojson', '.json')) else 'csv'
+
+
+def read_csv(stream: IO[str], delimiter: str | None = None) -> Iterator[tuple[int, dict]]:
+    """
+    Restituisce ``(numero di riga, colonne)`` per ogni riga del CSV.
+
+    Se ``delimiter`` non è indicato viene riconosciuto dall'inizio del file
+    (virgola, punto e virgola o tabulazione).
+    """
+    sample = stream.read(4096)
+    # Completa l'ultima riga letta, così il campione contiene solo righe intere
+    sample += stream.readline()
+    if delimiter is None:
+        try:
+            delimiter = csv.Sniffer().sniff(sample, delimiters=',;\t').delimiter
+        except csv.Error:
+            delimiter = ','
+    lines = itertools.chain(io.StringIO(sample), stream)
+    reader = csv.DictReader(lines, delimiter=delimiter)
+    if reader.fieldnames is None:
+        return
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    for row in reader:
+        yield reader.line_num, row
+
+
+class _JSONReader:
+    """Legge un documento JSON un valore alla volta, caricando il file a blocchi."""
+
+    def __init__(self, stream: IO[str], chunk_size: int):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Il prossimo carattere diverso da uno spazio, senza consumarlo."""
+        while True:
+            match = _NON_WHITESPACE.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                raise InvalidFile('il file JSON termina in modo inatteso')
+
+    def expect(self, *chars: str) -> str:
+        char = self.peek()
+        if char not in chars:
+            raise InvalidFile(f'atteso {" o ".join(chars)}, trovato {char!r}')
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as err:
+                # Il valore può continuare nel blocco successivo
+                if self._fill():
+                    continue
+                raise InvalidFile(f'JSON non valido: {err}') from err
+            # Un numero alla fine del blocco potrebbe essere troncato
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def read_geojson(stream: IO[str], chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[int, dict]]:
+    """
+    Restituisce ``(numero della feature, proprietà)`` per ogni feature di una FeatureCollection.
+
+    Le feature vengono decodificate una alla volta, senza caricare il file
+    intero; la geometria viene aggiunta alle proprietà come ``geometry``.
+    """
+    reader = _JSONReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        raise InvalidFile('il file non contiene una FeatureCollection')
+    found = False
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise InvalidFile('il file non contiene un oggetto JSON valido')
+        reader.expect(':')
+        if key == 'features':
+            found = True
+            reader.expect('[')
+            n = 0
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    n += 1
+                    feature = reader.value()
+                    if not isinstance(feature, dict):
+                        raise InvalidFile(f'la feature {n} non è un oggetto')
+                    yield n, {
+                        **(feature.get('properties') or {}),
+                        'geometry': feature.get('geometry'),
+                    }
+                    if reader.expect(',', ']') == ']':
+                        break
+        elif key == 'type':
+            if reader.value() != 'FeatureCollection':
+                raise InvalidFile('il file non contiene una FeatureCollection')
+        else:
+            # Altri membri (ad es. crs o name) vengono ignorati
+            reader.value()
+        if reader.expect(',', '}') == '}':
+            break
+    if not found:
+        raise InvalidFile('la FeatureCollection non contiene features')
+
+
+def read_rows(
+    stream: IO[str],
+    format: str,
+    delimiter: str | None = None,
+) -> Iterator[tuple[int, dict]]:
+    if format == 'geojson':
+        return read_geojson(stream)
+    return read_csv(stream, delimiter)
+
+
+def _text(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).strip()
+
+
+def _values(value: Any) -> list[str]:
+    values = value if isinstance(value, list) else _text(value).split(';')
+    return [text for text in map(_text, values) if text]
+
+
+def _max_length(model, name: str) -> int:
+    return model._meta.get_field(name).max_length
+
+
+class Lookups:
+    """Categorie, livelli di valutazione e province per sigla, slug o nome."""
+
+    def __init__(self):
+        data = reference.get()
+        self.categories = {}
+        for category in data.categories.values():
+            self.categories[category.name.casefold()] = category
+            self.categories[category.slug.casefold()] = category
+        self.evaluations = {}
+        for level in data.evaluations.values():
+            self.evaluations[level.full_name.casefold()] = level
+            self.evaluations[level.short_name.casefold()] = level
+        self.provinces = {}
+        for code, name in data.provinces.items():
+            self.provinces[name.casefold()] = code
+            self.provinces[code.casefold()] = code
+
+
+@dataclass
+class ParsedRow:
+    entity: Entity
+    addresses: list[Address]
+    contacts: list[Contact]
+
+
+def _coords(raw: dict) -> dict | None:
+    if 'geometry' in raw:
+        geometry = raw['geometry']
+        if geometry is None:
+            return None
+        if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+            raise InvalidRow('la geometria deve essere un punto')
+        lat, lng = coords_to_lat_lng(geometry)
+    else:
+        if not _text(raw.get('latitude')) and not _text(raw.get('longitude')):
+            return None
+        try:
+            lat, lng = float(_text(raw.get('latitude'))), float(_text(raw.get('longitude')))
+        except ValueError as err:
+            raise InvalidRow('latitudine e longitudine devono essere numeri') from err
+    if lat is None or not (math.isfinite(lat) and math.isfinite(lng)):
+        raise InvalidRow('coordinate non valide')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise InvalidRow('coordinate fuori dai limiti')
+    return {'type': 'Point', 'coordinates': [lng, lat]}
+
+
+def _check_length(model, name: str, value: str, label: str) -> str:
+    if len(value) > _max_length(model, name):
+        raise InvalidRow(f'{label} troppo lungo (massimo {_max_length(model, name)} caratteri)')
+    return value
+
+
+def parse_row(raw: dict, lookups: Lookups) -> ParsedRow:
+    """Valida una riga e ne costruisce segnalazione, indirizzo e contatti (non salvati)."""
+    raw = {str(key).strip().lower(): value for key, value in raw.items() if key is not None}
+
+    title = _check_length(Entity, 'title', _text(raw.get('title')), 'titolo')
+    if not title:
+        raise InvalidRow('titolo mancante')
+    category_name = _text(raw.get('category'))
+    if not category_name:
+        raise InvalidRow('categoria mancante')
+    category = lookups.categories.get(category_name.casefold())
+    if category is None:
+        raise InvalidRow(f'categoria sconosciuta: {category_name}')
+    evaluation = None
+    if _text(raw.get('evaluation')):
+        evaluation = lookups.evaluations.get(_text(raw.get('evaluation')).casefold())
+        if evaluation is None:
+            raise InvalidRow(f'valutazione sconosciuta: {_text(raw.get("evaluation"))}')
+
+    entity = Entity(
+        category_id=category.pk,
+        title=title,
+        description=_text(raw.get('description')),
+        evaluation_id=evaluation.pk if evaluation else None,
+        published=_text(raw.get('published')).casefold() in TRUE_VALUES,
+    )
+    richtext.render_instance(entity)
+
+    addresses = []
+    coords = _coords(raw)
+    road, number, city = (_text(raw.get(name)) for name in ('road', 'number', 'city'))
+    province_name = _text(raw.get('province'))
+    if coords or road or number or city or province_name:
+        if not city:
+            raise InvalidRow('città mancante')
+        if province_name:
+            province = lookups.provinces.get(province_name.casefold())
+        else:
+            province = provinces.province_of(coords)
+        if province is None:
+            raise InvalidRow(f'provincia sconosciuta: {province_name or "(vuota)"}')
+        address = Address(
+            road=_check_length(Address, 'road', road, 'via'),
+            number=_check_length(Address, 'number', number, 'numero civico'),
+            city=_check_length(Address, 'city', city, 'città'),
+            province=province,
+            coords=coords,
+        )
+        if coords is not None:
+            address.latitude, address.longitude = coords_to_lat_lng(coords)
+        addresses.append(address)
+
+    contacts = []
+    for column, typology in CONTACT_COLUMNS.items():
+        for value in _values(raw.get(column)):
+            _check_length(Contact, 'contact', value, 'contatto')
+            if typology == 'E':
+                try:
+                    validate_email(value)
+                except ValidationError as err:
+                    raise InvalidRow(f'e-mail non valida: {value}') from err
+            contacts.append(Contact(typology=typology, contact=value))
+
+    return ParsedRow(entity, addresses, contacts)
+
+
+@dataclass
+class ImportStats:
+    # Righe lette, comprese quelle saltate riprendendo un'importazione
+    rows: int = 0
+    imported: int = 0
+    errors: int = 0
+    # Indirizzi salvati senza coordinate
+    unlocated: int = 0
+    # Indirizzi con la provincia diversa da quella delle coordinate
+    mismatched: int = 0
+
+
+class Importer:
+    """
+    Valida le righe e salva quelle valide a blocchi di ``batch_size``.
+
+    ``on_error(riga, colonne, messaggio)`` viene chiamata per ogni riga non
+    valida, ``on_batch(statistiche)`` dopo il salvataggio di ogni blocco (ad
+    es. per salvare il punto di ripresa). Con ``dry_run`` le righe vengono
+    solo validate. Con ``geocode`` le coordinate mancanti vengono cercate
+    prima di salvare ogni blocco.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = BATCH_SIZE,
+        dry_run: bool = False,
+        on_error: Callable[[int, dict, str], None] | None = None,
+        on_batch: Callable[[ImportStats], None] | None = None,
+        geocode: bool = False,
+        using: str = 'default',
+    ):
+        if not dry_run and not connections[using].features.can_return_rows_from_bulk_insert:
+            # Servono le chiavi delle segnalazioni per collegare indirizzi e contatti
+            raise NotSupportedError('Bulk import needs a database returning keys from inserts.')
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.on_error = on_error or (lambda line, raw, message: None)
+        self.on_batch = on_batch or (lambda stats: None)
+        self.geocode = geocode
+        self.using = using
+        self.lookups = Lookups()
+
+    def run(self, rows: Iterable[tuple[int, dict]], skip: int = 0) -> ImportStats:
+        """Importa le righe, saltando le prime ``skip`` (già importate)."""
+        stats = ImportStats()
+        batch: list[ParsedRow] = []
+        for line, raw in rows:
+            stats.rows += 1
+            if stats.rows <= skip:
+                continue
+            try:
+                batch.append(parse_row(raw, self.lookups))
+            except InvalidRow as err:
+                stats.errors += 1
+                self.on_error(line, raw, str(err))
+                continue
+            if len(batch) >= self.batch_size:
+                self.save(batch, stats)
+                batch = []
+        self.save(batch, stats)
+        return stats
+
+    def save(self, batch: list[ParsedRow], stats: ImportStats) -> None:
+        if batch and not self.dry_run:
+            addresses = [address for row in batch for address in row.addresses]
+            if self.geocode:
+                # Le chiamate al backend avvengono fuori dalla transazione
+                geocoding.locate_addresses(addresses)
+            stats.unlocated += sum(address.coords is None for address in addresses)
+            stats.mismatched += sum(
+                provinces.province_of(address.coords) not in (None, address.province)
+                for address in addresses
+            )
+            with transaction.atomic(using=self.using):
+                self._insert(batch)
+        stats.imported += len(batch)
+        self.on_batch(stats)
+
+    def _insert(self, batch: list[ParsedRow]) -> None:
+        entities = Entity.objects.using(self.using).bulk_create([row.entity for row in batch])
+        addresses, contacts = [], []
+        for row, entity in zip(batch, entities):
+            for obj in row.addresses:
+                obj.entity_id = entity.pk
+            for obj in row.contacts:
+                obj.entity_id = entity.pk
+            addresses += row.addresses
+            contacts += row.contacts
+        Address.objects.using(self.using).bulk_create(addresses)
+        Contact.objects.using(self.using).bulk_create(contacts)
+        search.update_documents([entity.pk for entity in entities], using=self.using)
+        # Le segnalazioni sono nuove: non ci sono pagine o popup salvati da
+        # invalidare, solo i dati e gli elenchi delle loro categorie
+        categories = reference.get().categories_by_pk
+        slugs = {categories[entity.category_id].slug for entity in entities}
+        versions.bump(
+            *(versions.category_scope(slug) for slug in slugs),
+            *(versions.list_scope(slug) for slug in slugs),
+        )
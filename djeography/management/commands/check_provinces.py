@@ -0,0 +1,89 @@
+"""Controlla la provincia degli indirizzi con le coordinate (vedi ``djeography/provinces.py``)."""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djeography import provinces, versions
+from djeography.models import Address
+
+# Indirizzi letti per ogni blocco
+BATCH_SIZE = 5000
+# Indirizzi diversi elencati nell'output
+SHOWN = 20
+
+
+class Command(BaseCommand):
+    help = (
+        'Controlla, a blocchi, che la provincia degli indirizzi corrisponda alle '
+        'coordinate e con --fix la corregge.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='Indirizzi elaborati per ogni blocco',
+        )
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Sostituisce la provincia con quella ricavata dalle coordinate',
+        )
+
+    def handle(self, *args: Any, **options: Any):
+        index = provinces.get()
+        if index is None:
+            raise CommandError(
+                "Manca il file dei confini: imposta DJEOGRAPHY_CONFIG['PROVINCE_BOUNDARIES'].",
+            )
+        queryset = Address.objects.filter(latitude__isnull=False).order_by('pk')
+        checked = mismatched = outside = 0
+        last = 0
+        while True:
+            rows = list(
+                queryset.filter(pk__gt=last).values_list(
+                    'pk',
+                    'latitude',
+                    'longitude',
+                    'province',
+                    'entity_id',
+                )[: options['batch_size']],
+            )
+            if not rows:
+                break
+            last = rows[-1][0]
+            # Provincia ricavata -> indirizzi da correggere
+            fixes: dict[str, list[int]] = {}
+            entities = set()
+            for pk, lat, lng, province, entity_id in rows:
+                located = index.locate(lat, lng)
+                if located is None:
+                    outside += 1
+                elif located != province:
+                    if mismatched < SHOWN:
+                        self.stdout.write(
+                            f'Indirizzo {pk}: {province or "(vuota)"}, '
+                            f'dalle coordinate {located}',
+                        )
+                    mismatched += 1
+                    fixes.setdefault(located, []).append(pk)
+                    entities.add(entity_id)
+            checked += len(rows)
+            if options['fix'] and fixes:
+                for province, pks in fixes.items():
+                    Address.objects.filter(pk__in=pks).update(province=province)
+                # update non invia i segnali: filtri, elenchi e popup cambiano
+                versions.touch_entities(entities)
+
+        if mismatched > SHOWN:
+            self.stdout.write(f'... e altri {mismatched - SHOWN} indirizzi.')
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{checked} indirizzi controllati, {mismatched} con la provincia diversa da '
+                f'quella delle coordinate, {outside} fuori dai confini.',
+            ),
+        )
+        if options['fix'] and mismatched:
+            self.stdout.write(self.style.SUCCESS(f'{mismatched} province corrette.'))
@@ -0,0 +1,102 @@
+"""
+Esporta segnalazioni, indirizzi, contatti e testimonianze in CSV, GeoJSON o NDJSON.
+
+Vedi ``djeography/exporting.py`` per il formato dei record.
+"""
+
+import os
+import sys
+from pathlib import Path
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djeography import exporting
+from djeography.models import Entity
+
+# Estensione del file -> formato
+EXTENSIONS = {'.csv': 'csv', '.geojson': 'geojson', '.json': 'geojson', '.ndjson': 'ndjson'}
+
+
+class Command(BaseCommand):
+    help = (
+        'Esporta le segnalazioni, con indirizzi, contatti e testimonianze, '
+        'in un file CSV, GeoJSON o NDJSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='File da scrivere ("-" per lo standard output)')
+        parser.add_argument(
+            '--format',
+            choices=exporting.FORMATS,
+            help="Formato del file (predefinito: in base all'estensione)",
+        )
+        parser.add_argument(
+            '--flat',
+            action='store_true',
+            help='Un record per indirizzo, con i contatti in colonne (sempre per il CSV)',
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            help='Comprime il file con gzip (predefinito se il nome termina con .gz)',
+        )
+        parser.add_argument('--category', help='Slug della categoria')
+        parser.add_argument('--province', help='Sigla della provincia')
+        parser.add_argument('--evaluation', help='Sigla del livello di valutazione')
+        state = parser.add_mutually_exclusive_group()
+        state.add_argument(
+            '--published',
+            action='store_const',
+            const=True,
+            dest='published',
+            help='Solo le segnalazioni pubblicate',
+        )
+        state.add_argument(
+            '--drafts',
+            action='store_const',
+            const=False,
+            dest='published',
+            help='Solo le segnalazioni non pubblicate',
+        )
+
+    def handle(self, *args: Any, **options: Any):
+        output = options['output']
+        compressed = options['gzip'] or output.endswith('.gz')
+        format = options['format']
+        if format is None:
+            suffix = Path(output.removesuffix('.gz')).suffix.lower()
+            if suffix not in EXTENSIONS:
+                raise CommandError(f'Impossibile dedurre il formato da {output}: usa --format.')
+            format = EXTENSIONS[suffix]
+
+        queryset = exporting.filter_entities(
+            Entity.objects.all(),
+            {name: options[name] for name in ('category', 'province', 'evaluation')},
+            published=options['published'],
+        )
+        export = exporting.Export(queryset, format, flat=options['flat'])
+        chunks = exporting.compress(export) if compressed else exporting.encode(export)
+
+        if output == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            # Scrive in un file temporaneo e lo rinomina: un'esportazione interrotta
+            # non sostituisce il file precedente
+            target = Path(output)
+            temporary = target.with_name(target.name + '.tmp')
+            try:
+                with open(temporary, 'wb') as file:
+                    for chunk in chunks:
+                        file.write(chunk)
+            except BaseException:
+                temporary.unlink(missing_ok=True)
+                raise
+            os.replace(temporary, target)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'{export.entities} segnalazioni esportate ({export.records} record).',
+                ),
+            )
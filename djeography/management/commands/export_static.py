@@ -0,0 +1,209 @@
+"""
+Esporta una copia statica della mappa pubblica.
+
+Le pagine e i dati vengono generati dalle stesse viste usate dal sito, con
+una richiesta anonima, e scritti in una cartella che riproduce la struttura
+degli URL: la copia può essere servita da nginx o da una CDN senza Django.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+from pathlib import Path
+from typing import Any
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.urls import resolve, reverse
+
+from djeography import geo
+from djeography.models import Address, Category, Entity
+from djeography.views import EntityListView, MapView
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+
+class SnapshotMapView(MapView):
+    """
+    La mappa della copia statica.
+
+    Un server statico ignora i parametri della query: la mappa scarica una
+    sola volta tutti gli indirizzi, dal file nel formato a colonne.
+    """
+
+    page_cache = False
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['data_url'] = columnar_url()
+        # I popup vengono scaricati uno alla volta, già pronti
+        context['popups_url'] = None
+        # La ricerca dei comuni ha bisogno dei parametri: la mappa usa Photon
+        context['places_url'] = None
+        context['viewport_min_zoom'] = geo.MAX_ZOOM + 1
+        context['server_clustering'] = False
+        return context
+
+
+class SnapshotEntityListView(EntityListView):
+    """
+    L'elenco delle segnalazioni della copia statica.
+
+    Sempre a pagine numerate, salvate in ``entities/page/<n>/``: i link
+    portano ai percorsi delle pagine invece che al parametro ``page``.
+    """
+
+    page_cache = False
+
+    def get_pagination_mode(self) -> str:
+        return 'pages'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['page_path'] = reverse('djeography:list')
+        return context
+
+
+def columnar_url() -> str:
+    return posixpath.splitext(reverse('djeography:data_all'))[0] + '.bin'
+
+
+def url_to_path(url: str) -> str:
+    """Percorso del file per un URL: gli URL che terminano con ``/`` diventano ``index.html``."""
+    path = url.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    return path
+
+
+class Command(BaseCommand):
+    help = (
+        'Esporta in una cartella la mappa pubblica, i popup, i dati GeoJSON '
+        'e le pagine delle segnalazioni come file statici.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Cartella in cui scrivere i file')
+        parser.add_argument(
+            '--no-compress',
+            action='store_false',
+            dest='compress',
+            help='Non scrivere le copie compresse .gz e .br',
+        )
+
+    def handle(self, *args: Any, **options: Any):
+        self.output = Path(options['output'])
+        self.compress = options['compress']
+        self.factory = RequestFactory()
+        manifest_path = self.output / MANIFEST
+        try:
+            self.previous = json.loads(manifest_path.read_text())
+        except FileNotFoundError:
+            self.previous = {}
+        except ValueError as e:
+            raise CommandError(f'{manifest_path} non è un manifest valido: {e}') from e
+        self.manifest: dict[str, str] = {}
+        self.written = 0
+
+        self.export_data()
+        self.export_pages()
+
+        removed = 0
+        for path in self.previous.keys() - self.manifest.keys():
+            for name in (path, path + '.gz', path + '.br'):
+                (self.output / name).unlink(missing_ok=True)
+            removed += 1
+        self._write(MANIFEST, json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{len(self.manifest)} file esportati: {self.written} aggiornati, '
+                f'{len(self.manifest) - self.written} invariati, {removed} rimossi.',
+            ),
+        )
+
+    def export_data(self):
+        self.export(reverse('djeography:data_all'))
+        self.export(reverse('djeography:data_all'), {'format': 'columnar'}, columnar_url())
+        for slug in Category.objects.values_list('slug', flat=True):
+            self.export(reverse('djeography:data', kwargs={'slug': slug}))
+
+    def export_pages(self):
+        self.export(reverse('djeography:map_fullscreen'), view=SnapshotMapView.as_view())
+
+        # Le pagine successive alla prima sono salvate in entities/page/<n>/
+        list_url = reverse('djeography:list')
+        list_view = SnapshotEntityListView.as_view()
+        response = self.export(list_url, view=list_view)
+        for page in range(2, response.context_data['paginator'].num_pages + 1):
+            self.export(list_url, {'page': page}, f'{list_url}page/{page}/', view=list_view)
+
+        for pk in Entity.published_objects.values_list('pk', flat=True).order_by('pk'):
+            self.export(reverse('djeography:detail', kwargs={'pk': pk}))
+        for pk in (
+            Address.objects.filter(entity__published=True)
+            .values_list('pk', flat=True)
+            .order_by('pk')
+        ):
+            self.export(reverse('djeography:popup', kwargs={'pk': pk}))
+
+    def export(self, url: str, query: dict | None = None, target: str | None = None, view=None):
+        """Genera la risposta della vista per ``url`` e la scrive nel file corrispondente."""
+        request = self.factory.get(url, query or {})
+        request.user = AnonymousUser()
+        match = resolve(url)
+        response = (view or match.func)(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        if response.status_code != 200:
+            raise CommandError(f'{url} ha restituito lo stato {response.status_code}')
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        self._export_file(url_to_path(target or url), content)
+        return response
+
+    def _export_file(self, path: str, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()
+        self.manifest[path] = digest
+        if self.previous.get(path) == digest and (self.output / path).exists():
+            siblings_missing = self.compress and not all(
+                (self.output / (path + suffix)).exists() for suffix in self._suffixes()
+            )
+            if not siblings_missing:
+                return
+        self._write(path, content)
+        siblings = {}
+        if self.compress:
+            # mtime=0: file identici producono copie compresse identiche
+            siblings['.gz'] = gzip.compress(content, compresslevel=9, mtime=0)
+            if brotli is not None:
+                siblings['.br'] = brotli.compress(content)
+        for suffix in ('.gz', '.br'):
+            if suffix in siblings:
+                self._write(path + suffix, siblings[suffix])
+            else:
+                # Una copia compressa rimasta da un'esportazione precedente non è più valida
+                (self.output / (path + suffix)).unlink(missing_ok=True)
+        self.written += 1
+
+    @staticmethod
+    def _suffixes() -> list[str]:
+        return ['.gz', '.br'] if brotli is not None else ['.gz']
+
+    def _write(self, path: str, content: bytes):
+        # Scrive in un file temporaneo e lo rinomina, così il server non legge mai un file a metà
+        target = self.output / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temporary = target.with_name(target.name + '.tmp')
+        temporary.write_bytes(content)
+        os.replace(temporary, target)
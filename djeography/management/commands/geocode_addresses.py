@@ -0,0 +1,45 @@
+"""Cerca le coordinate degli indirizzi che non le hanno (vedi ``djeography/geocoding.py``)."""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand
+
+from djeography import geocoding, versions
+from djeography.models import Address
+
+
+class Command(BaseCommand):
+    help = (
+        'Cerca con il backend di geocoding le coordinate degli indirizzi che non le '
+        'hanno e le salva, a blocchi.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=geocoding.CHUNK_SIZE,
+            help='Indirizzi elaborati per ogni blocco',
+        )
+
+    def handle(self, *args: Any, **options: Any):
+        backend = geocoding.get_backend()
+        queryset = Address.objects.filter(coords__isnull=True).order_by('pk')
+        located = missing = 0
+        last = 0
+        while True:
+            # Gli indirizzi non trovati restano senza coordinate: si prosegue per chiave
+            addresses = list(queryset.filter(pk__gt=last)[: options['batch_size']])
+            if not addresses:
+                break
+            last = addresses[-1].pk
+            found = geocoding.locate_addresses(addresses, backend)
+            Address.objects.bulk_update(found, ['coords', 'latitude', 'longitude'])
+            # bulk_update non invia i segnali: gli indirizzi compaiono ora sulla mappa
+            versions.touch_entities({address.entity_id for address in found})
+            located += len(found)
+            missing += len(addresses) - len(found)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'{located} indirizzi localizzati, {missing} non trovati.'),
+        )
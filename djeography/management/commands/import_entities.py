@@ -0,0 +1,160 @@
+"""
+Importa segnalazioni, indirizzi e contatti da un file CSV o GeoJSON.
+
+Vedi ``djeography/importing.py`` per le colonne riconosciute.
+"""
+
+import csv
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djeography import importing
+
+
+class Command(BaseCommand):
+    help = (
+        'Importa segnalazioni, indirizzi e contatti da un file CSV o da una '
+        'FeatureCollection GeoJSON, a blocchi.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='File CSV o GeoJSON da importare')
+        parser.add_argument(
+            '--format',
+            choices=importing.FORMATS,
+            help="Formato del file (predefinito: in base all'estensione)",
+        )
+        parser.add_argument(
+            '--delimiter',
+            help='Separatore delle colonne del CSV (predefinito: riconosciuto dal file)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=importing.BATCH_SIZE,
+            help='Righe salvate per ogni transazione',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Valida le righe senza salvare nulla',
+        )
+        parser.add_argument(
+            '--geocode',
+            action='store_true',
+            help='Cerca le coordinate degli indirizzi che non le hanno (vedi geocoding.py)',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help=(
+                'File in cui salvare il numero di righe già importate: se esiste, '
+                "l'importazione riprende da lì"
+            ),
+        )
+        parser.add_argument(
+            '--errors',
+            help='File CSV in cui scrivere le righe non valide e il motivo',
+        )
+
+    def handle(self, *args: Any, **options: Any):
+        path = Path(options['file'])
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size deve essere almeno 1.')
+        try:
+            size = path.stat().st_size
+        except OSError as e:
+            raise CommandError(f'Impossibile leggere {path}: {e}') from e
+        format = options['format'] or importing.detect_format(path.name)
+
+        self.checkpoint = Path(options['checkpoint']) if options['checkpoint'] else None
+        self.source = {'file': str(path.resolve()), 'size': size}
+        skip = 0 if options['dry_run'] else self.read_checkpoint()
+
+        errors_file = writer = None
+        if options['errors']:
+            # Riprendendo, gli errori vengono aggiunti a quelli già scritti
+            errors_file = open(options['errors'], 'a' if skip else 'w', newline='')
+            writer = csv.writer(errors_file)
+            if not skip:
+                writer.writerow(['row', 'title', 'error'])
+        self.error_count = 0
+
+        def on_error(line, raw, message):
+            if writer is not None:
+                writer.writerow([line, raw.get('title') or '', message])
+            elif self.error_count < 20:
+                self.stderr.write(f'Riga {line}: {message}')
+            self.error_count += 1
+
+        importer = importing.Importer(
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            on_error=on_error,
+            on_batch=None if options['dry_run'] else self.write_checkpoint,
+            geocode=options['geocode'],
+        )
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                stats = importer.run(
+                    importing.read_rows(stream, format, options['delimiter']),
+                    skip=skip,
+                )
+        except (importing.InvalidFile, UnicodeDecodeError) as e:
+            raise CommandError(f'{path} non è un file {format} valido: {e}') from e
+        finally:
+            if errors_file is not None:
+                errors_file.close()
+
+        if writer is None and self.error_count > 20:
+            self.stderr.write(f'... e altre {self.error_count - 20} righe con errori.')
+        if skip:
+            self.stdout.write(f'{min(skip, stats.rows)} righe già importate saltate.')
+        if options['dry_run']:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'{stats.imported} righe valide, {stats.errors} righe con errori '
+                    '(nessuna modifica salvata).',
+                ),
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'{stats.imported} segnalazioni importate, {stats.errors} righe con errori.',
+                ),
+            )
+            if stats.unlocated:
+                self.stdout.write(
+                    f'{stats.unlocated} indirizzi senza coordinate: '
+                    'usa geocode_addresses per cercarle.',
+                )
+            if stats.mismatched:
+                self.stdout.write(
+                    f'{stats.mismatched} indirizzi con la provincia diversa da quella delle '
+                    'coordinate: usa check_provinces per controllarli.',
+                )
+
+    def read_checkpoint(self) -> int:
+        if self.checkpoint is None or not self.checkpoint.exists():
+            return 0
+        try:
+            saved = json.loads(self.checkpoint.read_text())
+            rows = int(saved['rows'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise CommandError(f'{self.checkpoint} non è un punto di ripresa valido.') from e
+        if saved.get('source') != self.source:
+            raise CommandError(
+                f'{self.checkpoint} si riferisce a un altro file: eliminalo per ricominciare.',
+            )
+        return rows
+
+    def write_checkpoint(self, stats: importing.ImportStats):
+        if self.checkpoint is None:
+            return
+        # Scrive in un file temporaneo e lo rinomina, così il punto di ripresa non è mai a metà
+        temporary = self.checkpoint.with_name(self.checkpoint.name + '.tmp')
+        temporary.write_text(json.dumps({'source': self.source, 'rows': stats.rows}))
+        os.replace(temporary, self.checkpoint)
@@ -0,0 +1,21 @@
+"""Ricalcola le statistiche delle testimonianze salvate nelle segnalazioni."""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand
+
+from djeography import versions
+from djeography.models import Entity
+
+
+class Command(BaseCommand):
+    help = (
+        'Ricalcola per ogni segnalazione la data della testimonianza più recente '
+        'e il numero di testimonianze.'
+    )
+
+    def handle(self, *args: Any, **options: Any):
+        updated = Entity.objects.update_report_stats()
+        # Elenco e popup mostrano le statistiche: invalida le copie in cache
+        versions.bump(versions.GLOBAL_SCOPE)
+        self.stdout.write(self.style.SUCCESS(f'{updated} segnalazioni aggiornate.'))
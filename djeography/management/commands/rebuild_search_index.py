@@ -0,0 +1,19 @@
+"""Rigenera i documenti e l'indice di ricerca delle segnalazioni."""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand
+
+from djeography import search
+from djeography.models import SearchDocument
+
+
+class Command(BaseCommand):
+    help = "Rigenera i documenti di ricerca di tutte le segnalazioni e ricostruisce l'indice."
+
+    def handle(self, *args: Any, **options: Any):
+        search.update_documents()
+        search.get_backend().rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(f'{SearchDocument.objects.count()} segnalazioni indicizzate.'),
+        )
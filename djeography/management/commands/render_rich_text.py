@@ -0,0 +1,20 @@
+"""Rigenera HTML ripulito, testo ed estratto di descrizioni e testimonianze."""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand
+
+from djeography import richtext, versions
+
+
+class Command(BaseCommand):
+    help = (
+        "Rigenera per ogni segnalazione e testimonianza l'HTML ripulito, "
+        "il testo semplice e l'estratto del testo formattato."
+    )
+
+    def handle(self, *args: Any, **options: Any):
+        updated = richtext.render_all()
+        # Pagine e popup mostrano le copie generate: invalida le copie in cache
+        versions.bump(versions.GLOBAL_SCOPE)
+        self.stdout.write(self.style.SUCCESS(f'{updated} righe aggiornate.'))
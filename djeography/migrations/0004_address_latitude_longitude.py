@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+# Indirizzi letti e aggiornati per ogni blocco
+CHUNK_SIZE = 500
+
+
+# Copia di djeography.geo.coords_to_lat_lng al momento della migrazione:
+# le modifiche successive al modulo non la cambiano
+def coords_to_lat_lng(coords):
+    try:
+        lng, lat = coords['coordinates'][:2]
+        return float(lat), float(lng)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None, None
+
+
+def fill_latitude_longitude(apps, schema_editor):
+    Address = apps.get_model('djeography', 'Address')
+    batch = []
+    for address in Address._base_manager.only('pk', 'coords').iterator(chunk_size=CHUNK_SIZE):
+        address.latitude, address.longitude = coords_to_lat_lng(address.coords)
+        batch.append(address)
+        if len(batch) == CHUNK_SIZE:
+            Address._base_manager.bulk_update(
+                batch,
+                ['latitude', 'longitude'],
+                batch_size=CHUNK_SIZE,
+            )
+            batch = []
+    Address._base_manager.bulk_update(batch, ['latitude', 'longitude'], batch_size=CHUNK_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djeography', '0003_alter_category_icon_alter_entity_description_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='latitude',
+            field=models.FloatField(editable=False, null=True, verbose_name='latitudine'),
+        ),
+        migrations.AddField(
+            model_name='address',
+            name='longitude',
+            field=models.FloatField(editable=False, null=True, verbose_name='longitudine'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['latitude', 'longitude'], name='address_lat_lng_idx'),
+        ),
+        migrations.RunPython(fill_latitude_longitude, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:05
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_report_stats(apps, schema_editor):
+    Entity = apps.get_model('djeography', 'Entity')
+    Report = apps.get_model('djeography', 'Report')
+    reports = Report.objects.filter(entity=OuterRef('pk')).order_by().values('entity')
+    Entity.objects.update(
+        latest_update=Subquery(reports.annotate(latest=Max('date_added')).values('latest')),
+        n_reports=Coalesce(Subquery(reports.annotate(n=Count('pk')).values('n')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djeography', '0004_address_latitude_longitude'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity',
+            name='latest_update',
+            field=models.DateField(blank=True, editable=False, null=True, verbose_name='testimonianza più recente'),
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='n_reports',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='testimonianze'),
+        ),
+        migrations.AddIndex(
+            model_name='entity',
+            index=models.Index(fields=['published', '-latest_update', 'id'], name='entity_list_order_idx'),
+        ),
+        migrations.RunPython(fill_report_stats, migrations.RunPython.noop),
+    ]
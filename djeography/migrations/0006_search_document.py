@@ -0,0 +1,186 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:10
+
+import re
+import unicodedata
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.html import strip_tags
+
+import djeography.search
+
+# Copie di costanti e funzioni di djeography/search.py al momento della
+# migrazione: le modifiche successive al modulo non la cambiano
+SQLITE_TABLE = 'djeography_searchdocument_fts'
+WEIGHTS = (10.0, 5.0, 1.0)
+CHUNK_SIZE = 500
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', strip_tags(text or ''))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    return _TOKEN.findall(text)
+
+
+def update_documents(apps):
+    Entity = apps.get_model('djeography', 'Entity')
+    Address = apps.get_model('djeography', 'Address')
+    Report = apps.get_model('djeography', 'Report')
+    SearchDocument = apps.get_model('djeography', 'SearchDocument')
+
+    entity_ids = list(Entity._base_manager.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(entity_ids), CHUNK_SIZE):
+        chunk = entity_ids[start : start + CHUNK_SIZE]
+        places, texts = defaultdict(list), defaultdict(list)
+        for entity_id, city, road in Address._base_manager.filter(entity__in=chunk).values_list(
+            'entity_id',
+            'city',
+            'road',
+        ):
+            places[entity_id] += [city, road]
+        for entity_id, title, body in Report._base_manager.filter(entity__in=chunk).values_list(
+            'entity_id',
+            'title',
+            'body',
+        ):
+            texts[entity_id] += [title, body]
+        SearchDocument._base_manager.bulk_create(
+            [
+                SearchDocument(
+                    entity_id=entity_id,
+                    title=' '.join(tokenize(title)),
+                    place=' '.join(tokenize(' '.join(places[entity_id]))),
+                    body=' '.join(tokenize(' '.join([description, *texts[entity_id]]))),
+                )
+                for entity_id, title, description in Entity._base_manager.filter(
+                    pk__in=chunk,
+                ).values_list('pk', 'title', 'description')
+            ],
+        )
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            if ('ENABLE_FTS5',) not in cursor.fetchall():
+                # Senza FTS5 viene usato l'indice invertito in memoria
+                return
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {SQLITE_TABLE} USING fts5('
+            "title, place, body, content='djeography_searchdocument', "
+            "content_rowid='entity_id', tokenize='unicode61 remove_diacritics 2')",
+        )
+        # Pesi di titolo, luoghi e testo nel punteggio bm25
+        weights = ', '.join(str(weight) for weight in WEIGHTS)
+        schema_editor.execute(
+            f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rank) VALUES ('rank', 'bm25({weights})')",
+        )
+        # Trigger che mantengono la tabella FTS5 allineata ai documenti
+        insert = (
+            f'INSERT INTO {SQLITE_TABLE}(rowid, title, place, body) '
+            'VALUES (new.entity_id, new.title, new.place, new.body);'
+        )
+        delete = (
+            f'INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, title, place, body) '
+            "VALUES ('delete', old.entity_id, old.title, old.place, old.body);"
+        )
+        for name, event, body in (
+            ('ai', 'AFTER INSERT', insert),
+            ('ad', 'AFTER DELETE', delete),
+            ('au', 'AFTER UPDATE', delete + ' ' + insert),
+        ):
+            schema_editor.execute(
+                f'CREATE TRIGGER {SQLITE_TABLE}_{name} {event} ON djeography_searchdocument '
+                f'BEGIN {body} END',
+            )
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'ALTER TABLE djeography_searchdocument ADD COLUMN vector tsvector '
+            "GENERATED ALWAYS AS (setweight(to_tsvector('simple', title), 'A') || "
+            "setweight(to_tsvector('simple', place), 'B') || "
+            "setweight(to_tsvector('simple', body), 'D')) STORED",
+        )
+        schema_editor.execute(
+            'CREATE INDEX djeography_searchdocument_vector_idx '
+            'ON djeography_searchdocument USING gin (vector)',
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            trigram = cursor.fetchone() is not None
+        if trigram:
+            for column in ('title', 'place'):
+                schema_editor.execute(
+                    f'CREATE INDEX djeography_searchdocument_{column}_trgm_idx '
+                    f'ON djeography_searchdocument USING gin ({column} gin_trgm_ops)',
+                )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        for name in ('ai', 'ad', 'au'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {SQLITE_TABLE}_{name}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SQLITE_TABLE}')
+    elif connection.vendor == 'postgresql':
+        # Gli indici vengono eliminati insieme alla colonna
+        schema_editor.execute('ALTER TABLE djeography_searchdocument DROP COLUMN vector')
+
+
+def fill_search_documents(apps, schema_editor):
+    # La tabella dei documenti è appena stata creata: nessun documento da sostituire
+    update_documents(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djeography', '0005_entity_report_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('entity', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='djeography.entity')),
+                ('title', models.TextField(verbose_name='titolo')),
+                ('place', models.TextField(verbose_name='luoghi')),
+                ('body', models.TextField(verbose_name='testo')),
+            ],
+            options={
+                'verbose_name': 'documento di ricerca',
+                'verbose_name_plural': 'documenti di ricerca',
+            },
+        ),
+        migrations.CreateModel(
+            name='PostgreSQLSearchIndex',
+            fields=[
+                ('entity', models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index_postgresql', serialize=False, to='djeography.entity')),
+                ('title', djeography.search.SearchField()),
+                ('place', djeography.search.SearchField()),
+                ('vector', djeography.search.SearchField()),
+            ],
+            options={
+                'db_table': 'djeography_searchdocument',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='SQLiteSearchIndex',
+            fields=[
+                ('entity', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index_sqlite', serialize=False, to='djeography.entity')),
+                ('match', djeography.search.SearchField(db_column='djeography_searchdocument_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'djeography_searchdocument_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(fill_search_documents, migrations.RunPython.noop),
+    ]
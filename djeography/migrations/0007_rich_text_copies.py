@@ -0,0 +1,182 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:37
+
+import re
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from django.db import migrations, models
+
+# Copie di costanti e funzioni di djeography/richtext.py al momento della
+# migrazione: le modifiche successive al modulo non la cambiano. Con
+# un'altra lunghezza degli estratti (EXCERPT_LENGTH) le copie si rigenerano
+# con il comando render_rich_text
+ALLOWED_TAGS = {
+    'a': {'href', 'title', 'target'},
+    'b': set(),
+    'blockquote': set(),
+    'br': set(),
+    'em': set(),
+    'h1': set(),
+    'h2': set(),
+    'h3': set(),
+    'h4': set(),
+    'h5': set(),
+    'h6': set(),
+    'hr': set(),
+    'i': set(),
+    'li': set(),
+    'ol': set(),
+    'p': set(),
+    's': set(),
+    'span': set(),
+    'strong': set(),
+    'sub': set(),
+    'sup': set(),
+    'u': set(),
+    'ul': set(),
+}
+VOID_TAGS = {'br', 'hr'}
+BLOCK_TAGS = set('blockquote br div h1 h2 h3 h4 h5 h6 hr li ol p table td th tr ul'.split())
+DROPPED_TAGS = {'script', 'style', 'template', 'iframe', 'object'}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto', 'tel'}
+FIELDS = {
+    'Entity': 'description',
+    'Report': 'body',
+}
+EXCERPT_LENGTH = 300
+CHUNK_SIZE = 500
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class Cleaner(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.html = []
+        self.text = []
+        self.open = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append(' ')
+        if tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_TAGS[tag]
+        rendered = []
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name == 'href' and urlsplit(value.strip()).scheme.lower() not in ALLOWED_SCHEMES:
+                continue
+            rendered.append(f' {name}="{escape(value)}"')
+        if tag == 'a' and any(name == 'target' for name, _ in attrs):
+            rendered.append(' rel="noopener noreferrer"')
+        self.html.append(f'<{tag}{"".join(rendered)}>')
+        if tag not in VOID_TAGS:
+            self.open.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append(' ')
+        if tag not in self.open:
+            return
+        while self.open:
+            current = self.open.pop()
+            self.html.append(f'</{current}>')
+            if current == tag:
+                break
+
+    def handle_data(self, data):
+        if self.dropping:
+            return
+        self.html.append(escape(data, quote=False))
+        self.text.append(data)
+
+    def close(self):
+        super().close()
+        while self.open:
+            self.html.append(f'</{self.open.pop()}>')
+
+
+def excerpt(text, length):
+    if len(text) <= length:
+        return text
+    cut = text[: length - 1]
+    if ' ' in cut and not text[length - 1].isspace():
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip(' ,.;:') + '…'
+
+
+def render(html):
+    cleaner = Cleaner()
+    cleaner.feed(html or '')
+    cleaner.close()
+    text = _WHITESPACE.sub(' ', ''.join(cleaner.text)).strip()
+    return ''.join(cleaner.html).strip(), text, excerpt(text, EXCERPT_LENGTH)
+
+
+def fill_rich_text_copies(apps, schema_editor):
+    for model_name, field in FIELDS.items():
+        model = apps.get_model('djeography', model_name)
+        names = [f'{field}_html', f'{field}_text', f'{field}_excerpt']
+        pks = list(model._base_manager.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[start : start + CHUNK_SIZE]
+            objs = list(model._base_manager.filter(pk__in=chunk).only('pk', field))
+            for obj in objs:
+                for name, value in zip(names, render(getattr(obj, field))):
+                    setattr(obj, name, value)
+            model._base_manager.bulk_update(objs, names)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djeography', '0006_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity',
+            name='description_excerpt',
+            field=models.TextField(blank=True, editable=False, verbose_name='info (estratto)'),
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='description_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='info (HTML ripulito)'),
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='description_text',
+            field=models.TextField(blank=True, editable=False, verbose_name='info (testo)'),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='body_excerpt',
+            field=models.TextField(blank=True, editable=False, verbose_name='testo (estratto)'),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='body_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='testo (HTML ripulito)'),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='body_text',
+            field=models.TextField(blank=True, editable=False, verbose_name='testo (solo testo)'),
+        ),
+        migrations.RunPython(fill_rich_text_copies, migrations.RunPython.noop),
+    ]
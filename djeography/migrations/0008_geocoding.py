@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+import djgeojson.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djeography', '0007_rich_text_copies'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='address',
+            name='coords',
+            field=djgeojson.fields.PointField(blank=True, null=True, verbose_name='coordinate'),
+        ),
+        migrations.CreateModel(
+            name='GeocodeResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=100, verbose_name='servizio')),
+                ('query', models.CharField(max_length=255, verbose_name='indirizzo')),
+                ('latitude', models.FloatField(null=True, verbose_name='latitudine')),
+                ('longitude', models.FloatField(null=True, verbose_name='longitudine')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='data')),
+            ],
+            options={
+                'verbose_name': 'coordinate trovate',
+                'verbose_name_plural': 'coordinate trovate',
+                'constraints': [models.UniqueConstraint(fields=('backend', 'query'), name='geocode_result_unique')],
+            },
+        ),
+    ]
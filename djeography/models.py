@@ -1,4 +1,7 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from django.template.defaultfilters import slugify
 from django.urls import reverse
 from django.utils import timezone
@@ -6,20 +9,176 @@ from djgeojson.fields import PointField
 
 from djeography import app_settings
 
+from . import provinces, richtext
+from .geo import coords_to_lat_lng
+from .search import SQLITE_TABLE, SearchField
 
-class EntityManager(models.Manager):
+
+class EntityQuerySet(models.QuerySet):
     """
-    Un manager per le segnalazioni.
+    Profili di query delle segnalazioni.
 
-    Evita ulteriori richieste al database per categoria, indirizzo e contatti
+    Ogni profilo legge solo le colonne e le righe collegate che servono al
+    template che lo usa: il queryset di base non carica nulla in più.
     """
 
-    def get_queryset(self) -> models.QuerySet:
+    # Segnalazioni aggiornate per ogni blocco da set_published
+    moderation_chunk_size = 500
+
+    # Colonne mostrate nell'intestazione delle schede (vedi _card_header.html)
+    card_fields = ('title', 'published', 'category__name', 'evaluation__short_name')
+
+    def _addresses(self) -> Prefetch:
+        return Prefetch(
+            'address_set',
+            queryset=Address.objects.only('entity', 'road', 'number', 'city', 'province'),
+        )
+
+    def _contacts(self) -> Prefetch:
+        return Prefetch(
+            'contact_set',
+            queryset=Contact.objects.only('entity', 'typology', 'contact'),
+        )
+
+    def for_list(self) -> models.QuerySet:
+        """Schede dell'elenco: indirizzi, contatti, estratto e statistiche."""
+        return (
+            self.select_related('category', 'evaluation')
+            .only(*self.card_fields, 'description_excerpt', 'latest_update', 'n_reports')
+            .prefetch_related(self._addresses(), self._contacts())
+        )
+
+    def for_detail(self) -> models.QuerySet:
+        """Pagina della segnalazione: come l'elenco, con la descrizione e le testimonianze."""
         return (
-            super()
-            .get_queryset()
-            .select_related('category', 'evaluation')
-            .prefetch_related('address_set', 'contact_set')
+            self.select_related('category', 'evaluation')
+            .only(*self.card_fields, 'description_html')
+            .prefetch_related(
+                self._addresses(),
+                self._contacts(),
+                Prefetch(
+                    'report_set',
+                    queryset=Report.objects.only(
+                        'entity',
+                        'title',
+                        'body_html',
+                        'date_added',
+                    ).order_by('-date_added'),
+                ),
+            )
+        )
+
+    def for_popup(self) -> models.QuerySet:
+        """Popup degli indirizzi: la categoria viene dalle tabelle di riferimento."""
+        return self.only(
+            'title',
+            'published',
+            'category_id',
+            'description_excerpt',
+            'latest_update',
+            'n_reports',
+        ).prefetch_related(self._contacts())
+
+    def for_export(self) -> models.QuerySet:
+        """Esportazione: tutti i dati modificabili, con indirizzi, contatti e testimonianze."""
+        return (
+            self.only(
+                'title',
+                'description',
+                'published',
+                'category_id',
+                'evaluation_id',
+                'latest_update',
+                'n_reports',
+            )
+            .prefetch_related(
+                Prefetch(
+                    'address_set',
+                    queryset=Address.objects.only(
+                        'entity',
+                        'road',
+                        'number',
+                        'city',
+                        'province',
+                        'latitude',
+                        'longitude',
+                    ).order_by('pk'),
+                ),
+                Prefetch(
+                    'contact_set',
+                    queryset=Contact.objects.only('entity', 'typology', 'contact').order_by('pk'),
+                ),
+                Prefetch(
+                    'report_set',
+                    queryset=Report.objects.only(
+                        'entity',
+                        'title',
+                        'body',
+                        'date_added',
+                    ).order_by('date_added', 'pk'),
+                ),
+            )
+            .order_by('pk')
+        )
+
+    def for_count(self) -> models.QuerySet:
+        """Conteggi e raggruppamenti: solo la chiave primaria, senza ordinamento."""
+        return self.order_by().only('pk')
+
+    def for_admin(self) -> models.QuerySet:
+        """Elenco dell'admin: le colonne di ``list_display``."""
+        return self.select_related('category', 'evaluation').only(
+            'title',
+            'published',
+            'category__name',
+            'evaluation__full_name',
+        )
+
+    def set_published(self, published: bool) -> int:
+        """
+        Pubblica o nasconde le segnalazioni del queryset; restituisce quante sono cambiate.
+
+        Gli aggiornamenti vengono fatti a blocchi di chiavi primarie, ognuno in
+        una transazione breve. Le versioni dei contenuti vengono aggiornate una
+        volta sola alla fine, per tutte le segnalazioni cambiate.
+        """
+        from . import versions
+
+        pks = list(
+            self.exclude(published=published).order_by('pk').values_list('pk', flat=True),
+        )
+        changed = 0
+        for start in range(0, len(pks), self.moderation_chunk_size):
+            chunk = pks[start : start + self.moderation_chunk_size]
+            with transaction.atomic(using=self.db):
+                changed += (
+                    self.model._base_manager.using(self.db)
+                    .filter(pk__in=chunk)
+                    .exclude(published=published)
+                    .update(published=published)
+                )
+        # update() non invia i segnali post_save
+        versions.touch_entities(pks)
+        return changed
+
+
+class EntityManager(models.Manager.from_queryset(EntityQuerySet)):
+    """Un manager per le segnalazioni, con i profili di query di ``EntityQuerySet``."""
+
+    def update_report_stats(self, pks=None) -> int:
+        """
+        Ricalcola data della testimonianza più recente e numero di testimonianze.
+
+        Aggiorna le segnalazioni indicate (tutte se ``pks`` è ``None``) con una
+        sola query; restituisce il numero di segnalazioni aggiornate.
+        """
+        queryset = models.QuerySet(self.model, using=self._db)
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
+        reports = Report.objects.filter(entity=OuterRef('pk')).order_by().values('entity')
+        return queryset.update(
+            latest_update=Subquery(reports.annotate(latest=Max('date_added')).values('latest')),
+            n_reports=Coalesce(Subquery(reports.annotate(n=Count('pk')).values('n')), 0),
         )
 
 
@@ -71,6 +230,10 @@ class Category(models.Model):
     def url(self):
         return reverse('djeography:data', kwargs={'slug': self.slug})
 
+    @property
+    def clusters_url(self):
+        return reverse('djeography:clusters', kwargs={'slug': self.slug})
+
 
 class EvaluationLevel(models.Model):
     """
@@ -123,6 +286,10 @@ class Entity(models.Model):
     )
     title = models.CharField('titolo', max_length=60)
     description = models.TextField('info', null=False, blank=True)
+    # Copie della descrizione generate al salvataggio (vedi richtext.py)
+    description_html = models.TextField('info (HTML ripulito)', blank=True, editable=False)
+    description_text = models.TextField('info (testo)', blank=True, editable=False)
+    description_excerpt = models.TextField('info (estratto)', blank=True, editable=False)
     evaluation = models.ForeignKey(
         EvaluationLevel,
         on_delete=models.RESTRICT,
@@ -131,6 +298,14 @@ class Entity(models.Model):
         blank=True,
     )
     published = models.BooleanField('pubblicata', default=False)
+    # Statistiche delle testimonianze, aggiornate quando le testimonianze cambiano
+    latest_update = models.DateField(
+        'testimonianza più recente',
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    n_reports = models.PositiveIntegerField('testimonianze', default=0, editable=False)
 
     # Model default manager
     objects = EntityManager()
@@ -140,6 +315,13 @@ class Entity(models.Model):
     class Meta:
         verbose_name = 'segnalazione'
         verbose_name_plural = 'segnalazioni'
+        indexes = [
+            # Ordinamento dell'elenco delle segnalazioni
+            models.Index(
+                fields=['published', '-latest_update', 'id'],
+                name='entity_list_order_idx',
+            ),
+        ]
 
     def __str__(self) -> str:
         return f'{self.title} ({self.category})'
@@ -147,6 +329,15 @@ class Entity(models.Model):
     def get_absolute_url(self):
         return reverse('djeography:detail', kwargs={'pk': self.pk})
 
+    def save(self, *args, **kwargs):
+        """Genera HTML ripulito, testo ed estratto della descrizione prima di salvare."""
+        derived = richtext.render_instance(self)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'description' in update_fields:
+            kwargs['update_fields'] = {*update_fields, *derived}
+
+        return super().save(*args, **kwargs)
+
     def publish(self):
         self.published = True
         self.save()
@@ -172,21 +363,62 @@ class Address(models.Model):
     road = models.CharField('via/piazza', max_length=120, null=False, blank=True)
     number = models.CharField('numero civico', max_length=20, null=False, blank=True)
     city = models.CharField('città', max_length=60)
+    # Obbligatoria; nei form può mancare se ci sono i confini per ricavarla: vedi provinces.py
     province = models.CharField(
         'provincia',
         max_length=2,
         choices=app_settings['PROV_CHOICES'],
+        help_text='Se non indicata viene ricavata dalle coordinate, se i confini sono configurati.',
     )
-    coords = PointField()
+    # Può mancare (ad es. negli indirizzi importati): vedi geocoding.py
+    coords = PointField('coordinate', null=True, blank=True)
+    # Copia numerica (indicizzata) di coords, per filtrare per area geografica
+    latitude = models.FloatField('latitudine', null=True, editable=False)
+    longitude = models.FloatField('longitudine', null=True, editable=False)
     entity = models.ForeignKey(Entity, on_delete=models.CASCADE)
 
     class Meta:
         verbose_name = 'indirizzo'
         verbose_name_plural = 'indirizzi'
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='address_lat_lng_idx'),
+        ]
 
     def __str__(self) -> str:
         return f'{self.road}, {self.number} {self.city} ({self.province})'
 
+    def clean_fields(self, exclude=None):
+        # La provincia mancante viene ricavata prima del controllo dei campi obbligatori
+        if not self.province:
+            self.province = provinces.province_of(self.coords) or ''
+        super().clean_fields(exclude)
+
+    def clean(self):
+        # Il form dell'admin non richiede la provincia se ci sono i confini
+        if not self.province:
+            self.province = provinces.province_of(self.coords) or ''
+            if not self.province:
+                raise ValidationError({'province': 'Indica la provincia.'})
+
+    def save(self, *args, **kwargs):
+        """
+        Allinea latitudine e longitudine a coords e ricava la provincia mancante.
+
+        Solleva ``ValueError`` se la provincia manca e non si può ricavare.
+        """
+        self.latitude, self.longitude = coords_to_lat_lng(self.coords)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'coords' in update_fields:
+            update_fields = kwargs['update_fields'] = {*update_fields, 'latitude', 'longitude'}
+        if not self.province:
+            self.province = provinces.province_of(self.coords) or ''
+            if self.province and update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'province'}
+            elif not self.province and (update_fields is None or 'province' in update_fields):
+                raise ValueError(f'Address {self} has no province and none can be derived.')
+
+        return super().save(*args, **kwargs)
+
     @property
     def popupUrl(self):
         return reverse('djeography:popup', kwargs={'pk': self.pk})
@@ -214,6 +446,67 @@ class Contact(models.Model):
         return str(self.contact)
 
 
+class ReportQuerySet(models.QuerySet):
+    """
+    Aggiorna le statistiche delle segnalazioni anche nelle operazioni di massa.
+
+    ``bulk_create``, ``bulk_update`` e ``update`` non inviano i segnali dei
+    modelli; ``delete`` li invia per ogni testimonianza eliminata.
+    """
+
+    # Campi da cui dipendono le statistiche
+    stats_fields = {'entity', 'entity_id', 'date_added'}
+
+    def _report_stats_changed(self, entity_ids):
+        from . import search, versions
+
+        entity_ids = set(entity_ids)
+        if entity_ids:
+            Entity.objects.update_report_stats(entity_ids)
+            versions.touch_entities(entity_ids)
+            search.update_documents(entity_ids)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        # save() non viene chiamato: le copie del testo vanno generate qui
+        for obj in objs:
+            richtext.render_instance(obj)
+        objs = super().bulk_create(objs, *args, **kwargs)
+        self._report_stats_changed(obj.entity_id for obj in objs)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        if 'body' in fields:
+            for obj in objs:
+                richtext.render_instance(obj)
+            fields = list(dict.fromkeys([*fields, *richtext.derived_fields('body')]))
+        if self.stats_fields.isdisjoint(fields):
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        # Le testimonianze spostate cambiano anche la segnalazione di partenza
+        previous = self.filter(pk__in=[obj.pk for obj in objs]).values_list(
+            'entity_id',
+            flat=True,
+        )
+        entity_ids = {*previous, *(obj.entity_id for obj in objs)}
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        self._report_stats_changed(entity_ids)
+        return rows
+
+    def update(self, **kwargs):
+        if isinstance(kwargs.get('body'), str):
+            kwargs.update(zip(richtext.derived_fields('body'), richtext.render(kwargs['body'])))
+        if self.stats_fields.isdisjoint(kwargs):
+            return super().update(**kwargs)
+        entity_ids = set(self.values_list('entity_id', flat=True))
+        entity = kwargs.get('entity', kwargs.get('entity_id'))
+        if entity is not None:
+            entity_ids.add(getattr(entity, 'pk', entity))
+        rows = super().update(**kwargs)
+        self._report_stats_changed(entity_ids)
+        return rows
+
+
 class Report(models.Model):
     """
     Modella le testimonianze (ogni segnalazione può avere 0, N testimonanze).
@@ -224,8 +517,14 @@ class Report(models.Model):
     entity = models.ForeignKey(Entity, on_delete=models.CASCADE)
     title = models.CharField('titolo', max_length=100, null=False)
     body = models.TextField('testo', null=False, blank=True)
+    # Copie del testo generate al salvataggio (vedi richtext.py)
+    body_html = models.TextField('testo (HTML ripulito)', blank=True, editable=False)
+    body_text = models.TextField('testo (solo testo)', blank=True, editable=False)
+    body_excerpt = models.TextField('testo (estratto)', blank=True, editable=False)
     date_added = models.DateField('data', default=timezone.now)
 
+    objects = ReportQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'testimonianza'
         verbose_name_plural = 'testimonianze'
@@ -233,3 +532,106 @@ class Report(models.Model):
 
     def __str__(self):
         return self.title
+
+    def save(self, *args, **kwargs):
+        """Genera HTML ripulito, testo ed estratto prima di salvare."""
+        derived = richtext.render_instance(self)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'body' in update_fields:
+            kwargs['update_fields'] = {*update_fields, *derived}
+
+        return super().save(*args, **kwargs)
+
+
+class SearchDocument(models.Model):
+    """
+    Testo di una segnalazione su cui viene svolta la ricerca.
+
+    I campi contengono il testo già normalizzato (vedi ``search.py``) e vengono
+    aggiornati dai segnali quando la segnalazione, i suoi indirizzi o le sue
+    testimonianze cambiano.
+    """
+
+    entity = models.OneToOneField(
+        Entity,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+    )
+    title = models.TextField('titolo')
+    # Città e vie degli indirizzi
+    place = models.TextField('luoghi')
+    # Descrizione e testimonianze
+    body = models.TextField('testo')
+
+    class Meta:
+        verbose_name = 'documento di ricerca'
+        verbose_name_plural = 'documenti di ricerca'
+
+
+class GeocodeResult(models.Model):
+    """
+    Coordinate trovate per un indirizzo, salvate per non ripetere le chiamate al servizio.
+
+    ``query`` è l'indirizzo normalizzato (vedi ``geocoding.py``); latitudine e
+    longitudine sono vuote se l'indirizzo non è stato trovato.
+    """
+
+    backend = models.CharField('servizio', max_length=100)
+    query = models.CharField('indirizzo', max_length=255)
+    latitude = models.FloatField('latitudine', null=True)
+    longitude = models.FloatField('longitudine', null=True)
+    created = models.DateTimeField('data', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'coordinate trovate'
+        verbose_name_plural = 'coordinate trovate'
+        constraints = [
+            models.UniqueConstraint(fields=['backend', 'query'], name='geocode_result_unique'),
+        ]
+
+    def __str__(self) -> str:
+        return self.query
+
+
+class SQLiteSearchIndex(models.Model):
+    """Tabella FTS5 dei documenti di ricerca, creata dalle migrazioni solo su SQLite."""
+
+    entity = models.OneToOneField(
+        Entity,
+        on_delete=models.DO_NOTHING,
+        primary_key=True,
+        db_column='rowid',
+        related_name='search_index_sqlite',
+    )
+    # Colonna nascosta di FTS5 con il nome della tabella, usata per MATCH
+    match = SearchField(db_column=SQLITE_TABLE)
+    # Colonna nascosta di FTS5 con il punteggio bm25
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = SQLITE_TABLE
+
+
+class PostgreSQLSearchIndex(models.Model):
+    """
+    Tabella dei documenti di ricerca vista con la colonna tsvector.
+
+    La colonna viene aggiunta dalle migrazioni solo su PostgreSQL.
+    """
+
+    entity = models.OneToOneField(
+        Entity,
+        on_delete=models.DO_NOTHING,
+        primary_key=True,
+        related_name='search_index_postgresql',
+    )
+    title = SearchField()
+    place = SearchField()
+    vector = SearchField()
+
+    class Meta:
+        managed = False
+        db_table = 'djeography_searchdocument'
+
@@ -0,0 +1,122 @@
+"""
+Codifica di tile vettoriali in formato Mapbox Vector Tile (MVT).
+
+Implementa in puro Python la piccola parte della specifica che serve per
+i punti (https://github.com/mapbox/vector-tile-spec/tree/master/2.1),
+senza dipendere da GDAL, PostGIS o da una libreria protobuf.
+"""
+
+import struct
+from collections.abc import Iterable
+from typing import Any
+
+from . import geo
+
+EXTENT = 4096
+
+# Tipi dei campi protobuf
+VARINT = 0
+LENGTH_DELIMITED = 2
+
+# Comandi e tipi di geometria MVT
+MOVE_TO = 1
+POINT = 1
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field: int, payload: bytes) -> bytes:
+    return _key(field, LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _varint_field(field: int, value: int) -> bytes:
+    return _key(field, VARINT) + _varint(value)
+
+
+def _packed_field(field: int, values: Iterable[int]) -> bytes:
+    return _bytes_field(field, b''.join(_varint(value) for value in values))
+
+
+def _value(value: Any) -> bytes:
+    """Codifica un messaggio ``Value``: stringa, booleano, intero o double."""
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _bytes_field(1, str(value).encode())
+
+
+class Layer:
+    """
+    Un layer di una tile, costruito aggiungendo un punto alla volta.
+
+    Chiavi e valori delle proprietà sono condivisi tra le feature, come
+    prevede la specifica.
+    """
+
+    def __init__(self, name: str, z: int, x: int, y: int, extent: int = EXTENT):
+        self.name = name
+        self.z, self.x, self.y = z, x, y
+        self.extent = extent
+        self.keys: dict[str, int] = {}
+        self.values: dict[tuple[type, Any], int] = {}
+        self.features: list[bytes] = []
+
+    def _tag(self, key: str, value: Any) -> tuple[int, int]:
+        key_index = self.keys.setdefault(key, len(self.keys))
+        # Il tipo fa parte della chiave: True e 1 sono valori diversi
+        value_index = self.values.setdefault((type(value), value), len(self.values))
+        return key_index, value_index
+
+    def add_point(self, lng: float, lat: float, properties: dict[str, Any], id=None):
+        """Aggiunge un punto; le proprietà con valore ``None`` vengono omesse."""
+        px = round((geo.lng_to_tile_x(lng, self.z) - self.x) * self.extent)
+        py = round((geo.lat_to_tile_y(lat, self.z) - self.y) * self.extent)
+        tags = [
+            index
+            for key, value in properties.items()
+            if value is not None
+            for index in self._tag(key, value)
+        ]
+        feature = b''
+        if id is not None:
+            feature += _varint_field(1, id)
+        if tags:
+            feature += _packed_field(2, tags)
+        feature += _varint_field(3, POINT)
+        feature += _packed_field(4, ((1 << 3) | MOVE_TO, _zigzag(px), _zigzag(py)))
+        self.features.append(feature)
+
+    def encode(self) -> bytes:
+        return b''.join(
+            (
+                _varint_field(15, 2),
+                _bytes_field(1, self.name.encode()),
+                *(_bytes_field(2, feature) for feature in self.features),
+                *(_bytes_field(3, key.encode()) for key in self.keys),
+                *(_bytes_field(4, _value(value)) for _, value in self.values),
+                _varint_field(5, self.extent),
+            ),
+        )
+
+
+def encode_tile(layers: Iterable[Layer]) -> bytes:
+    """Codifica una tile; i layer vuoti vengono omessi."""
+    return b''.join(_bytes_field(3, layer.encode()) for layer in layers if layer.features)
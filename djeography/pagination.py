@@ -0,0 +1,182 @@
+"""
+Paginazione a cursore (keyset) dell'elenco delle segnalazioni.
+
+Contiene anche un paginator con conteggio stimato per l'elenco dell'admin.
+
+Invece del numero di pagina, i link portano un cursore opaco con la chiave
+di ordinamento ``(published, latest_update, id)`` dell'ultima segnalazione
+mostrata (o della prima, per tornare indietro): la pagina successiva è
+"le segnalazioni che vengono dopo questa chiave", una ricerca sull'indice
+invece di un OFFSET, e non serve contare le segnalazioni: il totale mostrato
+viene dai conteggi dei filtri, già in cache (vedi ``facets.total``).
+"""
+
+import base64
+import binascii
+import datetime
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Q, QuerySet
+from django.utils.functional import cached_property
+
+# Ordinamento dell'elenco e ordinamento inverso, per le pagine precedenti
+ORDERING = ('published', F('latest_update').desc(nulls_last=True), 'id')
+REVERSE_ORDERING = ('-published', F('latest_update').asc(nulls_first=True), '-id')
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(direction: str, entity) -> str:
+    latest_update = entity.latest_update.isoformat() if entity.latest_update else None
+    key = [direction, entity.published, latest_update, entity.pk]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[str, bool, datetime.date | None, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, published, latest_update, pk = json.loads(raw)
+        if direction not in ('next', 'previous'):
+            raise ValueError(direction)
+        if latest_update is not None:
+            latest_update = datetime.date.fromisoformat(latest_update)
+        return direction, bool(published), latest_update, int(pk)
+    except (binascii.Error, TypeError, ValueError) as err:
+        raise InvalidCursor(cursor) from err
+
+
+def after(published: bool, latest_update: datetime.date | None, pk: int) -> Q:
+    """Segnalazioni che nell'ordinamento dell'elenco vengono dopo la chiave data."""
+    same = Q(published=published)
+    if latest_update is None:
+        # Le segnalazioni senza testimonianze sono in fondo
+        following = Q(latest_update__isnull=True, pk__gt=pk)
+    else:
+        following = (
+            Q(latest_update__lt=latest_update)
+            | Q(latest_update__isnull=True)
+            | Q(latest_update=latest_update, pk__gt=pk)
+        )
+    return Q(published__gt=published) | (same & following)
+
+
+def before(published: bool, latest_update: datetime.date | None, pk: int) -> Q:
+    """Segnalazioni che nell'ordinamento dell'elenco vengono prima della chiave data."""
+    same = Q(published=published)
+    if latest_update is None:
+        preceding = Q(latest_update__isnull=False) | Q(latest_update__isnull=True, pk__lt=pk)
+    else:
+        preceding = Q(latest_update__gt=latest_update) | Q(latest_update=latest_update, pk__lt=pk)
+    return Q(published__lt=published) | (same & preceding)
+
+
+class CursorPage:
+    """Una pagina di segnalazioni, con i cursori per la pagina precedente e la successiva."""
+
+    def __init__(self, object_list: list, has_previous: bool, has_next: bool):
+        self.object_list = object_list
+        self.previous_cursor = (
+            encode_cursor('previous', object_list[0]) if has_previous and object_list else None
+        )
+        self.next_cursor = (
+            encode_cursor('next', object_list[-1]) if has_next and object_list else None
+        )
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_other_pages(self) -> bool:
+        return self.has_previous() or self.has_next()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self) -> int:
+        return len(self.object_list)
+
+
+class CursorPaginator:
+    """
+    Divide in pagine un queryset di segnalazioni senza OFFSET e senza COUNT.
+
+    Il queryset viene ordinato come l'elenco (``ORDERING``); per ogni pagina
+    viene letta una segnalazione in più per sapere se ce n'è un'altra.
+    """
+
+    def __init__(self, queryset: QuerySet, per_page: int, count: int | None = None):
+        self.queryset = queryset
+        self.per_page = per_page
+        # Numero di segnalazioni, se è noto senza contarle
+        self.count = count
+
+    def page(self, cursor: str | None) -> CursorPage:
+        if not cursor:
+            entities = list(self.queryset.order_by(*ORDERING)[: self.per_page + 1])
+            return CursorPage(entities[: self.per_page], False, len(entities) > self.per_page)
+
+        direction, *key = decode_cursor(cursor)
+        if direction == 'next':
+            entities = list(
+                self.queryset.filter(after(*key)).order_by(*ORDERING)[: self.per_page + 1],
+            )
+            return CursorPage(entities[: self.per_page], True, len(entities) > self.per_page)
+
+        entities = list(
+            self.queryset.filter(before(*key)).order_by(*REVERSE_ORDERING)[: self.per_page + 1],
+        )
+        more = len(entities) > self.per_page
+        return CursorPage(entities[: self.per_page][::-1], more, True)
+
+
+def estimated_count(queryset: QuerySet) -> int | None:
+    """
+    Numero di righe della tabella stimato dal database, senza COUNT.
+
+    Solo per queryset senza filtri; ``None`` se il database non ha una stima
+    (su SQLite serve ``ANALYZE``, su PostgreSQL ``VACUUM`` o ``ANALYZE``).
+    """
+    query = queryset.query
+    if query.where or query.distinct or query.is_sliced:
+        return None
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [table])
+        elif (
+            connection.vendor == 'sqlite'
+            and 'sqlite_stat1' in connection.introspection.table_names(cursor)
+        ):
+            # La prima cifra delle statistiche di ogni indice è il numero di righe
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    estimate = int(float(str(row[0]).split()[0]))
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator che per le tabelle grandi non filtrate usa il numero di righe stimato.
+
+    Sotto ``threshold`` righe, o con dei filtri, il conteggio resta esatto.
+    """
+
+    threshold = 10000
+
+    @cached_property
+    def count(self) -> int:
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate > self.threshold:
+            return estimate
+        return super().count
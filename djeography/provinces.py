@@ -0,0 +1,191 @@
+"""
+Provincia di un punto, dai confini delle province.
+
+I confini vengono letti dal file GeoJSON indicato in
+``DJEOGRAPHY_CONFIG['PROVINCE_BOUNDARIES']``: una FeatureCollection di
+Polygon o MultiPolygon con la sigla della provincia nella proprietà
+``province`` (o ``prov_acr`` o ``sigla``, come nei file di ISTAT e openpolis).
+
+Senza file la provincia non viene ricavata né controllata: l'indirizzo deve
+indicarla. Il pacchetto non include i confini: i file di ISTAT o di openpolis
+(semplificati, per l'indice bastano poche migliaia di vertici per provincia)
+vanno scaricati a parte.
+
+L'indice divide il territorio in una griglia di celle quadrate:
+
+- i lati dei poligoni sono raggruppati per riga della griglia (una fascia di
+  latitudine), insieme al limite est di ogni provincia nella fascia: un punto
+  viene confrontato solo con le province il cui confine passa alla sua
+  destra, contando gli attraversamenti con i lati della fascia (ray casting);
+- le celle non attraversate da alcun lato appartengono a una sola provincia
+  (o a nessuna): viene cercata una volta, per il centro della cella, e
+  riusata per tutti i punti della cella.
+"""
+
+import json
+import math
+import threading
+from collections.abc import Iterable, Iterator
+
+from djeography import app_settings
+
+from .geo import coords_to_lat_lng
+
+# Lato delle celle della griglia, in gradi
+CELL_SIZE = 0.05
+# Proprietà delle feature con la sigla della provincia
+PROVINCE_PROPERTIES = ('province', 'prov_acr', 'sigla')
+
+# Anello di un poligono: vertici (longitudine, latitudine)
+Ring = list[tuple[float, float]]
+
+
+class ProvinceIndex:
+    """
+    Indice dei confini: ``boundaries`` sono coppie (sigla, anello).
+
+    Gli anelli di una provincia (parti e buchi) vengono contati insieme, con
+    la regola pari-dispari: non devono sovrapporsi.
+    """
+
+    def __init__(self, boundaries: Iterable[tuple[str, Ring]], cell_size: float = CELL_SIZE):
+        rings = [(province, ring) for province, ring in boundaries if len(ring) >= 3]
+        if not rings:
+            raise ValueError('No province boundaries.')
+        self.cell_size = cell_size
+        self.west = min(lng for _, ring in rings for lng, _ in ring)
+        self.east = max(lng for _, ring in rings for lng, _ in ring)
+        self.south = min(lat for _, ring in rings for _, lat in ring)
+        self.north = max(lat for _, ring in rings for _, lat in ring)
+        self.rows = int((self.north - self.south) / cell_size) + 1
+        self.columns = int((self.east - self.west) / cell_size) + 1
+        # Celle attraversate da almeno un lato
+        self.boundary_cells: set[int] = set()
+        # Provincia delle altre celle, calcolata alla prima richiesta
+        self.interior: dict[int, str | None] = {}
+
+        bands: list[dict[str, list]] = [{} for _ in range(self.rows)]
+        for province, ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                for row in range(self._row(min(y1, y2)), self._row(max(y1, y2)) + 1):
+                    # Tratto del lato nella fascia: segna le celle che attraversa
+                    if y1 == y2:
+                        left, right = min(x1, x2), max(x1, x2)
+                    else:
+                        slope = (x2 - x1) / (y2 - y1)
+                        bottom = max(min(y1, y2), self.south + row * cell_size)
+                        top = min(max(y1, y2), self.south + (row + 1) * cell_size)
+                        xa, xb = x1 + (bottom - y1) * slope, x1 + (top - y1) * slope
+                        left, right = min(xa, xb), max(xa, xb)
+                        # Un raggio orizzontale non attraversa mai i lati orizzontali
+                        band = bands[row].setdefault(province, [-math.inf, []])
+                        band[0] = max(band[0], x1, x2)
+                        band[1].append((min(y1, y2), max(y1, y2), x1, y1, slope))
+                    first = row * self.columns
+                    self.boundary_cells.update(
+                        range(first + self._column(left), first + self._column(right) + 1),
+                    )
+        # Per ogni fascia: (sigla, limite est, lati)
+        self.bands = [
+            [(province, east, tuple(edges)) for province, (east, edges) in band.items()]
+            for band in bands
+        ]
+
+    def _row(self, lat: float) -> int:
+        return min(max(int((lat - self.south) / self.cell_size), 0), self.rows - 1)
+
+    def _column(self, lng: float) -> int:
+        return min(max(int((lng - self.west) / self.cell_size), 0), self.columns - 1)
+
+    def _ray_cast(self, row: int, lat: float, lng: float) -> str | None:
+        for province, east, edges in self.bands[row]:
+            if lng >= east:
+                # Nessun lato della provincia alla destra del punto
+                continue
+            inside = False
+            for low, high, x1, y1, slope in edges:
+                if low <= lat < high and lng < x1 + (lat - y1) * slope:
+                    inside = not inside
+            if inside:
+                return province
+        return None
+
+    def locate(self, lat: float, lng: float) -> str | None:
+        """Sigla della provincia che contiene il punto, ``None`` se è fuori dai confini."""
+        if not (self.south <= lat <= self.north and self.west <= lng <= self.east):
+            return None
+        row = self._row(lat)
+        column = self._column(lng)
+        cell = row * self.columns + column
+        if cell in self.boundary_cells:
+            return self._ray_cast(row, lat, lng)
+        try:
+            return self.interior[cell]
+        except KeyError:
+            province = self._ray_cast(
+                row,
+                self.south + (row + 0.5) * self.cell_size,
+                self.west + (column + 0.5) * self.cell_size,
+            )
+            self.interior[cell] = province
+            return province
+
+
+def read_geojson(path) -> Iterator[tuple[str, Ring]]:
+    """Anelli dei poligoni di una FeatureCollection, con la sigla della provincia."""
+    with open(path, encoding='utf-8') as file:
+        data = json.load(file)
+    for feature in data.get('features', ()):
+        properties = {
+            str(key).lower(): value for key, value in (feature.get('properties') or {}).items()
+        }
+        province = next(
+            (properties[name] for name in PROVINCE_PROPERTIES if properties.get(name)),
+            None,
+        )
+        if province is None:
+            raise ValueError(f'Feature without a province code: {properties!r}')
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            raise ValueError(f'Unsupported geometry for {province}: {geometry.get("type")}')
+        for polygon in polygons:
+            for ring in polygon:
+                yield str(province).upper(), [(float(point[0]), float(point[1])) for point in ring]
+
+
+# File dei confini e indice costruito dal file
+_index: tuple[object, ProvinceIndex] | None = None
+_lock = threading.Lock()
+
+
+def get() -> ProvinceIndex | None:
+    """L'indice dei confini, costruito alla prima richiesta; ``None`` senza file dei confini."""
+    global _index
+    path = app_settings['PROVINCE_BOUNDARIES']
+    if not path:
+        return None
+    entry = _index
+    if entry is not None and entry[0] == path:
+        return entry[1]
+    with _lock:
+        if _index is None or _index[0] != path:
+            _index = (path, ProvinceIndex(read_geojson(path)))
+        return _index[1]
+
+
+def province_of(coords) -> str | None:
+    """
+    Sigla della provincia di un punto GeoJSON.
+
+    ``None`` se mancano le coordinate o il file dei confini, o se il punto è
+    fuori dai confini.
+    """
+    lat, lng = coords_to_lat_lng(coords) if coords else (None, None)
+    index = get()
+    if lat is None or index is None:
+        return None
+    return index.locate(lat, lng)
@@ -0,0 +1,72 @@
+"""
+Tabelle di riferimento: categorie, livelli di valutazione e province.
+
+Cambiano di rado ma servono a quasi ogni pagina: vengono lette una volta e
+tenute in memoria nel processo, insieme alla versione globale (vedi
+``versions.py``) da cui sono state lette. I segnali aggiornano la versione
+globale quando categorie o livelli di valutazione cambiano, così anche gli
+altri processi rileggono le tabelle alla richiesta successiva.
+"""
+
+import threading
+from dataclasses import dataclass
+
+from django.urls import reverse
+
+from djeography import app_settings
+
+from . import versions
+
+
+@dataclass(frozen=True)
+class ReferenceData:
+    # slug -> categoria
+    categories: dict
+    # id -> categoria
+    categories_by_pk: dict
+    # Dati delle categorie per la mappa, con gli URL già risolti
+    map_categories: list[dict]
+    # short_name -> livello di valutazione
+    evaluations: dict
+    # sigla -> nome della provincia
+    provinces: dict[str, str]
+
+
+def load() -> ReferenceData:
+    from .models import Category, EvaluationLevel
+
+    categories = list(Category.objects.all())
+    return ReferenceData(
+        categories={cat.slug: cat for cat in categories},
+        categories_by_pk={cat.pk: cat for cat in categories},
+        map_categories=[
+            {
+                'name': cat.name,
+                'slug': cat.slug,
+                'icon': cat.icon,
+                'url': reverse('djeography:data', kwargs={'slug': cat.slug}),
+                'clusters_url': reverse('djeography:clusters', kwargs={'slug': cat.slug}),
+            }
+            for cat in categories
+        ],
+        evaluations={level.short_name: level for level in EvaluationLevel.objects.all()},
+        provinces=dict(app_settings['PROV_CHOICES']),
+    )
+
+
+_data: tuple[float, ReferenceData] | None = None
+_lock = threading.Lock()
+
+
+def get() -> ReferenceData:
+    """Restituisce le tabelle di riferimento, rileggendole se la versione globale è cambiata."""
+    global _data
+    # La versione va letta prima delle tabelle: una modifica successiva la cambia di nuovo
+    version = versions.get_versions()[0]
+    entry = _data
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with _lock:
+        if _data is None or _data[0] != version:
+            _data = (version, load())
+        return _data[1]
@@ -0,0 +1,179 @@
+"""
+Testi formattati (TinyMCE) elaborati al salvataggio.
+
+Descrizioni e testimonianze vengono salvate così come arrivano dall'editor,
+e insieme a tre copie derivate: l'HTML ripulito (solo tag e attributi
+ammessi), il testo semplice e un breve estratto. I template usano le copie
+derivate, così il lavoro viene fatto una volta sola e non a ogni pagina.
+"""
+
+import re
+from collections.abc import Iterable
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from django.apps import apps as global_apps
+
+from djeography import app_settings
+
+# Tag ammessi nell'HTML ripulito, con i rispettivi attributi
+ALLOWED_TAGS = {
+    'a': {'href', 'title', 'target'},
+    'b': set(),
+    'blockquote': set(),
+    'br': set(),
+    'em': set(),
+    'h1': set(),
+    'h2': set(),
+    'h3': set(),
+    'h4': set(),
+    'h5': set(),
+    'h6': set(),
+    'hr': set(),
+    'i': set(),
+    'li': set(),
+    'ol': set(),
+    'p': set(),
+    's': set(),
+    'span': set(),
+    'strong': set(),
+    'sub': set(),
+    'sup': set(),
+    'u': set(),
+    'ul': set(),
+}
+VOID_TAGS = {'br', 'hr'}
+# Tag che separano il testo: nel testo semplice diventano uno spazio
+BLOCK_TAGS = set('blockquote br div h1 h2 h3 h4 h5 h6 hr li ol p table td th tr ul'.split())
+# Tag il cui contenuto viene scartato
+DROPPED_TAGS = {'script', 'style', 'template', 'iframe', 'object'}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto', 'tel'}
+
+# Campo formattato di ogni modello e prefisso delle copie derivate
+FIELDS = {
+    'Entity': 'description',
+    'Report': 'body',
+}
+# Righe elaborate per ogni blocco durante l'aggiornamento delle copie derivate
+CHUNK_SIZE = 500
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class _Cleaner(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.html: list[str] = []
+        self.text: list[str] = []
+        self.open: list[str] = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append(' ')
+        if tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_TAGS[tag]
+        rendered = []
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name == 'href' and urlsplit(value.strip()).scheme.lower() not in ALLOWED_SCHEMES:
+                continue
+            rendered.append(f' {name}="{escape(value)}"')
+        if tag == 'a' and any(name == 'target' for name, _ in attrs):
+            # La pagina aperta non deve poter controllare quella di partenza
+            rendered.append(' rel="noopener noreferrer"')
+        self.html.append(f'<{tag}{"".join(rendered)}>')
+        if tag not in VOID_TAGS:
+            self.open.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append(' ')
+        if tag not in self.open:
+            return
+        # Chiude anche i tag rimasti aperti all'interno
+        while self.open:
+            current = self.open.pop()
+            self.html.append(f'</{current}>')
+            if current == tag:
+                break
+
+    def handle_data(self, data):
+        if self.dropping:
+            return
+        self.html.append(escape(data, quote=False))
+        self.text.append(data)
+
+    def close(self):
+        super().close()
+        while self.open:
+            self.html.append(f'</{self.open.pop()}>')
+
+
+def render(html: str, excerpt_length: int | None = None) -> tuple[str, str, str]:
+    """Restituisce HTML ripulito, testo semplice ed estratto di un testo formattato."""
+    if excerpt_length is None:
+        excerpt_length = app_settings['EXCERPT_LENGTH']
+    cleaner = _Cleaner()
+    cleaner.feed(html or '')
+    cleaner.close()
+    text = _WHITESPACE.sub(' ', ''.join(cleaner.text)).strip()
+    return ''.join(cleaner.html).strip(), text, excerpt(text, excerpt_length)
+
+
+def excerpt(text: str, length: int) -> str:
+    """Tronca il testo all'ultima parola intera entro ``length`` caratteri."""
+    if len(text) <= length:
+        return text
+    cut = text[: length - 1]
+    if ' ' in cut and not text[length - 1].isspace():
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip(' ,.;:') + '…'
+
+
+def derived_fields(field: str) -> list[str]:
+    return [f'{field}_html', f'{field}_text', f'{field}_excerpt']
+
+
+def render_instance(instance) -> list[str]:
+    """Aggiorna le copie derivate del testo formattato e ne restituisce i nomi."""
+    field = FIELDS[instance._meta.object_name]
+    names = derived_fields(field)
+    for name, value in zip(names, render(getattr(instance, field))):
+        setattr(instance, name, value)
+    return names
+
+
+def render_all(model_names: Iterable[str] = FIELDS, apps=global_apps) -> int:
+    """
+    Rigenera le copie derivate di tutte le righe, a blocchi; restituisce il numero di righe.
+
+    ``apps`` permette di usare la funzione anche nelle migrazioni.
+    """
+    updated = 0
+    for model_name in model_names:
+        model = apps.get_model('djeography', model_name)
+        field = FIELDS[model_name]
+        pks = list(model._base_manager.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[start : start + CHUNK_SIZE]
+            objs = list(model._base_manager.filter(pk__in=chunk).only('pk', field))
+            for obj in objs:
+                for name, value in zip(derived_fields(field), render(getattr(obj, field))):
+                    setattr(obj, name, value)
+            model._base_manager.bulk_update(objs, derived_fields(field))
+            updated += len(objs)
+    return updated
@@ -0,0 +1,440 @@
+"""
+Ricerca testuale delle segnalazioni.
+
+Per ogni segnalazione viene mantenuto un documento di ricerca (``SearchDocument``)
+con titolo, luoghi (città e vie degli indirizzi) e testo (descrizione e
+testimonianze), già normalizzati: senza HTML, senza accenti e in minuscolo.
+I documenti vengono aggiornati dai segnali quando i dati cambiano.
+
+La ricerca vera e propria è affidata a un backend, scelto in base al database:
+
+- SQLite: tabella FTS5 collegata ai documenti, ordinata con bm25;
+- PostgreSQL: colonna ``tsvector`` indicizzata con GIN, più la somiglianza
+  per trigrammi se l'estensione ``pg_trgm`` è installata;
+- altri database: indice invertito in memoria, ricostruito quando i documenti cambiano.
+
+Con SQLite e con l'indice in memoria, una parola che non è l'inizio di
+nessuna parola dei documenti viene sostituita dalle parole dei documenti
+scritte in modo simile (``Vocabulary.similar``): al più una lettera diversa,
+due per le parole lunghe.
+
+Con ``DJEOGRAPHY_CONFIG['SEARCH_BACKEND']`` si può indicare il percorso di un
+backend diverso. Un backend restituisce il queryset filtrato e annotato con
+``search_rank`` (più alto = più pertinente).
+"""
+
+import re
+import threading
+import unicodedata
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+
+from django.apps import apps as global_apps
+from django.db import NotSupportedError, connection, models, router, transaction
+from django.db.models import Case, F, FloatField, Func, Lookup, Q, Value, When
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+
+from djeography import app_settings
+
+from . import versions
+
+# Segnalazioni elaborate per ogni blocco durante l'aggiornamento dei documenti
+CHUNK_SIZE = 500
+
+SQLITE_TABLE = 'djeography_searchdocument_fts'
+
+# Peso di titolo, luoghi e testo nel calcolo della pertinenza
+WEIGHTS = (10.0, 5.0, 1.0)
+
+# Lunghezza minima delle parole cercate anche con errori di battitura, e
+# lunghezza da cui sono ammesse due lettere sbagliate invece di una
+FUZZY_MIN_LENGTH = 4
+FUZZY_LONG_LENGTH = 8
+
+_TOKEN = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    """Rimuove HTML e accenti e converte in minuscolo: "Città" diventa "citta"."""
+    text = unicodedata.normalize('NFKD', strip_tags(text or ''))
+    return ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(normalize(text))
+
+
+class SearchField(models.TextField):
+    """Colonna di un indice di ricerca, su cui si possono usare i lookup ``match`` e ``similar``."""
+
+
+@SearchField.register_lookup
+class Match(Lookup):
+    """Corrispondenza con l'indice full-text (FTS5 o tsvector)."""
+
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError(f'Full-text search is not supported on {connection.vendor}.')
+
+    def as_sqlite(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', [*lhs_params, *rhs_params]
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} @@ to_tsquery('simple', {rhs})", [*lhs_params, *rhs_params]
+
+
+@SearchField.register_lookup
+class Similar(Lookup):
+    """Somiglianza per trigrammi con una delle parole della colonna (``pg_trgm``)."""
+
+    lookup_name = 'similar'
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError(f'Trigram search is not supported on {connection.vendor}.')
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{rhs} <%% {lhs}', [*rhs_params, *lhs_params]
+
+
+def _trigrams(word: str) -> list[str]:
+    # Come pg_trgm: due spazi prima della parola e uno dopo
+    padded = f'  {word} '
+    return [padded[i : i + 3] for i in range(len(padded) - 2)]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Distanza di Levenshtein tra ``a`` e ``b``; ``limit + 1`` se è maggiore di ``limit``."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)),
+            )
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class Vocabulary:
+    """Parole dei documenti, ordinate e indicizzate per trigrammi."""
+
+    def __init__(self, words: Iterable[str]):
+        self.words = sorted(set(words))
+        trigrams: dict[str, list[int]] = defaultdict(list)
+        for i, word in enumerate(self.words):
+            for trigram in set(_trigrams(word)):
+                trigrams[trigram].append(i)
+        self.trigrams = dict(trigrams)
+
+    def completions(self, prefix: str) -> list[str]:
+        """Parole che iniziano con ``prefix``."""
+        words = []
+        # Le parole che iniziano con prefix sono consecutive nella lista ordinata
+        for i in range(bisect_left(self.words, prefix), len(self.words)):
+            if not self.words[i].startswith(prefix):
+                break
+            words.append(self.words[i])
+        return words
+
+    def similar(self, token: str) -> list[str]:
+        """Parole che differiscono da ``token`` per una lettera (due per le parole lunghe)."""
+        if len(token) < FUZZY_MIN_LENGTH:
+            return []
+        limit = 1 if len(token) < FUZZY_LONG_LENGTH else 2
+        trigrams = set(_trigrams(token))
+        shared = Counter(i for trigram in trigrams for i in self.trigrams.get(trigram, ()))
+        # Ogni lettera sbagliata cambia al più tre trigrammi
+        needed = len(trigrams) - 3 * limit
+        return [
+            self.words[i]
+            for i, count in shared.items()
+            if count >= needed and edit_distance(token, self.words[i], limit) <= limit
+        ]
+
+
+class SearchBackend(ABC):
+    @abstractmethod
+    def search(self, queryset: models.QuerySet, text: str) -> models.QuerySet:
+        """Filtra il queryset delle segnalazioni e lo annota con ``search_rank``."""
+
+    def empty(self, queryset: models.QuerySet) -> models.QuerySet:
+        return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    def rebuild(self) -> None:
+        """Ricostruisce l'indice dopo che tutti i documenti sono stati rigenerati."""
+
+
+class SQLiteBackend(SearchBackend):
+    """
+    Tabella virtuale FTS5, aggiornata da trigger sulla tabella dei documenti.
+
+    Le parole dei documenti per le ricerche con errori di battitura vengono
+    lette solo quando servono, una volta per ogni versione dei documenti.
+    """
+
+    def __init__(self):
+        self.vocabulary: tuple[float, Vocabulary] | None = None
+        self.lock = threading.Lock()
+
+    def get_vocabulary(self) -> Vocabulary:
+        version = versions.get_versions(versions.SEARCH_SCOPE)[-1]
+        if self.vocabulary is None or self.vocabulary[0] != version:
+            with self.lock:
+                if self.vocabulary is None or self.vocabulary[0] != version:
+                    documents = global_apps.get_model('djeography', 'SearchDocument').objects
+                    self.vocabulary = (
+                        version,
+                        Vocabulary(
+                            word
+                            for fields in documents.values_list(
+                                'title',
+                                'place',
+                                'body',
+                            ).iterator(chunk_size=2000)
+                            for field in fields
+                            for word in field.split()
+                        ),
+                    )
+        return self.vocabulary[1]
+
+    def term(self, model, token: str) -> str:
+        # Ogni parola può essere l'inizio di una parola del documento
+        prefix = f'"{token}"*'
+        if model._base_manager.filter(search_index_sqlite__match=prefix).exists():
+            return prefix
+        similar = self.get_vocabulary().similar(token)
+        if not similar:
+            return prefix
+        return '(' + ' OR '.join([prefix, *(f'"{word}"' for word in similar)]) + ')'
+
+    def search(self, queryset, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return self.empty(queryset)
+        query = ' AND '.join(self.term(queryset.model, token) for token in tokens)
+        return queryset.filter(search_index_sqlite__match=query).annotate(
+            # rank è il punteggio bm25 di FTS5: più basso = più pertinente
+            search_rank=-F('search_index_sqlite__rank'),
+        )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('optimize')")
+
+
+class PostgreSQLBackend(SearchBackend):
+    """Colonna ``tsvector`` generata sulla tabella dei documenti, con indice GIN."""
+
+    def __init__(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            self.trigram = cursor.fetchone() is not None
+
+    def search(self, queryset, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return self.empty(queryset)
+        query = ' & '.join(f'{token}:*' for token in tokens)
+        matches = Q(search_index_postgresql__vector__match=query)
+        rank = Func(
+            F('search_index_postgresql__vector'),
+            Func(
+                Value(query),
+                function='to_tsquery',
+                template="%(function)s('simple', %(expressions)s)",
+            ),
+            function='ts_rank',
+            output_field=FloatField(),
+        )
+        if self.trigram:
+            # Trova anche le parole scritte in modo leggermente diverso
+            normalized = ' '.join(tokens)
+            matches |= Q(search_index_postgresql__title__similar=normalized)
+            matches |= Q(search_index_postgresql__place__similar=normalized)
+            rank += Func(
+                Value(normalized),
+                F('search_index_postgresql__title'),
+                function='word_similarity',
+                output_field=FloatField(),
+            )
+        return queryset.filter(matches).annotate(search_rank=rank)
+
+
+class InvertedIndex:
+    """Indice invertito dei documenti: parola -> {segnalazione: punteggio}."""
+
+    def __init__(self, documents: Iterable[tuple[int, str, str, str]]):
+        postings: dict[str, dict[int, float]] = defaultdict(dict)
+        for entity_id, *fields in documents:
+            for weight, field in zip(WEIGHTS, fields):
+                for token in field.split():
+                    scores = postings[token]
+                    scores[entity_id] = scores.get(entity_id, 0.0) + weight
+        self.postings = dict(postings)
+        self.vocabulary = Vocabulary(self.postings)
+
+    def search(self, tokens: list[str]) -> dict[int, float]:
+        """
+        Segnalazioni che contengono tutte le parole (anche come prefisso), con il punteggio.
+
+        Una parola che non è l'inizio di nessuna parola dei documenti trova
+        quelle scritte in modo simile.
+        """
+        results: dict[int, float] | None = None
+        for token in tokens:
+            scores: dict[int, float] = {}
+            words = self.vocabulary.completions(token) or self.vocabulary.similar(token)
+            for word in words:
+                for entity_id, score in self.postings[word].items():
+                    scores[entity_id] = scores.get(entity_id, 0.0) + score
+            if results is None:
+                results = scores
+            else:
+                results = {
+                    entity_id: score + scores[entity_id]
+                    for entity_id, score in results.items()
+                    if entity_id in scores
+                }
+        return results or {}
+
+
+class InvertedIndexBackend(SearchBackend):
+    """
+    Indice invertito in memoria, per i database senza ricerca full-text supportata.
+
+    L'indice viene costruito una volta per processo e ricostruito quando i
+    documenti cambiano; vengono restituite al più
+    ``DJEOGRAPHY_CONFIG['SEARCH_MAX_RESULTS']`` segnalazioni, le più pertinenti.
+    """
+
+    def __init__(self):
+        self.index: tuple[float, InvertedIndex] | None = None
+        self.lock = threading.Lock()
+
+    def get_index(self) -> InvertedIndex:
+        version = versions.get_versions(versions.SEARCH_SCOPE)[-1]
+        if self.index is None or self.index[0] != version:
+            with self.lock:
+                if self.index is None or self.index[0] != version:
+                    documents = global_apps.get_model('djeography', 'SearchDocument').objects
+                    self.index = (
+                        version,
+                        InvertedIndex(
+                            documents.values_list('entity_id', 'title', 'place', 'body').iterator(
+                                chunk_size=2000,
+                            ),
+                        ),
+                    )
+        return self.index[1]
+
+    def search(self, queryset, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return self.empty(queryset)
+        scores = self.get_index().search(tokens)
+        best = sorted(scores, key=lambda entity_id: -scores[entity_id])
+        # Le segnalazioni trovate finiscono in una condizione IN e in un CASE
+        best = best[: app_settings['SEARCH_MAX_RESULTS']]
+        if not best:
+            return self.empty(queryset)
+        return queryset.filter(pk__in=best).annotate(
+            search_rank=Case(
+                *(When(pk=entity_id, then=Value(scores[entity_id])) for entity_id in best),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ),
+        )
+
+
+_backend: SearchBackend | None = None
+
+
+def get_backend() -> SearchBackend:
+    global _backend
+    if _backend is None:
+        if app_settings['SEARCH_BACKEND']:
+            _backend = import_string(app_settings['SEARCH_BACKEND'])()
+        elif connection.vendor == 'postgresql':
+            _backend = PostgreSQLBackend()
+        elif (
+            connection.vendor == 'sqlite'
+            and SQLITE_TABLE in connection.introspection.table_names()
+        ):
+            _backend = SQLiteBackend()
+        else:
+            _backend = InvertedIndexBackend()
+    return _backend
+
+
+def search(queryset: models.QuerySet, text: str) -> models.QuerySet:
+    """Segnalazioni del queryset che corrispondono a ``text``, annotate con ``search_rank``."""
+    return get_backend().search(queryset, text)
+
+
+def update_documents(
+    entity_ids: Iterable[int] | None = None,
+    apps=global_apps,
+    using: str | None = None,
+) -> None:
+    """
+    Ricostruisce i documenti di ricerca delle segnalazioni indicate (tutte se ``None``).
+
+    ``apps`` permette di usare la funzione anche nelle migrazioni; ``using`` è
+    il database delle segnalazioni (predefinito: quello scelto dai router).
+    """
+    Entity = apps.get_model('djeography', 'Entity')
+    Address = apps.get_model('djeography', 'Address')
+    Report = apps.get_model('djeography', 'Report')
+    SearchDocument = apps.get_model('djeography', 'SearchDocument')
+    using = using or router.db_for_write(SearchDocument)
+
+    if entity_ids is None:
+        entity_ids = Entity._base_manager.using(using).order_by('pk').values_list('pk', flat=True)
+    entity_ids = list(entity_ids)
+    for start in range(0, len(entity_ids), CHUNK_SIZE):
+        chunk = entity_ids[start : start + CHUNK_SIZE]
+        places, texts = defaultdict(list), defaultdict(list)
+        addresses = Address._base_manager.using(using).filter(entity__in=chunk)
+        for entity_id, city, road in addresses.values_list(
+            'entity_id',
+            'city',
+            'road',
+        ):
+            places[entity_id] += [city, road]
+        reports = Report._base_manager.using(using).filter(entity__in=chunk)
+        for entity_id, title, body in reports.values_list(
+            'entity_id',
+            'title',
+            'body',
+        ):
+            texts[entity_id] += [title, body]
+        documents = [
+            SearchDocument(
+                entity_id=entity_id,
+                title=' '.join(tokenize(title)),
+                place=' '.join(tokenize(' '.join(places[entity_id]))),
+                body=' '.join(tokenize(' '.join([description, *texts[entity_id]]))),
+            )
+            for entity_id, title, description in Entity._base_manager.using(using)
+            .filter(pk__in=chunk)
+            .values_list('pk', 'title', 'description')
+        ]
+        with transaction.atomic(using=using):
+            SearchDocument._base_manager.using(using).filter(entity__in=chunk).delete()
+            SearchDocument._base_manager.using(using).bulk_create(documents)
+    versions.bump(versions.SEARCH_SCOPE)
@@ -0,0 +1,97 @@
+"""
+Serializzazione in GeoJSON degli indirizzi.
+
+Produce lo stesso formato del serializer di djgeojson usato in precedenza
+(stesse chiavi, nello stesso ordine), ma senza istanziare i modelli né
+costruire un dizionario per ogni feature: le righe vengono lette a blocchi
+con ``values_list`` e scritte direttamente come testo JSON, un blocco alla
+volta, così la memoria usata non dipende dal numero di indirizzi.
+"""
+
+import json
+from collections.abc import Iterator, Mapping
+from typing import Any
+
+from django.db.models import QuerySet
+from django.urls import reverse
+
+# Righe lette dal database (e feature scritte) per ogni blocco
+CHUNK_SIZE = 2000
+
+MODEL_NAME = 'djeography.address'
+
+HEADER = '{"type": "FeatureCollection", "features": ['
+FOOTER = '], "crs": {"type": "name", "properties": {"name": "EPSG:4326"}}}'
+FEATURE = (
+    '{{"type": "Feature", "properties": {{{properties}"popupUrl": {popup_url}, '
+    '"model": "' + MODEL_NAME + '"}}, "id": {pk}, '
+    '"geometry": {{"type": "Point", "coordinates": [{lng!r}, {lat!r}]}}}}'
+)
+
+# Valore segnaposto per costruire gli URL dei popup senza chiamare reverse() per ogni riga
+_PK_PLACEHOLDER = 2147483647
+
+
+def url_template(viewname: str) -> str:
+    """URL della vista ``viewname`` con ``{}`` al posto dell'id."""
+    return reverse(viewname, kwargs={'pk': _PK_PLACEHOLDER}).replace(
+        str(_PK_PLACEHOLDER),
+        '{}',
+    )
+
+
+def popup_url_template() -> str:
+    return url_template('djeography:popup')
+
+
+def stream_addresses(
+    queryset: QuerySet,
+    properties: Mapping[str, str],
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Genera una FeatureCollection GeoJSON degli indirizzi, un blocco alla volta.
+
+    ``properties`` associa il nome di ogni proprietà al lookup da cui leggerla
+    (ad es. ``{'evaluation': 'entity__evaluation'}``); ``popupUrl`` viene
+    sempre aggiunto. Gli indirizzi senza coordinate valide vengono saltati.
+    """
+    rows = (
+        queryset.filter(latitude__isnull=False, longitude__isnull=False)
+        .values_list('pk', 'longitude', 'latitude', *properties.values())
+        .iterator(chunk_size=chunk_size)
+    )
+    keys = [json.dumps(name) + ': ' for name in properties]
+    popup_url = json.dumps(popup_url_template())
+    # I valori delle proprietà (slug, valutazioni, booleani) sono pochi:
+    # ciascuno viene codificato una sola volta
+    encoded: dict[Any, str] = {}
+
+    def encode(value: Any) -> str:
+        key = (type(value), value)
+        if key not in encoded:
+            encoded[key] = json.dumps(value, ensure_ascii=False)
+        return encoded[key]
+
+    yield HEADER.encode()
+    separator = ''
+    chunk = []
+    for pk, lng, lat, *values in rows:
+        chunk.append(
+            FEATURE.format(
+                properties=''.join(
+                    f'{key}{encode(value)}, ' for key, value in zip(keys, values)
+                ),
+                popup_url=popup_url.format(pk),
+                pk=pk,
+                lng=lng,
+                lat=lat,
+            ),
+        )
+        if len(chunk) == chunk_size:
+            yield (separator + ', '.join(chunk)).encode()
+            separator = ', '
+            chunk = []
+    if chunk:
+        yield (separator + ', '.join(chunk)).encode()
+    yield FOOTER.encode()
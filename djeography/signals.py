@@ -0,0 +1,122 @@
+"""
+Ricevitori dei segnali dei modelli.
+
+Tengono aggiornate le versioni dei contenuti (vedi ``versions.py``) quando
+segnalazioni, indirizzi e dati collegati vengono salvati o eliminati.
+"""
+
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import search, versions
+from .models import Address, Category, Contact, Entity, EvaluationLevel, Report
+
+
+def deleted_with_entity(origin) -> bool:
+    """La riga è stata eliminata a cascata insieme alla sua segnalazione."""
+    if isinstance(origin, QuerySet):
+        return origin.model is Entity
+    return isinstance(origin, Entity)
+
+
+@receiver(pre_save, sender=Entity)
+def remember_entity_category(sender, instance, **kwargs):
+    # Se la segnalazione cambia categoria va aggiornata anche quella di partenza
+    instance._previous_category_id = (
+        sender.objects.filter(pk=instance.pk).values_list('category_id', flat=True).first()
+        if instance.pk
+        else None
+    )
+
+
+@receiver(post_save, sender=Entity)
+def entity_saved(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_category_id', None)
+    if previous is not None and previous != instance.category_id:
+        slug = Category.objects.filter(pk=previous).values_list('slug', flat=True).first()
+        if slug:
+            versions.bump(versions.category_scope(slug), versions.list_scope(slug))
+    versions.touch_entities([instance.pk])
+    search.update_documents([instance.pk])
+
+
+@receiver(post_delete, sender=Entity)
+def entity_deleted(sender, instance, **kwargs):
+    # Gli indirizzi sono già stati eliminati (CASCADE) e hanno aggiornato le proprie versioni
+    versions.bump(
+        versions.category_scope(instance.category.slug),
+        versions.list_scope(instance.category.slug),
+        versions.entity_scope(instance.pk),
+    )
+
+
+@receiver(post_save, sender=Address)
+@receiver(post_delete, sender=Address)
+def address_changed(sender, instance, origin=None, **kwargs):
+    slug = (
+        Category.objects.filter(entity=instance.entity_id)
+        .values_list('slug', flat=True)
+        .first()
+    )
+    scopes = [versions.address_scope(instance.pk), versions.entity_scope(instance.entity_id)]
+    if slug:
+        scopes += [versions.category_scope(slug), versions.list_scope(slug)]
+    versions.bump(*scopes)
+    # Città e via compaiono nel documento di ricerca della segnalazione
+    if not deleted_with_entity(origin):
+        search.update_documents([instance.entity_id])
+
+
+def bump_entity_addresses(*entity_ids):
+    versions.bump(
+        *(
+            versions.address_scope(pk)
+            for pk in Address.objects.filter(entity__in=entity_ids).values_list(
+                'pk',
+                flat=True,
+            )
+        ),
+    )
+
+
+@receiver(post_save, sender=Contact)
+@receiver(post_delete, sender=Contact)
+def entity_content_changed(sender, instance, **kwargs):
+    # I contatti compaiono nei popup degli indirizzi e nelle pagine della segnalazione
+    bump_entity_addresses(instance.entity_id)
+    versions.touch_pages([instance.entity_id])
+
+
+@receiver(pre_save, sender=Report)
+def remember_report_entity(sender, instance, **kwargs):
+    # Se la testimonianza viene spostata vanno aggiornate entrambe le segnalazioni
+    instance._previous_entity_id = (
+        sender.objects.filter(pk=instance.pk).values_list('entity_id', flat=True).first()
+        if instance.pk
+        else None
+    )
+
+
+@receiver(post_save, sender=Report)
+@receiver(post_delete, sender=Report)
+def report_changed(sender, instance, origin=None, **kwargs):
+    if deleted_with_entity(origin):
+        return
+    # Le statistiche delle testimonianze compaiono nell'elenco e nei popup,
+    # il testo nei documenti di ricerca
+    entity_ids = {instance.entity_id, getattr(instance, '_previous_entity_id', None)}
+    entity_ids.discard(None)
+    Entity.objects.update_report_stats(entity_ids)
+    bump_entity_addresses(*entity_ids)
+    versions.touch_pages(entity_ids)
+    search.update_documents(entity_ids)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=EvaluationLevel)
+@receiver(post_delete, sender=EvaluationLevel)
+def reference_data_changed(sender, instance, **kwargs):
+    # Categorie e livelli di valutazione cambiano di rado: invalida tutto
+    versions.bump(versions.GLOBAL_SCOPE)
@@ -0,0 +1,19 @@
+from django import template
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def page_url(context, number):
+    """
+    Link alla pagina ``number`` dell'elenco.
+
+    Nella copia statica (``page_path`` nel contesto) le pagine sono percorsi,
+    perché un server statico ignora i parametri della query.
+    """
+    page_path = context.get('page_path')
+    if page_path:
+        return page_path if int(number) == 1 else f'{page_path}page/{number}/'
+    params = context.request.GET.copy()
+    params['page'] = number
+    return f'?{params.urlencode()}'
@@ -1,19 +1,30 @@
 from django.urls import path
 
 from .views import (
+    ClusterView,
     EntityDetailView,
     EntityListView,
     EntityPublishView,
     EntityUnpublishView,
+    ExportView,
+    GeoJSONAllCategoriesView,
     GeoJSONLayerByCategoryView,
     MapView,
+    PlacesView,
+    PopupBatchView,
     PopupView,
+    VectorTileView,
 )
 
 app_name = 'djeography'
 urlpatterns = [
+    path('data.geojson', GeoJSONAllCategoriesView.as_view(), name='data_all'),
     path('data/<slug:slug>.geojson', GeoJSONLayerByCategoryView.as_view(), name='data'),
+    path('data/<slug:slug>/clusters.geojson', ClusterView.as_view(), name='clusters'),
+    path('tiles/<int:z>/<int:x>/<int:y>.pbf', VectorTileView.as_view(), name='tiles'),
     path('popup/<int:pk>/', PopupView.as_view(), name='popup'),
+    path('popups.json', PopupBatchView.as_view(), name='popups'),
+    path('places.json', PlacesView.as_view(), name='places'),
     path('fullscreen/', MapView.as_view(), name='map_fullscreen'),
     path('entities/', EntityListView.as_view(), name='list'),
     path('entities/<int:pk>/', EntityDetailView.as_view(), name='detail'),
@@ -23,4 +34,5 @@ urlpatterns = [
         EntityUnpublishView.as_view(),
         name='unpublish',
     ),
+    path('export/', ExportView.as_view(), name='export'),
 ]
@@ -0,0 +1,161 @@
+"""
+Versioni dei contenuti serviti alla mappa.
+
+Ogni ambito (l'intero dataset, una categoria, un indirizzo, una pagina) ha una versione
+salvata nella cache di Django: il valore è il timestamp dell'ultima modifica.
+Le versioni vengono aggiornate dai segnali definiti in ``signals.py`` e dalle
+azioni di massa dell'admin, e servono a calcolare ETag e Last-Modified per le
+richieste condizionali e a scartare le pagine salvate in cache.
+
+Se l'applicazione gira su più processi la cache deve essere condivisa
+(Redis, Memcached, database), altrimenti ogni processo avrebbe le proprie versioni.
+"""
+
+import hashlib
+import time
+from collections.abc import Iterable
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY_PREFIX = 'djeography:version:'
+# Durata delle versioni inizializzate da get_versions: gli ambiti vengono dagli
+# URL, e una chiave senza scadenza per ogni slug o id inventato riempirebbe la
+# cache. Le versioni aggiornate da bump non scadono
+INITIAL_VERSION_TIMEOUT = 24 * 60 * 60
+
+# Ambito condiviso da tutte le risposte: viene aggiornato quando cambiano
+# categorie o livelli di valutazione
+GLOBAL_SCOPE = 'global'
+# Ambito dei contenuti che includono gli indirizzi di tutte le categorie:
+# viene aggiornato insieme a quello di qualsiasi categoria
+DATASET_SCOPE = 'dataset'
+
+# Ambito dei documenti di ricerca (vedi ``search.py``)
+SEARCH_SCOPE = 'search'
+
+# Ambito delle pagine dell'elenco non filtrate per categoria: viene aggiornato
+# insieme a quello dell'elenco di qualsiasi categoria
+LIST_SCOPE = 'list'
+
+PUBLIC_TIER = 'public'
+STAFF_TIER = 'staff'
+TIERS = (PUBLIC_TIER, STAFF_TIER)
+
+
+def category_scope(slug: str) -> str:
+    return f'category:{slug}'
+
+
+def address_scope(pk: int) -> str:
+    return f'address:{pk}'
+
+
+def entity_scope(pk: int) -> str:
+    """Pagina di dettaglio della segnalazione."""
+    return f'entity:{pk}'
+
+
+def list_scope(slug: str) -> str:
+    """Pagine dell'elenco filtrate per la categoria."""
+    return f'list:{slug}'
+
+
+def visibility_tier(request) -> str:
+    """Gli utenti autenticati vedono anche le bozze: i loro contenuti sono diversi."""
+    return STAFF_TIER if request.user.is_authenticated else PUBLIC_TIER
+
+
+def get_versions(*scopes: str) -> list[float]:
+    """
+    Restituisce le versioni degli ambiti richiesti (più quello globale, sempre primo).
+
+    Una versione assente dalla cache (ad es. dopo un riavvio o uno svuotamento)
+    viene inizializzata all'istante corrente, per ``INITIAL_VERSION_TIMEOUT``
+    secondi: i validatori già emessi diventano così non validi invece di
+    restare validi per errore.
+    """
+    keys = [VERSION_KEY_PREFIX + scope for scope in (GLOBAL_SCOPE, *scopes)]
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        now = time.time()
+        for key in missing:
+            cache.add(key, now, timeout=INITIAL_VERSION_TIMEOUT)
+        found.update(cache.get_many(missing))
+    return [found[key] for key in keys]
+
+
+def _set_versions(scopes: Iterable[str]) -> None:
+    now = time.time()
+    cache.set_many(
+        {VERSION_KEY_PREFIX + scope: now for scope in scopes},
+        timeout=None,
+    )
+
+
+def bump(*scopes: str) -> None:
+    """
+    Aggiorna la versione degli ambiti indicati.
+
+    L'aggiornamento avviene dopo il commit della transazione corrente: in caso
+    contrario una richiesta concorrente potrebbe leggere i dati vecchi e
+    associarli alla nuova versione.
+    """
+    if any(scope.startswith('category:') for scope in scopes):
+        scopes = (*scopes, DATASET_SCOPE)
+    if any(scope.startswith('list:') for scope in scopes):
+        scopes = (*scopes, LIST_SCOPE)
+    if scopes:
+        transaction.on_commit(lambda: _set_versions(scopes))
+
+
+def touch_entities(entity_ids: Iterable[int]) -> None:
+    """Aggiorna le versioni di categorie, indirizzi e pagine delle segnalazioni indicate."""
+    from .models import Address, Category
+
+    entity_ids = list(entity_ids)
+    if not entity_ids:
+        return
+    slugs = set(Category.objects.filter(entity__in=entity_ids).values_list('slug', flat=True))
+    addresses = Address.objects.filter(entity__in=entity_ids).values_list('pk', flat=True)
+    bump(
+        *(category_scope(slug) for slug in slugs),
+        *(address_scope(pk) for pk in addresses),
+        *(list_scope(slug) for slug in slugs),
+        *(entity_scope(pk) for pk in entity_ids),
+    )
+
+
+def touch_pages(entity_ids: Iterable[int]) -> None:
+    """
+    Aggiorna le versioni delle pagine in cui compaiono le segnalazioni indicate.
+
+    Per le modifiche che non cambiano i dati della mappa (contatti, testimonianze):
+    la pagina di dettaglio e le pagine dell'elenco che possono contenerle.
+    """
+    from .models import Category
+
+    entity_ids = list(entity_ids)
+    if not entity_ids:
+        return
+    slugs = Category.objects.filter(entity__in=entity_ids).values_list('slug', flat=True)
+    bump(
+        *(list_scope(slug) for slug in set(slugs)),
+        *(entity_scope(pk) for pk in entity_ids),
+    )
+
+
+def validators(tier: str, *scopes: str, variant: str = '') -> tuple[str, datetime]:
+    """
+    Restituisce ETag e Last-Modified per il contenuto degli ambiti indicati.
+
+    L'ETag è forte e distinto per livello di visibilità, perché anonimi e
+    utenti autenticati ricevono contenuti diversi per la stessa URL, e per
+    ``variant`` (ad es. il formato della risposta).
+    """
+    versions = get_versions(*scopes)
+    digest = hashlib.sha1(repr((tier, variant, scopes, versions)).encode()).hexdigest()
+    modified = datetime.fromtimestamp(max(versions), tz=timezone.utc)
+    return f'"{digest}"', modified
@@ -1,21 +1,208 @@
+import hashlib
 from typing import Any
 
 from django.contrib import messages
-from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Count, F, Max, Prefetch, Q
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousOperation
+from django.db.models import Prefetch
 from django.db.models.query import QuerySet
-from django.http import HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
+from django.template.defaultfilters import date, title
+from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views.decorators.clickjacking import xframe_options_sameorigin
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 from django.views.generic import DetailView, ListView, TemplateView, View
-from djgeojson.views import GeoJSONLayerView
 
 from djeography import app_settings
 
-from .models import Address, Category, Entity, EvaluationLevel, Report
+from . import (
+    caching,
+    clustering,
+    columnar,
+    exporting,
+    facets,
+    gazetteer,
+    geo,
+    mvt,
+    pagination,
+    reference,
+    serializers,
+    versions,
+)
+from . import search as text_search
+from .models import Address, Contact, Entity
+
+
+class ConditionalResponseMixin:
+    """
+    Gestisce le richieste condizionali (If-None-Match / If-Modified-Since).
+
+    ETag e Last-Modified sono calcolati dalle versioni dei contenuti restituite
+    da ``get_version_scopes``: se il client ha già la versione corrente la vista
+    risponde con 304 senza interrogare il database.
+    """
+
+    def get_version_scopes(self) -> list[str]:
+        """
+        Ambiti da cui dipende la risposta; quello globale è sempre incluso.
+
+        Predefinito: gli indirizzi di tutte le categorie.
+        """
+        return [versions.DATASET_SCOPE]
+
+    def get_variant(self) -> str:
+        """Distingue rappresentazioni diverse dello stesso contenuto alla stessa URL."""
+        return ''
+
+    def dispatch(self, request, *args, **kwargs):
+        self.tier = versions.visibility_tier(request)
+        self.etag, self.last_modified = versions.validators(
+            self.tier,
+            *self.get_version_scopes(),
+            variant=self.get_variant(),
+        )
+        view = condition(
+            etag_func=lambda request, *args, **kwargs: self.etag,
+            last_modified_func=lambda request, *args, **kwargs: self.last_modified,
+        )(super().dispatch)
+        response = view(request, *args, **kwargs)
+        # Il browser deve sempre rivalidare: le versioni cambiano senza preavviso
+        patch_cache_control(
+            response,
+            no_cache=True,
+            private=self.tier == versions.STAFF_TIER,
+        )
+        return response
 
 
-class EntityListView(ListView):
+class PageCacheMixin:
+    """
+    Cache delle pagine HTML per gli utenti anonimi (``DJEOGRAPHY_CONFIG['PAGE_CACHE']``).
+
+    La pagina viene salvata insieme alle versioni degli ambiti restituiti da
+    ``get_page_scopes``: quando una segnalazione cambia vengono scartate solo
+    le pagine che la possono contenere. La chiave dipende dal percorso e dai
+    soli parametri in ``page_cache_params``, ordinati e senza valori vuoti.
+
+    Gli utenti autenticati, le richieste con messaggi in attesa e le risposte
+    che impostano cookie (ad es. il token CSRF) non passano dalla cache.
+    """
+
+    page_cache_params: tuple[str, ...] = ()
+    # False per le viste che generano la pagina in modo diverso (ad es. la copia statica)
+    page_cache = True
+
+    def get_page_scopes(self) -> list[str]:
+        """
+        Ambiti da cui dipende la pagina.
+
+        Predefinito: quelli delle risposte condizionali, se la vista le
+        gestisce, altrimenti gli indirizzi di tutte le categorie e l'elenco.
+        """
+        if isinstance(self, ConditionalResponseMixin):
+            return self.get_version_scopes()
+        return [versions.DATASET_SCOPE, versions.LIST_SCOPE]
+
+    def dispatch(self, request, *args, **kwargs):
+        if (
+            not app_settings['PAGE_CACHE']
+            or not self.page_cache
+            or request.method != 'GET'
+            or request.user.is_authenticated
+            or len(messages.get_messages(request))
+        ):
+            return super().dispatch(request, *args, **kwargs)
+
+        query = sorted(
+            (name, value)
+            for name, value in request.GET.items()
+            if name in self.page_cache_params and value
+        )
+        key = 'djeography:page:{}'.format(
+            hashlib.sha1(repr((request.path, query)).encode()).hexdigest(),
+        )
+        # Le versioni vanno lette prima di generare la pagina
+        token = repr(versions.get_versions(*self.get_page_scopes()))
+        entry = cache.get(key)
+        if entry is not None and entry[0] == token:
+            response = HttpResponse(entry[1])
+            for header, value in entry[2]:
+                response[header] = value
+            return response
+
+        response = super().dispatch(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        if (
+            response.status_code == 200
+            and not response.cookies
+            and not request.META.get('CSRF_COOKIE_USED')
+        ):
+            headers = [
+                (header, value)
+                for header, value in response.items()
+                if header.lower() != 'set-cookie'
+            ]
+            cache.set(
+                key,
+                (token, response.content, headers),
+                timeout=app_settings['PAGE_CACHE_TIMEOUT'],
+            )
+        return response
+
+
+class ViewportMixin:
+    """
+    Legge i parametri ``bbox`` (ovest,sud,est,nord) e ``zoom`` della richiesta.
+
+    Con ``zoom`` l'area viene allargata alla griglia delle tile di quel
+    livello, così viste vicine condividono la stessa risposta.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        self.viewport, self.tiles = self.get_viewport()
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_viewport(self):
+        """Restituisce il bounding box richiesto e, se c'è uno zoom, le tile che lo coprono."""
+        bbox = self.request.GET.get('bbox')
+        zoom = self.request.GET.get('zoom')
+        if not bbox:
+            return None, None
+        try:
+            bbox = geo.parse_bbox(bbox)
+            if zoom is None:
+                return bbox, None
+            zoom = int(zoom)
+            tiles = geo.tile_range(bbox, zoom)
+        except ValueError as err:
+            # Django risponde con 400 Bad Request
+            raise SuspiciousOperation('Invalid bbox or zoom parameters.') from err
+        return geo.tile_range_bbox(zoom, *tiles), (zoom, *tiles)
+
+    def filter_viewport(self, queryset: QuerySet[Address]) -> QuerySet[Address]:
+        if self.viewport is None:
+            return queryset
+        west, south, east, north = self.viewport
+        return queryset.filter(
+            latitude__range=(south, north),
+            longitude__range=(west, east),
+        )
+
+
+class EntityListView(PageCacheMixin, ListView):
     """
     Vista per tutte le segnalazioni.
 
@@ -27,6 +214,14 @@ class EntityListView(ListView):
     template_name = 'map/list.html'
     context_object_name = 'entities'
     paginate_by = app_settings['PAGINATION']
+    page_cache_params = ('search', 'province', 'category', 'evaluation', 'page', 'cursor')
+
+    def get_page_scopes(self) -> list[str]:
+        category = self.request.GET.get('category')
+        if category in reference.get().categories:
+            # Solo le segnalazioni della categoria possono comparire nella pagina
+            return [versions.list_scope(category)]
+        return [versions.LIST_SCOPE]
 
     def get_queryset(self) -> QuerySet[Any]:
         # Solo gli utenti autenticati possono vedere segnalazioni
@@ -47,51 +242,81 @@ class EntityListView(ListView):
         )
 
         if search:
-            # Vedi https://docs.djangoproject.com/en/5.2/topics/db/search/
-            # per documentazione sulle funzioni di ricerca
-            queryset = queryset.filter(
-                Q(address__city__icontains=search) | Q(title__icontains=search),
-            )
-
-        else:
-            # Applica i filtri solo se non sta svolgendo una ricerca
-            if province_filter:
-                queryset = queryset.filter(address__province=province_filter)
-            if category_filter:
-                queryset = queryset.filter(category__slug=category_filter)
-            if evaluation_filter:
-                queryset = queryset.filter(evaluation=evaluation_filter)
-
-        # Aggiungi numero di testimonianze e testimonianza più recente
-        queryset = queryset.annotate(
-            latest_update=Max('report__date_added'),
-            n_reports=Count('report', distinct=True),
-        )
+            queryset = text_search.search(queryset, search)
+        # Risultati della ricerca prima dei filtri: servono per i conteggi dei filtri
+        self.unfiltered = queryset
+        # I filtri sono condizioni sulla segnalazione (EXISTS per gli indirizzi),
+        # senza join che moltiplicano le righe
+        queryset = facets.filter_entities(queryset, self.request.GET).for_list()
 
-        return queryset.order_by(
-            'published', F('latest_update').desc(nulls_last=True), 'id'
+        if search:
+            # Risultati in ordine di pertinenza (vedi search.py)
+            return queryset.order_by('-search_rank', 'id')
+
+        # Numero di testimonianze e testimonianza più recente sono salvati
+        # nella segnalazione: l'ordinamento può usare un indice
+        return queryset.order_by(*pagination.ORDERING)
+
+    def get_pagination_mode(self) -> str:
+        # I risultati di una ricerca sono ordinati per pertinenza: restano a pagine numerate
+        if self.request.GET.get('search'):
+            return 'pages'
+        return app_settings['PAGINATION_MODE']
+
+    def paginate_queryset(self, queryset, page_size):
+        self.pagination_mode = self.get_pagination_mode()
+        if self.pagination_mode == 'pages':
+            return super().paginate_queryset(queryset, page_size)
+        # Il totale viene dai conteggi dei filtri, senza un COUNT
+        paginator = pagination.CursorPaginator(
+            queryset,
+            page_size,
+            count=facets.total(self.facet_counts, self.request.GET),
         )
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except pagination.InvalidCursor as err:
+            raise Http404('Invalid cursor.') from err
+        return paginator, page, page.object_list, page.has_other_pages()
 
     def get_context_data(self, **kwargs: Any) -> dict[str, Any]:
+        # Numero di segnalazioni per ogni opzione dei filtri, usato anche dalla paginazione
+        self.facet_counts = facets.get_facets(
+            self.unfiltered,
+            self.request.GET,
+            versions.visibility_tier(self.request),
+            search=self.request.GET.get('search', ''),
+        )
         context = super().get_context_data(**kwargs)
 
         # Dati per la creazione del form
-        context['provinces'] = dict(app_settings['PROV_CHOICES'])
-        context['categories'] = {cat.slug: cat for cat in Category.objects.all()}
+        tables = reference.get()
+        context['provinces'] = tables.provinces
+        context['categories'] = tables.categories
         context['evaluations'] = {
-            level.short_name: level.full_name for level in EvaluationLevel.objects.all()
+            short_name: level.full_name for short_name, level in tables.evaluations.items()
         }
+        context['facets'] = self.facet_counts
         context['searching'] = self.searching
+        # Filtri scelti, che la ricerca deve mantenere
+        context['filters'] = {
+            name: self.request.GET[name] for name in facets.FILTERS if self.request.GET.get(name)
+        }
+        context['filtering'] = bool(context['filters'])
+        context['pagination_mode'] = self.pagination_mode
 
         return context
 
 
-class EntityDetailView(DetailView):
+class EntityDetailView(PageCacheMixin, DetailView):
     """Vista per una singola segnalazione e le testimonianze pertinenti a quella segnalazione."""
 
     model = Entity
     template_name = 'map/detail.html'
 
+    def get_page_scopes(self) -> list[str]:
+        return [versions.entity_scope(self.kwargs['pk'])]
+
     def get_context_data(self, **kwargs: Any) -> dict[str, Any]:
         context = super().get_context_data(**kwargs)
 
@@ -106,9 +331,7 @@ class EntityDetailView(DetailView):
             queryset = super().get_queryset()
         else:
             queryset = self.model.published_objects.all()
-        return queryset.prefetch_related(
-            Prefetch('report_set', queryset=Report.objects.order_by('-date_added')),
-        )
+        return queryset.for_detail()
 
 
 class EntityPublishView(LoginRequiredMixin, View):
@@ -135,33 +358,360 @@ class EntityUnpublishView(LoginRequiredMixin, View):
         return HttpResponseRedirect(entity.get_absolute_url())
 
 
-class GeoJSONLayerByCategoryView(GeoJSONLayerView):
-    model = Address
-    properties = ('evaluation', 'published', 'popupUrl')
-    geometry_field = 'coords'
+class ExportView(UserPassesTestMixin, View):
+    """
+    Esportazione delle segnalazioni per lo staff, in streaming.
 
-    def get_queryset(self, **kwargs):
-        queryset = self.model.objects.filter(
-            entity__category__slug=self.kwargs['slug'],
-        ).annotate(evaluation=F('entity__evaluation'), published=F('entity__published'))
+    Parametri: ``format`` (csv, geojson, ndjson), ``flat``, ``gzip``, i filtri
+    dell'elenco (``province``, ``category``, ``evaluation``) e ``published``
+    (1 o 0). Vedi ``exporting.py``.
+    """
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'csv')
+        if format not in exporting.FORMATS:
+            raise SuspiciousOperation('Invalid export format.')
+        published = {'1': True, '0': False, '': None}.get(request.GET.get('published', ''))
+        if published is None and request.GET.get('published'):
+            raise SuspiciousOperation('Invalid published parameter.')
+        queryset = exporting.filter_entities(Entity.objects.all(), request.GET, published)
+        export = exporting.Export(queryset, format, flat=bool(request.GET.get('flat')))
+
+        content_type, extension = exporting.FORMATS[format]
+        filename = f'djeography.{extension}'
+        if request.GET.get('gzip'):
+            response = StreamingHttpResponse(
+                exporting.compress(export),
+                content_type='application/gzip',
+            )
+            filename += '.gz'
+        else:
+            response = StreamingHttpResponse(exporting.encode(export), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        patch_cache_control(response, private=True, no_store=True)
+        return response
+
+
+@method_decorator(gzip_page, name='dispatch')
+class PlacesView(View):
+    """
+    Comuni il cui nome inizia con il testo cercato, per l'autocompletamento.
+
+    Parametri: ``q`` e ``limit`` (al più ``max_limit``). Restituisce una lista
+    di comuni con nome, sigla e nome della provincia e coordinate del centro.
+    L'elenco dei comuni non dipende dal database (vedi ``gazetteer.py``): le
+    risposte possono essere salvate dal browser e dai proxy.
+    """
+
+    default_limit = 10
+    max_limit = 20
+    max_age = 24 * 60 * 60
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.GET.get('limit', self.default_limit))
+        except ValueError as err:
+            raise SuspiciousOperation('Invalid limit parameter.') from err
+        limit = max(1, min(limit, self.max_limit))
+        provinces = dict(app_settings['PROV_CHOICES'])
+        places = gazetteer.get().search(request.GET.get('q', ''), limit)
+        response = JsonResponse(
+            [
+                {
+                    'name': place.name,
+                    'province': place.province,
+                    'province_name': provinces.get(place.province, place.province),
+                    'lat': place.latitude,
+                    'lng': place.longitude,
+                }
+                for place in places
+            ],
+            safe=False,
+        )
+        patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
+
+
+class GeoJSONLayerByCategoryView(ViewportMixin, ConditionalResponseMixin, View):
+    """
+    Indirizzi di una categoria in formato GeoJSON.
+
+    Accetta ``bbox`` e ``zoom`` per limitare la risposta all'area visibile;
+    le risposte allineate alle tile vengono salvate in cache, le altre
+    vengono inviate in streaming.
+
+    Con ``format=columnar`` (o con l'header ``Accept`` corrispondente) restituisce
+    gli indirizzi nel formato binario a colonne descritto in ``columnar.py``.
+    """
+
+    content_type = 'application/geo+json'
+    # Proprietà delle feature e lookup da cui leggerle (popupUrl è sempre presente)
+    properties = {
+        'evaluation': 'entity__evaluation',
+        'published': 'entity__published',
+    }
+
+    def get_version_scopes(self) -> list[str]:
+        return [versions.category_scope(self.kwargs['slug'])]
+
+    def get_queryset(self) -> QuerySet[Address]:
+        queryset = self.filter_viewport(
+            Address.objects.filter(entity__category__slug=self.kwargs['slug']),
+        )
         if not self.request.user.is_authenticated:
             return queryset.filter(entity__published=True)
         return queryset
 
+    def get_variant(self) -> str:
+        if self.request.GET.get('format') == 'columnar' or columnar.MEDIA_TYPE in (
+            self.request.headers.get('Accept', '')
+        ):
+            return 'columnar'
+        return ''
+
+    def get_cache_key(self) -> str | None:
+        key = f'djeography:geojson:{self.kwargs["slug"]}:{self.tier}{self.get_variant()}'
+        if self.viewport is None:
+            return key
+        if self.tiles is None:
+            # Un bbox arbitrario non allineato alle tile non vale la pena di salvarlo
+            return None
+        return '{}:{}/{}-{}/{}-{}'.format(key, *self.tiles)
+
+    def get(self, request, *args, **kwargs):
+        """
+        Restituisce il GeoJSON della categoria dalla cache, se aggiornato.
+
+        Le copie sono distinte per livello di visibilità (solo pubblicate
+        oppure anche bozze), per formato e per area richiesta.
+        """
+        if self.get_variant() == 'columnar':
+            content_type = columnar.MEDIA_TYPE
+            stream = columnar.stream_addresses(
+                self.get_queryset(),
+                app_settings['COLUMNAR_PRECISION'],
+            )
+        else:
+            content_type = self.content_type
+            stream = serializers.stream_addresses(self.get_queryset(), self.properties)
+
+        key = self.get_cache_key()
+        if key is None:
+            response = StreamingHttpResponse(stream, content_type=content_type)
+        else:
+            etag, (last_modified, content) = caching.get_or_build(
+                key,
+                self.etag,
+                lambda: (self.last_modified, b''.join(stream)),
+                timeout=app_settings['GEOJSON_CACHE_TIMEOUT'],
+            )
+            response = HttpResponse(content, content_type=content_type)
+            # Se è stata servita una copia precedente i validatori devono essere i suoi
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class GeoJSONAllCategoriesView(GeoJSONLayerByCategoryView):
+    """
+    Indirizzi di tutte le categorie in un'unica FeatureCollection GeoJSON.
+
+    Le feature hanno le stesse proprietà del GeoJSON per categoria, più lo
+    slug della categoria in ``category``. La risposta viene generata con una
+    sola query e inviata in streaming; accetta ``bbox`` e ``zoom``.
+    """
+
+    properties = {
+        'category': 'entity__category__slug',
+        **GeoJSONLayerByCategoryView.properties,
+    }
+
+    def get_version_scopes(self) -> list[str]:
+        return [versions.DATASET_SCOPE]
+
+    def get_queryset(self) -> QuerySet[Address]:
+        queryset = self.filter_viewport(Address.objects.all())
+        if not self.request.user.is_authenticated:
+            queryset = queryset.filter(entity__published=True)
+        return queryset
+
+    def get_cache_key(self) -> str | None:
+        return None
+
+
+class ClusterView(ConditionalResponseMixin, View):
+    """
+    Indirizzi di una categoria raggruppati lato server.
+
+    Richiede il parametro ``zoom`` e accetta ``bbox`` (ovest,sud,est,nord).
+    Ogni cluster riporta il numero di indirizzi, la loro suddivisione per
+    valutazione e l'area che occupano; oltre ``CLUSTER_MAX_ZOOM`` vengono
+    restituiti i singoli indirizzi, con le stesse proprietà del GeoJSON.
+    """
+
+    def get_version_scopes(self) -> list[str]:
+        # Prima di creare versioni e gerarchie: lo slug arriva dall'URL
+        if self.kwargs['slug'] not in reference.get().categories:
+            raise Http404('No such category.')
+        return [versions.category_scope(self.kwargs['slug'])]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            zoom = int(request.GET['zoom'])
+            bbox = geo.parse_bbox(request.GET.get('bbox', '-180,-90,180,90'))
+        except (KeyError, ValueError) as err:
+            raise SuspiciousOperation('Invalid bbox or zoom parameters.') from err
+
+        index = clustering.get_index(
+            f'{self.kwargs["slug"]}:{self.tier}',
+            self.etag,
+            self.build_index,
+            max_size=len(reference.get().categories) * len(versions.TIERS),
+        )
+        return JsonResponse(
+            {
+                'type': 'FeatureCollection',
+                'features': [
+                    self.to_feature(item) for item in index.get_clusters(bbox, zoom)
+                ],
+            },
+            content_type='application/geo+json',
+        )
+
+    def build_index(self) -> clustering.ClusterIndex:
+        queryset = Address.objects.filter(
+            entity__category__slug=self.kwargs['slug'],
+            latitude__isnull=False,
+            longitude__isnull=False,
+        )
+        if not self.request.user.is_authenticated:
+            queryset = queryset.filter(entity__published=True)
+        return clustering.ClusterIndex(
+            queryset.values_list(
+                'pk',
+                'longitude',
+                'latitude',
+                'entity__evaluation',
+                'entity__published',
+            ).iterator(),
+            radius=app_settings['CLUSTER_RADIUS'],
+            max_zoom=app_settings['CLUSTER_MAX_ZOOM'],
+        )
+
+    def to_feature(self, item: clustering.Cluster) -> dict[str, Any]:
+        feature = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': list(item.lng_lat)},
+        }
+        if item.point is not None:
+            pk, evaluation, published = item.point
+            feature['id'] = pk
+            feature['properties'] = {
+                'evaluation': evaluation,
+                'published': published,
+                'popupUrl': reverse('djeography:popup', kwargs={'pk': pk}),
+            }
+        else:
+            feature['properties'] = {
+                'cluster': True,
+                'count': item.count,
+                'evaluations': dict(item.evaluations),
+                'bbox': list(item.bounds),
+            }
+        return feature
+
+
+class VectorTileView(ConditionalResponseMixin, View):
+    """
+    Indirizzi di tutte le categorie come tile vettoriali (Mapbox Vector Tile).
+
+    Ogni indirizzo è una feature con l'id dell'indirizzo e gli attributi
+    ``category``, ``evaluation`` e ``published``.
+    """
+
+    content_type = 'application/vnd.mapbox-vector-tile'
+    layer_name = 'addresses'
+    # Margine attorno alla tile (in unità della tile), per non tagliare
+    # le icone dei punti vicini al bordo
+    buffer = 64
 
-class MapView(TemplateView):
+    def get_version_scopes(self) -> list[str]:
+        return [versions.DATASET_SCOPE]
+
+    def get(self, request, z, x, y, *args, **kwargs):
+        if z > geo.MAX_ZOOM or x >= 2**z or y >= 2**z:
+            raise Http404('Tile out of range.')
+
+        etag, (last_modified, content) = caching.get_or_build(
+            f'djeography:tile:{self.tier}:{z}/{x}/{y}',
+            self.etag,
+            lambda: (self.last_modified, self.build_tile(z, x, y)),
+            timeout=app_settings['GEOJSON_CACHE_TIMEOUT'],
+        )
+        response = HttpResponse(content, content_type=self.content_type)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+    def build_tile(self, z: int, x: int, y: int) -> bytes:
+        margin = self.buffer / mvt.EXTENT
+        west, south, east, north = geo.tile_range_bbox(z, x, y, x, y)
+        # Il margine si calcola in coordinate delle tile, poi si riconverte in gradi
+        west = geo.tile_x_to_lng(x - margin, z)
+        east = geo.tile_x_to_lng(x + 1 + margin, z)
+        north = max(north, geo.tile_y_to_lat(y - margin, z))
+        south = min(south, geo.tile_y_to_lat(y + 1 + margin, z))
+
+        queryset = Address.objects.filter(
+            latitude__range=(south, north),
+            longitude__range=(west, east),
+        )
+        if not self.request.user.is_authenticated:
+            queryset = queryset.filter(entity__published=True)
+
+        layer = mvt.Layer(self.layer_name, z, x, y)
+        for pk, lng, lat, category, evaluation, published in queryset.values_list(
+            'pk',
+            'longitude',
+            'latitude',
+            'entity__category__slug',
+            'entity__evaluation',
+            'entity__published',
+        ).iterator():
+            layer.add_point(
+                lng,
+                lat,
+                {'category': category, 'evaluation': evaluation, 'published': published},
+                id=pk,
+            )
+        return mvt.encode_tile([layer])
+
+
+class MapView(PageCacheMixin, TemplateView):
     template_name = 'map/map.html'
 
+    def get_page_scopes(self) -> list[str]:
+        # I dati vengono scaricati a parte: la pagina cambia solo con categorie e valutazioni
+        return []
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = [
-            {'name': cat.name, 'icon': cat.icon, 'url': cat.url}
-            for cat in Category.objects.all()
-        ]
+        tables = reference.get()
+        context['categories'] = tables.map_categories
         context['color_map'] = dict(
-            {level.short_name: level.color for level in EvaluationLevel.objects.all()},
+            {short_name: level.color for short_name, level in tables.evaluations.items()},
             default=app_settings.get('DEFAULT_MARKER_COLOR'),
         )
+        context['data_url'] = reverse('djeography:data_all')
+        context['popups_url'] = reverse('djeography:popups')
+        context['places_url'] = reverse('djeography:places')
+        context['places_fallback'] = app_settings['PLACES_PHOTON_FALLBACK']
+        context['viewport_min_zoom'] = app_settings['VIEWPORT_MIN_ZOOM']
+        context['server_clustering'] = app_settings['SERVER_CLUSTERING']
         return context
 
     @xframe_options_sameorigin
@@ -170,19 +720,135 @@ class MapView(TemplateView):
         return super().render_to_response(context, **response_kwargs)
 
 
-class PopupView(DetailView):
+class PopupView(ConditionalResponseMixin, DetailView):
+    """
+    Popup di un indirizzo.
+
+    L'HTML generato viene salvato in cache insieme alla versione dell'indirizzo,
+    che viene aggiornata anche quando cambiano la segnalazione, i suoi contatti
+    o le sue testimonianze: finché la versione non cambia la vista non
+    interroga il database.
+    """
+
     model = Address
     template_name = 'map/popup.html'
 
+    def get(self, request, *args, **kwargs):
+        # L'ETag dipende dal livello di visibilità e dalle versioni del contenuto
+        key = f'djeography:popup:{self.kwargs["pk"]}:{self.etag}'
+        content = cache.get(key)
+        if content is None:
+            content = super().get(request, *args, **kwargs).rendered_content
+            cache.set(key, content, timeout=app_settings['POPUP_CACHE_TIMEOUT'])
+        return HttpResponse(content)
+
+    def get_version_scopes(self) -> list[str]:
+        return [versions.address_scope(self.kwargs['pk'])]
+
     def get_queryset(self):
         return (
             super()
             .get_queryset()
-            .select_related(
-                'entity__category',
-            )
-            .annotate(
-                entity_latest_update=Max('entity__report__date_added'),
-                entity_n_reports=Count('entity__report'),
-            )
+            .only('road', 'number', 'city', 'province', 'entity')
+            .prefetch_related(Prefetch('entity', queryset=Entity.objects.for_popup()))
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # La categoria viene dalle tabelle di riferimento, senza join
+        context['category'] = reference.get().categories_by_pk[self.object.entity.category_id]
+        return context
+
+
+@method_decorator(gzip_page, name='dispatch')
+class PopupBatchView(ViewportMixin, ConditionalResponseMixin, View):
+    """
+    Dati dei popup di più indirizzi in formato JSON, per generarli nel browser.
+
+    Accetta una lista di id (``ids=1,2,3``) oppure un'area (``bbox`` e
+    ``zoom``, come il GeoJSON); restituisce un oggetto che associa l'id di
+    ogni indirizzo ai dati del suo popup. Vengono restituiti al più
+    ``max_popups`` indirizzi.
+    """
+
+    max_popups = 500
+
+    def get_version_scopes(self) -> list[str]:
+        return [versions.DATASET_SCOPE]
+
+    def get_ids(self) -> list[int] | None:
+        raw = self.request.GET.get('ids')
+        if not raw:
+            return None
+        try:
+            ids = [int(pk) for pk in raw.split(',')]
+        except ValueError as err:
+            raise SuspiciousOperation('Invalid ids parameter.') from err
+        if len(ids) > self.max_popups:
+            raise SuspiciousOperation(f'At most {self.max_popups} ids can be requested.')
+        return ids
+
+    def get_queryset(self) -> QuerySet[Address]:
+        ids = self.get_ids()
+        if ids is not None:
+            queryset = Address.objects.filter(pk__in=ids)
+        elif self.viewport is not None:
+            queryset = self.filter_viewport(Address.objects.all())
+        else:
+            raise SuspiciousOperation('Either ids or bbox is required.')
+        if not self.request.user.is_authenticated:
+            queryset = queryset.filter(entity__published=True)
+        return queryset
+
+    def get(self, request, *args, **kwargs):
+        rows = list(
+            self.get_queryset()
+            .order_by('pk')
+            .values(
+                'pk',
+                'road',
+                'number',
+                'city',
+                'province',
+                'entity_id',
+                'entity__title',
+                'entity__published',
+                'entity__description_excerpt',
+                'entity__category_id',
+                'entity__latest_update',
+                'entity__n_reports',
+            )[: self.max_popups],
+        )
+        # I contatti di tutte le segnalazioni con una sola query
+        contacts: dict[int, list[list[str]]] = {}
+        for entity_id, typology, contact in Contact.objects.filter(
+            entity_id__in={row['entity_id'] for row in rows},
+        ).values_list('entity_id', 'typology', 'contact'):
+            contacts.setdefault(entity_id, []).append([typology, contact])
+
+        categories = reference.get().categories_by_pk
+        detail_url = serializers.url_template('djeography:detail')
+        return JsonResponse(
+            {
+                row['pk']: {
+                    'title': row['entity__title'],
+                    'url': detail_url.format(row['entity_id']),
+                    'published': row['entity__published'],
+                    'category': categories[row['entity__category_id']].name,
+                    'road': title(row['road']),
+                    'number': row['number'],
+                    'city': title(row['city']),
+                    'province': row['province'],
+                    'contacts': contacts.get(row['entity_id'], []),
+                    'description': row['entity__description_excerpt'],
+                    'latest_update': {
+                        'datetime': date(row['entity__latest_update'], 'c'),
+                        'text': date(row['entity__latest_update'], 'j F Y'),
+                    }
+                    if row['entity__latest_update']
+                    else None,
+                    'n_reports': row['entity__n_reports'],
+                }
+                for row in rows
+            },
         )
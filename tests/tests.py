@@ -1,9 +1,57 @@
+import asyncio
+import gzip
+import json
+import re
+import shutil
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-
-from djeography import app_settings
-from djeography.models import Category, Contact, Entity, EvaluationLevel
+from django.views.generic import View
+
+from djeography import (
+    app_settings,
+    caching,
+    clustering,
+    columnar,
+    exporting,
+    facets,
+    gazetteer,
+    geocoding,
+    importing,
+    mvt,
+    pagination,
+    provinces,
+    reference,
+    richtext,
+    search,
+    serializers,
+    versions,
+    views,
+)
+from djeography.models import (
+    Address,
+    Category,
+    Contact,
+    Entity,
+    EvaluationLevel,
+    GeocodeResult,
+    Report,
+)
 
 # Create your tests here.
 
@@ -199,6 +247,14 @@ class MapViewEmptyTest(TestCase):
         self.assertTemplateUsed(response, 'map/map.html')
 
 
+    def test_places_fallback(self):
+        url = reverse('djeography:map_fullscreen')
+        # No third-party place search unless enabled
+        self.assertIs(self.client.get(url).context['places_fallback'], False)
+        with mock.patch.dict(app_settings, {'PLACES_PHOTON_FALLBACK': True}):
+            self.assertIs(self.client.get(url).context['places_fallback'], True)
+
+
 class MapViewPopulatedTest(EntityPopulatedTestCase):
     def test_map_view_url_by_name(self):
         response = self.client.get(reverse('djeography:map_fullscreen'))
@@ -353,3 +409,2067 @@ class EvaluationDataMigrationTest(TestCase):
     def test_evaluation_level_does_not_exist(self):
         with self.assertRaises(EvaluationLevel.DoesNotExist):
             EvaluationLevel.objects.get(short_name='1')
+
+
+class AddressPopulatedTestCase(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        """Add an address to the published entity and start from an empty cache."""
+        super().setUp()
+        cache.clear()
+        self.address = Address.objects.create(
+            city='Milano',
+            province='MI',
+            coords={'type': 'Point', 'coordinates': [9.19, 45.46]},
+            entity=self.pub_entity,
+        )
+        self.data_url = reverse('djeography:data', kwargs={'slug': self.cat.slug})
+        self.popup_url = reverse('djeography:popup', kwargs={'pk': self.address.pk})
+
+
+class ConditionalGetTest(AddressPopulatedTestCase):
+    def test_geojson_has_validators(self):
+        response = self.client.get(self.data_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertTrue(response['ETag'].startswith('"'))
+
+    def test_geojson_not_modified(self):
+        etag = self.client.get(self.data_url)['ETag']
+        response = self.client.get(self.data_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_popup_not_modified(self):
+        etag = self.client.get(self.popup_url)['ETag']
+        response = self.client.get(self.popup_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_geojson_modified_after_save(self):
+        etag = self.client.get(self.data_url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pub_entity.unpublish()
+        response = self.client.get(self.data_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_popup_modified_after_contact_added(self):
+        etag = self.client.get(self.popup_url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Contact.objects.create(typology='E', contact='a@b.it', entity=self.pub_entity)
+        response = self.client.get(self.popup_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_geojson_modified_after_bulk_update(self):
+        etag = self.client.get(self.data_url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Entity.objects.update(published=False)
+            versions.touch_entities([self.pub_entity.pk])
+        response = self.client.get(self.data_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_default_version_scopes(self):
+        class DefaultScopesView(views.ConditionalResponseMixin, View):
+            def get(self, request):
+                return HttpResponse('ok')
+
+        view = DefaultScopesView.as_view()
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        etag = view(request)['ETag']
+        request = RequestFactory().get('/', headers={'if-none-match': etag})
+        request.user = AnonymousUser()
+        self.assertEqual(view(request).status_code, 304)
+        # Address data changes invalidate the default validators
+        with self.captureOnCommitCallbacks(execute=True):
+            versions.touch_entities([self.pub_entity.pk])
+        self.assertEqual(view(request).status_code, 200)
+
+    def test_default_page_scopes(self):
+        class DefaultPageView(views.PageCacheMixin, View):
+            pass
+
+        class ConditionalPageView(
+            views.PageCacheMixin,
+            views.ConditionalResponseMixin,
+            View,
+        ):
+            def get_version_scopes(self):
+                return [versions.SEARCH_SCOPE]
+
+        self.assertEqual(
+            DefaultPageView().get_page_scopes(),
+            [versions.DATASET_SCOPE, versions.LIST_SCOPE],
+        )
+        self.assertEqual(ConditionalPageView().get_page_scopes(), [versions.SEARCH_SCOPE])
+
+    def test_initial_versions_expire(self):
+        scope = versions.category_scope('no-such-category')
+        with mock.patch.object(versions.cache, 'add', wraps=versions.cache.add) as add:
+            versions.get_versions(scope)
+        add.assert_any_call(
+            versions.VERSION_KEY_PREFIX + scope,
+            mock.ANY,
+            timeout=versions.INITIAL_VERSION_TIMEOUT,
+        )
+        # Bumped versions do not expire
+        with (
+            mock.patch.object(versions.cache, 'set_many') as set_many,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            versions.bump(scope)
+        self.assertIsNone(set_many.call_args.kwargs['timeout'])
+
+    def test_validators_differ_by_visibility(self):
+        anon_etag = self.client.get(self.data_url)['ETag']
+        self.client.login(username='test', password='test')
+        response = self.client.get(self.data_url, headers={'if-none-match': anon_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], anon_etag)
+
+
+class GeoJSONCacheTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.draft_address = Address.objects.create(
+            city='Torino',
+            province='TO',
+            coords={'type': 'Point', 'coordinates': [7.68, 45.07]},
+            entity=self.entity,
+        )
+
+    def test_cached_response_skips_database(self):
+        first = self.client.get(self.data_url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.data_url)
+        self.assertEqual(first.content, second.content)
+
+    def test_cache_separated_by_visibility(self):
+        anon = self.client.get(self.data_url).json()
+        self.client.login(username='test', password='test')
+        auth = self.client.get(self.data_url).json()
+        self.assertEqual(len(anon['features']), 1)
+        self.assertEqual(len(auth['features']), 2)
+
+    def test_cache_rebuilt_after_change(self):
+        self.client.get(self.data_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.entity.publish()
+        response = self.client.get(self.data_url)
+        self.assertEqual(len(response.json()['features']), 2)
+
+    def test_stale_copy_served_during_rebuild(self):
+        caching.get_or_build('test-key', 'v1', lambda: 'old')
+        cache.add('test-key:lock', 'v2')
+        token, value = caching.get_or_build('test-key', 'v2', lambda: 'new')
+        self.assertEqual((token, value), ('v1', 'old'))
+        cache.delete('test-key:lock')
+        token, value = caching.get_or_build('test-key', 'v2', lambda: 'new')
+        self.assertEqual((token, value), ('v2', 'new'))
+
+
+class GeoJSONSerializerTest(AddressPopulatedTestCase):
+    def test_feature_format(self):
+        feature = self.client.get(self.data_url).json()['features'][0]
+        self.assertEqual(
+            feature,
+            {
+                'type': 'Feature',
+                'properties': {
+                    'evaluation': None,
+                    'published': True,
+                    'popupUrl': self.popup_url,
+                    'model': 'djeography.address',
+                },
+                'id': self.address.pk,
+                'geometry': {'type': 'Point', 'coordinates': [9.19, 45.46]},
+            },
+        )
+
+    def test_streamed_in_chunks(self):
+        for i in range(4):
+            Address.objects.create(
+                city='Milano',
+                province='MI',
+                coords={'type': 'Point', 'coordinates': [9.19 + i / 100, 45.46]},
+                entity=self.pub_entity,
+            )
+        chunks = list(
+            serializers.stream_addresses(
+                Address.objects.all(),
+                {'published': 'entity__published'},
+                chunk_size=2,
+            ),
+        )
+        # Intestazione, tre blocchi (2 + 2 + 1 feature) e chiusura
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(len(json.loads(b''.join(chunks))['features']), 5)
+
+
+class ViewportTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        Address.objects.create(
+            city='Palermo',
+            province='PA',
+            coords={'type': 'Point', 'coordinates': [13.36, 38.12]},
+            entity=self.pub_entity,
+        )
+
+    def test_coordinates_synced_on_save(self):
+        self.assertEqual(self.address.latitude, 45.46)
+        self.assertEqual(self.address.longitude, 9.19)
+        self.address.coords = {'type': 'Point', 'coordinates': [7.68, 45.07]}
+        self.address.save(update_fields=['coords'])
+        self.address.refresh_from_db()
+        self.assertEqual(self.address.longitude, 7.68)
+
+    def test_geojson_without_bbox(self):
+        response = self.client.get(self.data_url)
+        self.assertEqual(len(response.json()['features']), 2)
+
+    def test_geojson_bbox(self):
+        # Senza zoom la risposta non viene salvata in cache e arriva in streaming
+        response = self.client.get(self.data_url, {'bbox': '8,45,10,46'})
+        features = json.loads(b''.join(response.streaming_content))['features']
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['geometry']['coordinates'], [9.19, 45.46])
+
+    def test_geojson_bbox_snapped_to_zoom(self):
+        # Allo zoom 2 l'area viene allargata a una tile che contiene anche Palermo
+        response = self.client.get(self.data_url, {'bbox': '9,45,9.5,45.5', 'zoom': 5})
+        self.assertEqual(len(response.json()['features']), 1)
+        response = self.client.get(self.data_url, {'bbox': '9,45,9.5,45.5', 'zoom': 2})
+        self.assertEqual(len(response.json()['features']), 2)
+
+    def test_geojson_invalid_bbox(self):
+        response = self.client.get(self.data_url, {'bbox': '10,46,8'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.data_url, {'bbox': '8,45,10,46', 'zoom': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ClusterTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.neg = EvaluationLevel.objects.get(short_name='NEG')
+        negative_entity = Entity.objects.create(
+            category=self.cat,
+            title='Negative',
+            evaluation=self.neg,
+            published=True,
+        )
+        Address.objects.create(
+            city='Milano',
+            province='MI',
+            coords={'type': 'Point', 'coordinates': [9.2, 45.47]},
+            entity=negative_entity,
+        )
+        self.clusters_url = reverse('djeography:clusters', kwargs={'slug': self.cat.slug})
+
+    def test_clusters_at_low_zoom(self):
+        response = self.client.get(self.clusters_url, {'zoom': 5})
+        self.assertEqual(response.status_code, 200)
+        features = response.json()['features']
+        self.assertEqual(len(features), 1)
+        properties = features[0]['properties']
+        self.assertTrue(properties['cluster'])
+        self.assertEqual(properties['count'], 2)
+        self.assertEqual(properties['evaluations'], {'default': 1, 'NEG': 1})
+
+    def test_points_past_max_zoom(self):
+        zoom = app_settings['CLUSTER_MAX_ZOOM'] + 1
+        response = self.client.get(self.clusters_url, {'zoom': zoom})
+        features = response.json()['features']
+        self.assertEqual(len(features), 2)
+        self.assertIn('popupUrl', features[0]['properties'])
+
+    def test_clusters_bbox(self):
+        response = self.client.get(self.clusters_url, {'zoom': 5, 'bbox': '10,38,15,40'})
+        self.assertEqual(response.json()['features'], [])
+
+    def test_clusters_require_zoom(self):
+        response = self.client.get(self.clusters_url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_clusters_hide_drafts(self):
+        Address.objects.create(
+            city='Milano',
+            province='MI',
+            coords={'type': 'Point', 'coordinates': [9.21, 45.46]},
+            entity=self.entity,
+        )
+        response = self.client.get(self.clusters_url, {'zoom': 5})
+        self.assertEqual(response.json()['features'][0]['properties']['count'], 2)
+
+    def test_unknown_category(self):
+        url = reverse('djeography:clusters', kwargs={'slug': 'no-such-category'})
+        response = self.client.get(url, {'zoom': 5})
+        self.assertEqual(response.status_code, 404)
+        # No version is created for the unknown category
+        key = versions.VERSION_KEY_PREFIX + versions.category_scope('no-such-category')
+        self.assertIsNone(versions.cache.get(key))
+
+    def test_indexes_are_bounded(self):
+        with mock.patch.object(clustering, '_indexes', OrderedDict()):
+            for key in ('a', 'b', 'a', 'c'):
+                clustering.get_index(key, 'v1', lambda: clustering.ClusterIndex([]), max_size=2)
+            # The least recently used index is dropped
+            self.assertEqual(list(clustering._indexes), ['a', 'c'])
+
+    def test_index_distant_points_not_merged(self):
+        index = clustering.ClusterIndex(
+            [(1, 9.19, 45.46, None, True), (2, 13.36, 38.12, None, True)],
+        )
+        self.assertEqual(len(index.get_clusters((-180, -90, 180, 90), 6)), 2)
+        self.assertEqual(len(index.get_clusters((-180, -90, 180, 90), 0)), 1)
+
+
+class VectorTileTest(AddressPopulatedTestCase):
+    def tile_url(self, z, x, y):
+        return reverse('djeography:tiles', kwargs={'z': z, 'x': x, 'y': y})
+
+    def test_tile_contains_address(self):
+        # Milano cade nella tile 4/8/5
+        response = self.client.get(self.tile_url(4, 8, 5))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn(b'addresses', response.content)
+        self.assertIn(self.cat.slug.encode(), response.content)
+
+    def test_empty_tile(self):
+        response = self.client.get(self.tile_url(4, 0, 0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+
+    def test_tile_out_of_range(self):
+        response = self.client.get(self.tile_url(2, 4, 0))
+        self.assertEqual(response.status_code, 404)
+
+    def test_tile_not_modified(self):
+        etag = self.client.get(self.tile_url(4, 8, 5))['ETag']
+        response = self.client.get(self.tile_url(4, 8, 5), headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pub_entity.unpublish()
+        response = self.client.get(self.tile_url(4, 8, 5), headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+
+    def test_point_encoding(self):
+        layer = mvt.Layer('addresses', 0, 0, 0)
+        layer.add_point(0.0, 0.0, {'published': True}, id=1)
+        # La feature è al centro della tile: MoveTo(1) con dx = dy = 2048 (zigzag 4096)
+        self.assertIn(bytes([0x22, 0x05, 0x09, 0x80, 0x20, 0x80, 0x20]), layer.encode())
+
+
+class GeoJSONAllCategoriesTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.other_cat = Category.objects.create(name='other')
+        other_entity = Entity.objects.create(
+            category=self.other_cat,
+            title='Other',
+            published=True,
+        )
+        Address.objects.create(
+            city='Palermo',
+            province='PA',
+            coords={'type': 'Point', 'coordinates': [13.36, 38.12]},
+            entity=other_entity,
+        )
+        Address.objects.create(
+            city='Torino',
+            province='TO',
+            coords={'type': 'Point', 'coordinates': [7.68, 45.07]},
+            entity=self.entity,
+        )
+        self.all_url = reverse('djeography:data_all')
+
+    def get_features(self, *args, **kwargs):
+        response = self.client.get(self.all_url, *args, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content))['features']
+
+    def test_all_categories_in_one_query(self):
+        with self.assertNumQueries(1):
+            features = self.get_features()
+        self.assertEqual(
+            sorted(feature['properties']['category'] for feature in features),
+            [self.other_cat.slug, self.cat.slug],
+        )
+
+    def test_drafts_only_for_authenticated(self):
+        self.client.login(username='test', password='test')
+        self.assertEqual(len(self.get_features()), 3)
+
+    def test_bbox(self):
+        features = self.get_features({'bbox': '8,45,10,46'})
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['properties']['popupUrl'], self.popup_url)
+
+    def test_not_modified(self):
+        etag = self.client.get(self.all_url)['ETag']
+        response = self.client.get(self.all_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 304)
+
+
+def decode_columnar(content):
+    """Decode the columnar points format (see djeography/columnar.py)."""
+    assert content[:4] == columnar.MAGIC
+    count, scale = struct.unpack_from('<Id', content, 4)
+    offset = 16
+
+    def read_string():
+        nonlocal offset
+        (length,) = struct.unpack_from('<H', content, offset)
+        value = content[offset + 2 : offset + 2 + length].decode()
+        offset += 2 + length
+        return value
+
+    def read_strings():
+        nonlocal offset
+        (length,) = struct.unpack_from('<H', content, offset)
+        offset += 2
+        return [read_string() for _ in range(length)]
+
+    def column(code, size):
+        nonlocal offset
+        offset += -offset % 4
+        values = struct.unpack_from(f'<{count}{code}', content, offset)
+        offset += count * size
+        return values
+
+    popup_url, evaluations, categories = read_string(), read_strings(), read_strings()
+    columns = zip(
+        column('i', 4),
+        column('i', 4),
+        column('i', 4),
+        column('H', 2),
+        column('H', 2),
+        column('B', 1),
+    )
+    points, pk, lng, lat = [], 0, 0, 0
+    for d_pk, d_lng, d_lat, evaluation, category, published in columns:
+        pk, lng, lat = pk + d_pk, lng + d_lng, lat + d_lat
+        points.append(
+            {
+                'id': pk,
+                'coordinates': [lng / scale, lat / scale],
+                'evaluation': evaluations[evaluation] or None,
+                'category': categories[category],
+                'published': bool(published),
+                'popupUrl': popup_url.replace('{}', str(pk)),
+            },
+        )
+    return points
+
+
+class ColumnarFormatTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.second = Address.objects.create(
+            city='Palermo',
+            province='PA',
+            coords={'type': 'Point', 'coordinates': [13.361389, 38.115556]},
+            entity=Entity.objects.create(
+                category=self.cat,
+                title='Third',
+                evaluation=EvaluationLevel.objects.get(short_name='POS'),
+                published=True,
+            ),
+        )
+
+    def test_geojson_is_default(self):
+        response = self.client.get(self.data_url)
+        self.assertEqual(response['Content-Type'], 'application/geo+json')
+
+    def test_columnar_by_query_parameter(self):
+        response = self.client.get(self.data_url, {'format': 'columnar'})
+        self.assertEqual(response['Content-Type'], columnar.MEDIA_TYPE)
+        points = decode_columnar(response.content)
+        self.assertEqual(
+            points,
+            [
+                {
+                    'id': self.address.pk,
+                    'coordinates': [9.19, 45.46],
+                    'evaluation': None,
+                    'category': self.cat.slug,
+                    'published': True,
+                    'popupUrl': self.popup_url,
+                },
+                {
+                    'id': self.second.pk,
+                    'coordinates': [13.36139, 38.11556],
+                    'evaluation': 'POS',
+                    'category': self.cat.slug,
+                    'published': True,
+                    'popupUrl': self.second.popupUrl,
+                },
+            ],
+        )
+
+    def test_columnar_by_accept_header(self):
+        response = self.client.get(self.data_url, headers={'accept': columnar.MEDIA_TYPE})
+        self.assertEqual(response['Content-Type'], columnar.MEDIA_TYPE)
+        self.assertIn('Accept', response['Vary'])
+
+    def test_validators_differ_by_format(self):
+        etag = self.client.get(self.data_url)['ETag']
+        response = self.client.get(
+            self.data_url,
+            {'format': 'columnar'},
+            headers={'if-none-match': etag},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_columnar_all_categories(self):
+        url = reverse('djeography:data_all')
+        response = self.client.get(url, {'format': 'columnar', 'bbox': '8,45,10,46'})
+        points = decode_columnar(b''.join(response.streaming_content))
+        self.assertEqual([point['id'] for point in points], [self.address.pk])
+
+
+class ExportStaticTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output = Path(tmp.name)
+
+    def export(self):
+        call_command('export_static', str(self.output), stdout=StringIO())
+        return json.loads((self.output / 'manifest.json').read_text())
+
+    def test_exported_files(self):
+        manifest = self.export()
+        detail = f'map/entities/{self.pub_entity.pk}/index.html'
+        popup = f'map/popup/{self.address.pk}/index.html'
+        for path in (
+            'map/data.geojson',
+            'map/data.bin',
+            f'map/data/{self.cat.slug}.geojson',
+            'map/fullscreen/index.html',
+            'map/entities/index.html',
+            detail,
+            popup,
+        ):
+            self.assertIn(path, manifest)
+            content = (self.output / path).read_bytes()
+            self.assertEqual(gzip.decompress((self.output / (path + '.gz')).read_bytes()), content)
+        # Unpublished entities are not exported
+        self.assertNotIn(f'map/entities/{self.entity.pk}/index.html', manifest)
+        self.assertIn(b'Milano', (self.output / popup).read_bytes())
+        self.assertIn(b'"/map/data.bin"', (self.output / 'map/fullscreen/index.html').read_bytes())
+        points = decode_columnar((self.output / 'map/data.bin').read_bytes())
+        self.assertEqual([point['id'] for point in points], [self.address.pk])
+
+    def test_pagination_links(self):
+        for i in range(2 * app_settings['PAGINATION']):
+            Entity.objects.create(category=self.cat, title=f'E{i}', published=True)
+        manifest = self.export()
+        # Follow the links from the first page: every page is reached through a file
+        seen, pending = set(), ['/map/entities/']
+        while pending:
+            url = pending.pop()
+            seen.add(url)
+            path = url.lstrip('/') + 'index.html'
+            self.assertIn(path, manifest)
+            html = (self.output / path).read_text()
+            self.assertNotIn('?page=', html)
+            self.assertNotIn('?cursor=', html)
+            for link in re.findall(r'href="(/map/entities/(?:page/\d+/)?)"', html):
+                if link not in seen:
+                    pending.append(link)
+        self.assertEqual(
+            seen,
+            {'/map/entities/', '/map/entities/page/2/', '/map/entities/page/3/'},
+        )
+
+    @mock.patch.dict(app_settings, {'PAGINATION_MODE': 'cursor'})
+    def test_cursor_mode(self):
+        for i in range(app_settings['PAGINATION']):
+            Entity.objects.create(category=self.cat, title=f'E{i}', published=True)
+        manifest = self.export()
+        self.assertIn('map/entities/page/2/index.html', manifest)
+        self.assertNotIn('cursor=', (self.output / 'map/entities/index.html').read_text())
+
+    def test_only_changed_files_are_rewritten(self):
+        self.export()
+        popup = self.output / f'map/popup/{self.address.pk}/index.html'
+        data = self.output / 'map/data.geojson'
+        popup_mtime = popup.stat().st_mtime_ns
+        with self.captureOnCommitCallbacks(execute=True):
+            Address.objects.create(
+                city='Torino',
+                province='TO',
+                coords={'type': 'Point', 'coordinates': [7.68, 45.07]},
+                entity=self.pub_entity,
+            )
+        self.export()
+        self.assertEqual(popup.stat().st_mtime_ns, popup_mtime)
+        self.assertIn(b'7.68', data.read_bytes())
+
+    def test_removed_entities_are_deleted(self):
+        self.export()
+        detail = self.output / f'map/entities/{self.pub_entity.pk}/index.html'
+        self.assertTrue(detail.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pub_entity.unpublish()
+        self.export()
+        self.assertFalse(detail.exists())
+        self.assertFalse(detail.with_name('index.html.gz').exists())
+
+
+class PopupBatchTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.url = reverse('djeography:popups')
+        self.draft_address = Address.objects.create(
+            city='Roma',
+            province='RM',
+            coords={'type': 'Point', 'coordinates': [12.5, 41.9]},
+            entity=self.entity,
+        )
+        Contact.objects.create(typology='E', contact='a@b.it', entity=self.pub_entity)
+        Report.objects.create(entity=self.pub_entity, title='Report', date_added='2024-03-05')
+        Report.objects.create(entity=self.pub_entity, title='Report', date_added='2024-01-02')
+
+    def test_popup_data(self):
+        # Reference tables are loaded once per process
+        reference.get()
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {'ids': self.address.pk})
+        self.assertEqual(
+            response.json(),
+            {
+                str(self.address.pk): {
+                    'title': 'Second test title',
+                    'url': self.pub_entity.get_absolute_url(),
+                    'published': True,
+                    'category': 'test',
+                    'road': '',
+                    'number': '',
+                    'city': 'Milano',
+                    'province': 'MI',
+                    'contacts': [['E', 'a@b.it']],
+                    'description': 'Some description',
+                    'latest_update': {'datetime': '2024-03-05', 'text': '5 March 2024'},
+                    'n_reports': 2,
+                },
+            },
+        )
+
+    def test_drafts_visible_only_to_authenticated_users(self):
+        ids = f'{self.address.pk},{self.draft_address.pk}'
+        response = self.client.get(self.url, {'ids': ids})
+        self.assertEqual(list(response.json()), [str(self.address.pk)])
+        self.client.login(username='test', password='test')
+        response = self.client.get(self.url, {'ids': ids})
+        self.assertEqual(len(response.json()), 2)
+
+    def test_viewport(self):
+        self.client.login(username='test', password='test')
+        response = self.client.get(self.url, {'bbox': '12,41,13,42', 'zoom': 8})
+        self.assertEqual(list(response.json()), [str(self.draft_address.pk)])
+
+    def test_invalid_parameters(self):
+        for params in ({}, {'ids': '1,a'}, {'ids': ','.join(['1'] * 501)}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.url, {'ids': self.address.pk})['ETag']
+        response = self.client.get(
+            self.url,
+            {'ids': self.address.pk},
+            headers={'if-none-match': etag},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_cluster_points_have_ids(self):
+        response = self.client.get(
+            reverse('djeography:clusters', kwargs={'slug': self.cat.slug}),
+            {'zoom': 20},
+        )
+        self.assertEqual(response.json()['features'][0]['id'], self.address.pk)
+
+
+class PopupCacheTest(AddressPopulatedTestCase):
+    def test_cache_hit_skips_database(self):
+        first = self.client.get(self.popup_url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.popup_url)
+        self.assertEqual(second.content, first.content)
+
+    def test_invalidated_by_related_rows(self):
+        self.client.get(self.popup_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            Contact.objects.create(typology='E', contact='a@b.it', entity=self.pub_entity)
+        self.assertContains(self.client.get(self.popup_url), 'a@b.it')
+        with self.captureOnCommitCallbacks(execute=True):
+            Report.objects.create(entity=self.pub_entity, title='Report')
+        self.assertContains(self.client.get(self.popup_url), 'Leggi (1)')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pub_entity.title = 'Renamed'
+            self.pub_entity.save()
+        self.assertContains(self.client.get(self.popup_url), 'Renamed')
+
+    def test_missing_address(self):
+        response = self.client.get(reverse('djeography:popup', kwargs={'pk': 999}))
+        self.assertEqual(response.status_code, 404)
+
+
+class ReportStatsTest(EntityPopulatedTestCase):
+    def assertStats(self, entity, latest_update, n_reports):
+        entity.refresh_from_db()
+        self.assertEqual(
+            (str(entity.latest_update) if entity.latest_update else None, entity.n_reports),
+            (latest_update, n_reports),
+        )
+
+    def test_create_update_delete(self):
+        report = Report.objects.create(entity=self.entity, title='A', date_added='2024-01-02')
+        Report.objects.create(entity=self.entity, title='B', date_added='2024-03-05')
+        self.assertStats(self.entity, '2024-03-05', 2)
+        report.date_added = '2024-06-07'
+        report.save()
+        self.assertStats(self.entity, '2024-06-07', 2)
+        report.delete()
+        self.assertStats(self.entity, '2024-03-05', 1)
+
+    def test_moved_report(self):
+        report = Report.objects.create(entity=self.entity, title='A', date_added='2024-01-02')
+        report.entity = self.pub_entity
+        report.save()
+        self.assertStats(self.entity, None, 0)
+        self.assertStats(self.pub_entity, '2024-01-02', 1)
+
+    def test_bulk_operations(self):
+        Report.objects.bulk_create(
+            [
+                Report(entity=self.entity, title='A', date_added='2024-01-02'),
+                Report(entity=self.entity, title='B', date_added='2024-03-05'),
+            ],
+        )
+        self.assertStats(self.entity, '2024-03-05', 2)
+        Report.objects.filter(title='B').update(entity=self.pub_entity)
+        self.assertStats(self.entity, '2024-01-02', 1)
+        self.assertStats(self.pub_entity, '2024-03-05', 1)
+        reports = list(Report.objects.order_by('pk'))
+        reports[0].date_added = '2025-01-01'
+        Report.objects.bulk_update(reports, ['date_added'])
+        self.assertStats(self.entity, '2025-01-01', 1)
+        Report.objects.all().delete()
+        self.assertStats(self.entity, None, 0)
+        self.assertStats(self.pub_entity, None, 0)
+
+    def test_rebuild_command(self):
+        Report.objects.create(entity=self.entity, title='A', date_added='2024-01-02')
+        Entity.objects.update(latest_update=None, n_reports=0)
+        call_command('rebuild_report_stats', stdout=StringIO())
+        self.assertStats(self.entity, '2024-01-02', 1)
+        self.assertStats(self.pub_entity, None, 0)
+
+    def test_list_ordering(self):
+        Report.objects.create(entity=self.pub_entity, title='A', date_added='2024-01-02')
+        newer = Entity.objects.create(category=self.cat, title='Newer', published=True)
+        Report.objects.create(entity=newer, title='B', date_added='2024-03-05')
+        other = Entity.objects.create(category=self.cat, title='No reports', published=True)
+        response = self.client.get(reverse('djeography:list'))
+        self.assertEqual(
+            [entity.pk for entity in response.context['entities']],
+            [newer.pk, self.pub_entity.pk, other.pk],
+        )
+
+
+class SearchTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+        self.cafe = Entity.objects.create(
+            category=self.cat,
+            title='Caffè della Città',
+            description='<p>Un bar <strong>accogliente</strong></p>',
+            published=True,
+        )
+        for city in ('Milano', 'Monza'):
+            Address.objects.create(
+                city=city,
+                road='Via Dante',
+                province='MI',
+                coords={'type': 'Point', 'coordinates': [9.19, 45.46]},
+                entity=self.cafe,
+            )
+        self.bakery = Entity.objects.create(
+            category=self.cat,
+            title='Panificio',
+            description='Vicino al caffè',
+            published=True,
+        )
+        Report.objects.create(entity=self.bakery, title='Visita', body='Pane ottimo')
+
+    def search(self, text, backend=None):
+        queryset = Entity.objects.all()
+        results = (backend or search.get_backend()).search(queryset, text)
+        return list(results.order_by('-search_rank', 'id').values_list('pk', flat=True))
+
+    def test_backend(self):
+        self.assertIsInstance(search.get_backend(), search.SQLiteBackend)
+
+    def test_normalize(self):
+        self.assertEqual(
+            search.tokenize("<b>L'Aquila</b> è più CITTÀ"),
+            ['l', 'aquila', 'e', 'piu', 'citta'],
+        )
+
+    def test_search(self):
+        for backend in (search.SQLiteBackend(), search.InvertedIndexBackend()):
+            with self.subTest(backend=type(backend).__name__):
+                # Accents, prefixes, places, descriptions and reports
+                self.assertEqual(self.search('citta', backend), [self.cafe.pk])
+                self.assertEqual(self.search('MIL', backend), [self.cafe.pk])
+                self.assertEqual(self.search('dante monza', backend), [self.cafe.pk])
+                self.assertEqual(self.search('accogliente', backend), [self.cafe.pk])
+                self.assertEqual(self.search('pane', backend), [self.bakery.pk])
+                # Title matches rank higher than description matches
+                self.assertEqual(self.search('caffe', backend), [self.cafe.pk, self.bakery.pk])
+                self.assertEqual(self.search('?!', backend), [])
+
+    def test_typos(self):
+        for backend in (search.SQLiteBackend(), search.InvertedIndexBackend()):
+            with self.subTest(backend=type(backend).__name__):
+                self.assertEqual(self.search('panifico', backend), [self.bakery.pk])
+                self.assertEqual(self.search('acoglinte', backend), [self.cafe.pk])
+                self.assertEqual(self.search('milamo monza', backend), [self.cafe.pk])
+                # Short words and words too different are not corrected
+                self.assertEqual(self.search('pano', backend), [self.bakery.pk])
+                self.assertEqual(self.search('bor', backend), [])
+                self.assertEqual(self.search('panetteria', backend), [])
+
+    def test_vocabulary(self):
+        vocabulary = search.Vocabulary(['caffe', 'citta', 'cittadella', 'pane'])
+        self.assertEqual(vocabulary.completions('citta'), ['citta', 'cittadella'])
+        self.assertEqual(vocabulary.similar('cita'), ['citta'])
+        self.assertEqual(vocabulary.similar('citadela'), ['cittadella'])
+        self.assertEqual(search.edit_distance('pane', 'pani', 1), 1)
+        self.assertEqual(search.edit_distance('pane', 'caffe', 1), 2)
+
+    def test_max_results(self):
+        backend = search.InvertedIndexBackend()
+        with mock.patch.dict(app_settings, {'SEARCH_MAX_RESULTS': 1}):
+            self.assertEqual(self.search('caffe', backend), [self.cafe.pk])
+        with mock.patch.dict(app_settings, {'SEARCH_MAX_RESULTS': None}):
+            self.assertEqual(self.search('caffe', backend), [self.cafe.pk, self.bakery.pk])
+
+    def test_documents_follow_changes(self):
+        backend = search.InvertedIndexBackend()
+        self.assertEqual(self.search('forno', backend), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bakery.title = 'Forno'
+            self.bakery.save()
+        self.assertEqual(self.search('forno'), [self.bakery.pk])
+        self.assertEqual(self.search('forno', backend), [self.bakery.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            Report.objects.filter(entity=self.bakery).delete()
+        self.assertEqual(self.search('pane'), [])
+        self.assertEqual(self.search('pane', backend), [])
+        self.cafe.delete()
+        self.assertEqual(self.search('citta'), [])
+
+    def test_list_view(self):
+        response = self.client.get(reverse('djeography:list'), {'search': 'caffe'})
+        self.assertEqual(
+            [entity.pk for entity in response.context['entities']],
+            [self.cafe.pk, self.bakery.pk],
+        )
+
+    def test_rebuild_command(self):
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.search('citta'), [self.cafe.pk])
+
+
+@mock.patch.dict(app_settings, {'PAGINATION_MODE': 'cursor'})
+class CursorPaginationTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Published entities with and without reports, plus the draft from setUp
+        dates = ['2024-01-01', '2024-03-01', '2024-03-01', None, None, '2024-02-01'] * 2
+        for i, date_added in enumerate(dates):
+            entity = Entity.objects.create(category=self.cat, title=f'E{i}', published=True)
+            if date_added:
+                Report.objects.create(entity=entity, title='R', date_added=date_added)
+        self.client.login(username='test', password='test')
+        self.url = reverse('djeography:list')
+        self.expected = list(
+            Entity.objects.order_by(*pagination.ORDERING).values_list('pk', flat=True),
+        )
+
+    def walk(self):
+        pages, cursor = [], None
+        while True:
+            response = self.client.get(self.url, {'cursor': cursor} if cursor else {})
+            page = response.context['page_obj']
+            pages.append([entity.pk for entity in page])
+            cursor = page.next_cursor
+            if cursor is None:
+                return pages, page
+
+    def test_forward_and_back(self):
+        pages, last = self.walk()
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual(len(pages), 3)
+        # Walk back from the last page to the first
+        back, cursor = [], last.previous_cursor
+        while cursor:
+            page = self.client.get(self.url, {'cursor': cursor}).context['page_obj']
+            back.insert(0, [entity.pk for entity in page])
+            cursor = page.previous_cursor
+        self.assertEqual(back, pages[:-1])
+
+    def test_no_count_or_offset(self):
+        # The filter counts are cached by the first request
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        sql = ' '.join(query['sql'] for query in queries).upper()
+        self.assertNotIn('COUNT(', sql)
+        self.assertNotIn('OFFSET', sql)
+        self.assertContains(response, 'Pagina successiva')
+        self.assertNotContains(response, 'Pagina precedente')
+
+    def test_total_from_facets(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Category.objects.create(name='other')
+            Entity.objects.create(category=other, title='Other', published=True)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['paginator'].count, len(self.expected) + 1)
+        self.assertContains(response, f'{len(self.expected) + 1} segnalazioni')
+        response = self.client.get(self.url, {'category': other.slug})
+        self.assertEqual(response.context['paginator'].count, 1)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_uses_pages(self):
+        response = self.client.get(self.url, {'search': 'e'})
+        self.assertEqual(response.context['pagination_mode'], 'pages')
+
+
+class FacetTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+        self.other = Category.objects.create(name='other')
+        self.positive = EvaluationLevel.objects.get(short_name='POS')
+        for province, category in (('MI', self.cat), ('MI', self.other), ('TO', self.cat)):
+            entity = Entity.objects.create(
+                category=category,
+                title='Facet',
+                evaluation=self.positive,
+                published=True,
+            )
+            Address.objects.create(
+                city='Città',
+                province=province,
+                coords={'type': 'Point', 'coordinates': [9.19, 45.46]},
+                entity=entity,
+            )
+        # Two addresses in the same province count once
+        Address.objects.create(
+            city='Milano',
+            province='MI',
+            coords={'type': 'Point', 'coordinates': [9.2, 45.5]},
+            entity=entity,
+        )
+        self.url = reverse('djeography:list')
+
+    def test_counts(self):
+        counts = facets.count_facets(Entity.published_objects.all(), {})
+        self.assertEqual(counts['province'], {'MI': 3, 'TO': 1})
+        self.assertEqual(counts['category'], {self.cat.slug: 3, self.other.slug: 1})
+        self.assertEqual(counts['evaluation'], {'POS': 3})
+
+    def test_counts_apply_other_filters(self):
+        counts = facets.count_facets(Entity.published_objects.all(), {'province': 'TO'})
+        # The province facet ignores its own filter
+        self.assertEqual(counts['province'], {'MI': 3, 'TO': 1})
+        self.assertEqual(counts['category'], {self.cat.slug: 1})
+
+    def test_form_shows_counts_and_hides_empty_options(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Milano (3)</option>')
+        self.assertContains(response, 'Torino (1)</option>')
+        self.assertNotContains(response, 'Roma (')
+
+    def test_tiers(self):
+        self.client.get(self.url)
+        self.client.login(username='test', password='test')
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['facets']['category'][self.cat.slug], 4)
+
+    def test_cached_until_dataset_changes(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.assertNotIn('COUNT(DISTINCT', ' '.join(query['sql'] for query in queries))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.entity.publish()
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['facets']['category'][self.cat.slug], 4)
+
+
+class ReferenceDataTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+
+    def test_loaded_once(self):
+        self.client.get(reverse('djeography:map_fullscreen'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('djeography:map_fullscreen'))
+        self.assertEqual(response.context['categories'][0]['slug'], self.cat.slug)
+        self.assertEqual(
+            response.context['categories'][0]['url'],
+            reverse('djeography:data', kwargs={'slug': self.cat.slug}),
+        )
+
+    def test_list_queries_reference_tables_once(self):
+        self.client.get(reverse('djeography:list'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('djeography:list'))
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('FROM "djeography_category"', sql)
+        self.assertNotIn('FROM "djeography_evaluationlevel"', sql)
+        self.assertEqual(response.context['categories'], {self.cat.slug: self.cat})
+
+    def test_reloaded_when_tables_change(self):
+        self.assertNotIn('new', reference.get().categories)
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='new')
+        self.assertIn('new', reference.get().categories)
+        with self.captureOnCommitCallbacks(execute=True):
+            EvaluationLevel.objects.filter(short_name='POS').get().delete()
+        self.assertNotIn('POS', reference.get().evaluations)
+
+    def test_reloaded_by_other_processes(self):
+        reference.get()
+        # Another process changed a category and bumped the shared version
+        Category.objects.filter(pk=self.cat.pk).update(name='Renamed')
+        versions._set_versions([versions.GLOBAL_SCOPE])
+        self.assertEqual(reference.get().categories[self.cat.slug].name, 'Renamed')
+
+
+@mock.patch.dict(app_settings, {'PAGE_CACHE': True})
+class PageCacheTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.other = Category.objects.create(name='other')
+        self.list_url = reverse('djeography:list')
+        self.detail_url = reverse('djeography:detail', kwargs={'pk': self.pub_entity.pk})
+
+    def test_cache_hit_skips_database(self):
+        for url in (self.list_url, self.detail_url, reverse('djeography:map_fullscreen')):
+            first = self.client.get(url)
+            with self.assertNumQueries(0):
+                second = self.client.get(url)
+            self.assertEqual(second.content, first.content)
+
+    def test_query_is_normalized(self):
+        self.client.get(self.list_url, {'province': 'MI', 'category': self.cat.slug})
+        with self.assertNumQueries(0):
+            self.client.get(
+                self.list_url,
+                {'category': self.cat.slug, 'province': 'MI', 'evaluation': '', 'utm': 'x'},
+            )
+
+    def test_targeted_purge(self):
+        other_list = {'category': self.other.slug}
+        self.client.get(self.detail_url)
+        self.client.get(self.list_url)
+        self.client.get(self.list_url, other_list)
+        with self.captureOnCommitCallbacks(execute=True):
+            Report.objects.create(entity=self.pub_entity, title='Report')
+        self.assertContains(self.client.get(self.detail_url), 'Report')
+        self.assertIn(self.pub_entity, self.client.get(self.list_url).context['entities'])
+        # Lists of other categories cannot contain the entity
+        with self.assertNumQueries(0):
+            self.client.get(self.list_url, other_list)
+
+    def test_publish_purges_lists(self):
+        self.client.get(self.list_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.entity.publish()
+        self.assertContains(self.client.get(self.list_url), self.entity.title)
+
+    def test_authenticated_users_bypass_cache(self):
+        self.client.get(self.detail_url)
+        self.client.login(username='test', password='test')
+        # The page is rendered again (publish buttons, CSRF token) and not stored
+        self.assertTemplateUsed(self.client.get(self.detail_url), 'map/detail.html')
+        self.client.logout()
+        self.assertTemplateNotUsed(self.client.get(self.detail_url), 'map/detail.html')
+
+    def test_errors_not_cached(self):
+        url = reverse('djeography:detail', kwargs={'pk': self.entity.pk})
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.entity.publish()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_disabled_by_default(self):
+        with mock.patch.dict(app_settings, {'PAGE_CACHE': False}):
+            self.client.get(self.detail_url)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(self.detail_url)
+        self.assertTrue(queries)
+
+
+class RichTextTest(EntityPopulatedTestCase):
+    def test_sanitize(self):
+        html, text, excerpt = richtext.render(
+            '<p onclick="x()">Ciao <b>tutti</b> &amp; <script>alert(1)</script>'
+            '<a href="javascript:alert(1)">uno</a> <a href="https://example.com" target="_blank">'
+            'due</a></p><iframe src="x"></iframe><ul><li>tre',
+            excerpt_length=300,
+        )
+        self.assertEqual(
+            html,
+            '<p>Ciao <b>tutti</b> &amp; <a>uno</a> <a href="https://example.com" '
+            'target="_blank" rel="noopener noreferrer">due</a></p><ul><li>tre</li></ul>',
+        )
+        self.assertEqual(text, 'Ciao tutti & uno due tre')
+        self.assertEqual(excerpt, text)
+
+    def test_excerpt(self):
+        self.assertEqual(richtext.excerpt('Una descrizione piuttosto lunga', 20), 'Una descrizione…')
+        self.assertEqual(richtext.excerpt('Breve', 20), 'Breve')
+
+    def test_rendered_on_save(self):
+        self.pub_entity.description = '<p>Nuova <em>descrizione</em></p>'
+        self.pub_entity.save(update_fields=['description'])
+        self.pub_entity.refresh_from_db()
+        self.assertEqual(self.pub_entity.description_html, '<p>Nuova <em>descrizione</em></p>')
+        self.assertEqual(self.pub_entity.description_text, 'Nuova descrizione')
+        report = Report.objects.create(entity=self.pub_entity, title='R', body='<p>Testo</p>')
+        self.assertEqual(report.body_text, 'Testo')
+
+    def test_rendered_on_bulk_operations(self):
+        [report] = Report.objects.bulk_create(
+            [Report(entity=self.pub_entity, title='R', body='<b>uno</b>')],
+        )
+        report.refresh_from_db()
+        self.assertEqual(report.body_html, '<b>uno</b>')
+        report.body = '<i>due</i>'
+        Report.objects.bulk_update([report], ['body'])
+        report.refresh_from_db()
+        self.assertEqual(report.body_text, 'due')
+        Report.objects.filter(pk=report.pk).update(body='tre<script>x</script>')
+        report.refresh_from_db()
+        self.assertEqual(report.body_html, 'tre')
+
+    def test_templates_use_copies(self):
+        with mock.patch.dict(app_settings, {'EXCERPT_LENGTH': 20}):
+            self.pub_entity.description = '<p>Una descrizione <b>piuttosto</b> lunga</p>'
+            self.pub_entity.save()
+        response = self.client.get(reverse('djeography:list'))
+        self.assertContains(response, '<p>Una descrizione…</p>', html=True)
+        self.assertNotContains(response, 'piuttosto')
+        response = self.client.get(self.pub_entity.get_absolute_url())
+        self.assertContains(response, '<b>piuttosto</b>')
+
+    def test_backfill_command(self):
+        Entity.objects.filter(pk=self.pub_entity.pk).update(description='<p>Aggiornata</p>')
+        out = StringIO()
+        call_command('render_rich_text', stdout=out)
+        self.pub_entity.refresh_from_db()
+        self.assertEqual(self.pub_entity.description_excerpt, 'Aggiornata')
+        self.assertIn('2 righe aggiornate', out.getvalue())
+
+
+class QueryProfileTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        Contact.objects.create(typology='E', contact='a@b.it', entity=self.pub_entity)
+        Report.objects.create(entity=self.pub_entity, title='Report', body='<p>Testo</p>')
+        reference.get()
+
+    def captured_sql(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries]
+
+    def test_list(self):
+        sql = self.captured_sql(reverse('djeography:list'))
+        joined = ' '.join(sql)
+        self.assertNotIn('"djeography_entity"."description",', joined)
+        self.assertNotIn('"djeography_entity"."description_html"', joined)
+        # Addresses and contacts are prefetched with one query each
+        self.assertEqual(len([query for query in sql if 'FROM "djeography_address"' in query]), 1)
+        self.assertEqual(len([query for query in sql if 'FROM "djeography_contact"' in query]), 1)
+
+    def test_detail(self):
+        sql = self.captured_sql(self.pub_entity.get_absolute_url())
+        self.assertEqual(len(sql), 4)
+        self.assertNotIn('"djeography_report"."body",', ' '.join(sql))
+
+    def test_popup(self):
+        sql = self.captured_sql(self.popup_url)
+        self.assertEqual(len(sql), 3)
+        self.assertNotIn('"djeography_entity"."description",', ' '.join(sql))
+
+    def test_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Entity.published_objects.for_count().count(), 1)
+        self.assertEqual(len(queries), 1)
+
+    def test_admin(self):
+        entities = list(Entity.objects.for_admin().order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEqual([str(entity.category) for entity in entities], ['test', 'test'])
+            self.assertIsNone(entities[0].evaluation)
+
+
+class ListFilterTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+        for city in ('Milano', 'Monza', 'Roma'):
+            Address.objects.create(
+                city=city,
+                province='RM' if city == 'Roma' else 'MI',
+                coords={'type': 'Point', 'coordinates': [9.19, 45.46]},
+                entity=self.pub_entity,
+            )
+        self.url = reverse('djeography:list')
+
+    def test_entity_listed_once(self):
+        response = self.client.get(self.url, {'province': 'MI'})
+        self.assertEqual(list(response.context['entities']), [self.pub_entity])
+        self.assertEqual(response.context['paginator'].count, 1)
+
+    def test_query_plan_has_no_address_join(self):
+        queryset = facets.filter_entities(
+            Entity.objects.all(),
+            {'province': 'MI', 'category': self.cat.slug, 'evaluation': 'POS'},
+        )
+        sql = str(queryset.query)
+        self.assertIn('EXISTS', sql)
+        self.assertNotIn('JOIN', sql)
+        plan = queryset.explain()
+        # The addresses are only read by the correlated subquery, through the entity index
+        self.assertIn('CORRELATED', plan)
+        self.assertNotIn('USE TEMP B-TREE FOR DISTINCT', plan)
+
+    def test_search_and_filters_combined(self):
+        other = Entity.objects.create(category=self.cat, title='Second other', published=True)
+        Address.objects.create(
+            city='Torino',
+            province='TO',
+            coords={'type': 'Point', 'coordinates': [7.68, 45.07]},
+            entity=other,
+        )
+        response = self.client.get(self.url, {'search': 'second'})
+        self.assertEqual(len(response.context['entities']), 2)
+        response = self.client.get(self.url, {'search': 'second', 'province': 'TO'})
+        self.assertEqual(list(response.context['entities']), [other])
+        # Filter counts follow the search
+        self.assertEqual(response.context['facets']['province'], {'MI': 1, 'RM': 1, 'TO': 1})
+        response = self.client.get(self.url, {'search': 'other'})
+        self.assertEqual(response.context['facets']['province'], {'TO': 1})
+
+    def test_unknown_category(self):
+        response = self.client.get(self.url, {'category': 'missing'})
+        self.assertEqual(list(response.context['entities']), [])
+
+
+class ModerationTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        for i in range(5):
+            Entity.objects.create(category=self.cat, title=f'Draft {i}')
+
+    def test_set_published_in_chunks(self):
+        with (
+            mock.patch.object(Entity.objects._queryset_class, 'moderation_chunk_size', 2),
+            mock.patch.object(versions, 'touch_entities') as touch,
+            CaptureQueriesContext(connection) as queries,
+        ):
+            changed = Entity.objects.all().set_published(True)
+        # The published entity from setUp is left alone
+        self.assertEqual(changed, 6)
+        self.assertEqual(Entity.published_objects.count(), 7)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)
+        touch.assert_called_once()
+        self.assertEqual(len(touch.call_args.args[0]), 6)
+
+    def test_set_published_bumps_versions(self):
+        before = versions.get_versions(versions.category_scope(self.cat.slug))
+        with self.captureOnCommitCallbacks(execute=True):
+            changed = Entity.objects.filter(pk=self.pub_entity.pk).set_published(False)
+        self.assertEqual(changed, 1)
+        self.assertNotEqual(versions.get_versions(versions.category_scope(self.cat.slug)), before)
+
+
+class EstimatedCountTest(EntityPopulatedTestCase):
+    def test_estimate_requires_statistics(self):
+        self.assertIsNone(pagination.estimated_count(Entity.objects.all()))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.assertEqual(pagination.estimated_count(Entity.objects.all()), 2)
+        self.assertIsNone(pagination.estimated_count(Entity.objects.filter(published=True)))
+
+    def test_paginator(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        Entity.objects.create(category=self.cat, title='Not in the statistics yet')
+        paginator = pagination.EstimatedCountPaginator(Entity.objects.order_by('pk'), 10)
+        self.assertEqual(paginator.count, 3)
+        with mock.patch.object(pagination.EstimatedCountPaginator, 'threshold', 0):
+            paginator = pagination.EstimatedCountPaginator(Entity.objects.order_by('pk'), 10)
+            self.assertEqual(paginator.count, 2)
+
+
+IMPORT_CSV = """title;category;evaluation;description;published;road;number;city;province;latitude;longitude;phone;email
+Bakery;test;POS;<p>Fresh <script>x</script>bread</p>;sì;Via Roma;1;Milano;MI;45.46;9.19;02 123;a@example.com
+Market;Test;Mista;;;;;;;;;;
+No category;;;;;;;;;;;;
+Bad province;test;;;;Via Po;2;Torino;XX;45.07;7.68;;
+Bad email;test;;;;;;;;;;;not-an-email
+"""
+
+
+class ImportTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def write(self, name, content):
+        path = Path(self.dir.name) / name
+        path.write_text(content, encoding='utf-8')
+        return str(path)
+
+    def test_csv_import(self):
+        out, err = StringIO(), StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'import_entities',
+                self.write('data.csv', IMPORT_CSV),
+                stdout=out,
+                stderr=err,
+            )
+        self.assertIn('2 segnalazioni importate, 3 righe con errori', out.getvalue())
+        self.assertIn('Riga 4: categoria mancante', err.getvalue())
+        self.assertIn('Riga 5: provincia sconosciuta: XX', err.getvalue())
+        self.assertIn('Riga 6: e-mail non valida', err.getvalue())
+
+        bakery = Entity.objects.get(title='Bakery')
+        self.assertTrue(bakery.published)
+        self.assertEqual(bakery.evaluation_id, 'POS')
+        # Derived data normally filled in by save() and the signals
+        self.assertEqual(bakery.description_html, '<p>Fresh bread</p>')
+        address = bakery.address_set.get()
+        self.assertEqual(
+            (address.province, address.latitude, address.longitude),
+            ('MI', 45.46, 9.19),
+        )
+        self.assertEqual(
+            sorted(bakery.contact_set.values_list('typology', 'contact')),
+            [('E', 'a@example.com'), ('P', '02 123')],
+        )
+        market = Entity.objects.get(title='Market')
+        self.assertFalse(market.published)
+        self.assertEqual(market.evaluation_id, 'MIX')
+        self.assertFalse(market.address_set.exists())
+        self.assertEqual(
+            list(search.search(Entity.objects.all(), 'fresh').values_list('title', flat=True)),
+            ['Bakery'],
+        )
+
+    def test_import_bumps_category_versions(self):
+        before = versions.get_versions(versions.category_scope(self.cat.slug))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'import_entities',
+                self.write('data.csv', IMPORT_CSV),
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        self.assertNotEqual(versions.get_versions(versions.category_scope(self.cat.slug)), before)
+
+    def test_import_indexes_on_its_database(self):
+        # Search documents are written on the database the import targets
+        with mock.patch.object(
+            search,
+            'update_documents',
+            wraps=search.update_documents,
+        ) as update_documents:
+            call_command(
+                'import_entities',
+                self.write('data.csv', IMPORT_CSV),
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        self.assertEqual(update_documents.call_args.kwargs['using'], 'default')
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command(
+            'import_entities',
+            self.write('data.csv', IMPORT_CSV),
+            '--dry-run',
+            stdout=out,
+            stderr=StringIO(),
+        )
+        self.assertIn('2 righe valide, 3 righe con errori', out.getvalue())
+        self.assertEqual(Entity.objects.count(), 2)
+
+    def test_error_report(self):
+        report = Path(self.dir.name) / 'errors.csv'
+        call_command(
+            'import_entities',
+            self.write('data.csv', IMPORT_CSV),
+            '--errors',
+            str(report),
+            stdout=StringIO(),
+            stderr=StringIO(),
+        )
+        rows = report.read_text().splitlines()
+        self.assertEqual(rows[0], 'row,title,error')
+        self.assertEqual(rows[1], '4,No category,categoria mancante')
+        self.assertEqual(len(rows), 4)
+
+    def test_resume_from_checkpoint(self):
+        source = self.write('data.csv', IMPORT_CSV)
+        checkpoint = Path(self.dir.name) / 'data.checkpoint'
+        with mock.patch.object(importing.Importer, '_insert', side_effect=[None, RuntimeError]):
+            # The first batch is saved, the second one fails
+            with self.assertRaises(RuntimeError):
+                call_command(
+                    'import_entities',
+                    source,
+                    '--batch-size',
+                    '1',
+                    '--checkpoint',
+                    str(checkpoint),
+                    stdout=StringIO(),
+                    stderr=StringIO(),
+                )
+        self.assertEqual(json.loads(checkpoint.read_text())['rows'], 1)
+
+        out = StringIO()
+        call_command(
+            'import_entities',
+            source,
+            '--checkpoint',
+            str(checkpoint),
+            stdout=out,
+            stderr=StringIO(),
+        )
+        self.assertIn('1 righe già importate saltate', out.getvalue())
+        # Bakery was imported by the first run and is not imported again
+        self.assertEqual(Entity.objects.filter(title='Bakery').count(), 0)
+        self.assertEqual(Entity.objects.filter(title='Market').count(), 1)
+        self.assertEqual(json.loads(checkpoint.read_text())['rows'], 5)
+
+        # The checkpoint belongs to another file
+        with self.assertRaises(CommandError):
+            call_command(
+                'import_entities',
+                self.write('other.csv', IMPORT_CSV + 'More;test\n'),
+                '--checkpoint',
+                str(checkpoint),
+                stdout=StringIO(),
+            )
+
+    def test_queries_do_not_grow_with_rows(self):
+        def run(n):
+            row = {
+                'category': 'test',
+                'city': 'Roma',
+                'province': 'RM',
+                'latitude': '41.9',
+                'longitude': '12.5',
+                'phone': '06 1',
+            }
+            rows = ((i, {**row, 'title': f'Row {i}'}) for i in range(n))
+            with CaptureQueriesContext(connection) as queries:
+                importing.Importer(batch_size=100).run(rows)
+            return len(queries)
+
+        reference.get()
+        self.assertEqual(run(3), run(30))
+        self.assertEqual(Address.objects.filter(latitude=41.9).count(), 33)
+
+    def test_geojson_streaming(self):
+        collection = {
+            'type': 'FeatureCollection',
+            'name': 'partner data',
+            'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}},
+            'features': [
+                {
+                    'type': 'Feature',
+                    'geometry': {'type': 'Point', 'coordinates': [12.4964, 41.9028]},
+                    'properties': {
+                        'title': f'Place {i}',
+                        'category': 'test',
+                        'city': 'Roma',
+                        'province': 'Roma',
+                        'published': True,
+                        'website': ['https://example.com', 'https://example.org'],
+                    },
+                }
+                for i in range(10)
+            ]
+            + [
+                {
+                    'type': 'Feature',
+                    'geometry': {'type': 'LineString', 'coordinates': [[0, 0], [1, 1]]},
+                    'properties': {'title': 'Line', 'category': 'test', 'city': 'Roma'},
+                },
+            ],
+        }
+        stream = StringIO(json.dumps(collection, indent=1))
+        # Tiny chunks: values are split across reads
+        rows = list(importing.read_geojson(stream, chunk_size=7))
+        self.assertEqual([line for line, raw in rows], list(range(1, 12)))
+        self.assertEqual(rows[0][1]['title'], 'Place 0')
+
+        errors = []
+        stats = importing.Importer(on_error=lambda *args: errors.append(args)).run(rows)
+        self.assertEqual((stats.imported, stats.errors), (10, 1))
+        self.assertEqual(errors[0][2], 'la geometria deve essere un punto')
+        place = Entity.objects.get(title='Place 9')
+        self.assertTrue(place.published)
+        self.assertEqual(place.address_set.get().longitude, 12.4964)
+        self.assertEqual(place.contact_set.filter(typology='S').count(), 2)
+
+    def test_invalid_geojson(self):
+        for content in (
+            '[]',
+            '{"type": "Feature"}',
+            '{"type": "FeatureCollection", "features": [{}',
+        ):
+            with self.assertRaises(importing.InvalidFile):
+                list(importing.read_geojson(StringIO(content)))
+
+
+class ExportTest(AddressPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        Contact.objects.create(entity=self.pub_entity, typology='P', contact='02 123')
+        Contact.objects.create(entity=self.pub_entity, typology='E', contact='a@example.com')
+        Report.objects.create(entity=self.pub_entity, title='Visit', body='<p>Nice</p>')
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def export(self, name, *args):
+        path = Path(self.dir.name) / name
+        out = StringIO()
+        call_command('export_entities', str(path), *args, stdout=out)
+        return path, out.getvalue()
+
+    def test_csv_is_flat(self):
+        path, out = self.export('data.csv')
+        self.assertIn('2 segnalazioni esportate (2 record)', out)
+        rows = path.read_text().splitlines()
+        self.assertEqual(rows[0].split(','), list(exporting.FLAT_COLUMNS))
+        self.assertEqual(
+            rows[1],
+            f'{self.entity.pk},Test title,test,,false,Some description,,,,,,,,,,0,',
+        )
+        self.assertIn(',Milano,MI,45.46,9.19,02 123,a@example.com,,1,', rows[2])
+
+    def test_csv_round_trip(self):
+        path, out = self.export('data.csv')
+        call_command('import_entities', str(path), stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Entity.objects.filter(title='Second test title').count(), 2)
+        copy = Entity.objects.filter(title='Second test title').latest('pk')
+        self.assertTrue(copy.published)
+        self.assertEqual(copy.address_set.get().city, 'Milano')
+        self.assertEqual(copy.contact_set.count(), 2)
+
+    def test_ndjson_is_nested(self):
+        path, out = self.export('data.ndjson', '--published')
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['id'], self.pub_entity.pk)
+        self.assertEqual(record['addresses'][0]['city'], 'Milano')
+        self.assertEqual(
+            record['contacts'],
+            [
+                {'typology': 'P', 'contact': '02 123'},
+                {'typology': 'E', 'contact': 'a@example.com'},
+            ],
+        )
+        self.assertEqual(record['reports'][0]['body'], '<p>Nice</p>')
+
+    def test_geojson(self):
+        path, out = self.export('data.geojson', '--province', 'MI')
+        features = json.loads(path.read_text())['features']
+        self.assertEqual(len(features), 1)
+        self.assertEqual(
+            features[0]['geometry'],
+            {'type': 'MultiPoint', 'coordinates': [[9.19, 45.46]]},
+        )
+
+        path, out = self.export('flat.geojson', '--flat', '--drafts')
+        features = json.loads(path.read_text())['features']
+        self.assertEqual([feature['id'] for feature in features], [self.entity.pk])
+        self.assertIsNone(features[0]['geometry'])
+
+    def test_gzip(self):
+        path, out = self.export('data.ndjson.gz')
+        self.assertEqual(len(gzip.decompress(path.read_bytes()).splitlines()), 2)
+
+    def test_streams_in_chunks(self):
+        for i in range(4):
+            Entity.objects.create(category=self.cat, title=f'Extra {i}')
+        reference.get()
+        with (
+            mock.patch.object(exporting, 'CHUNK_SIZE', 2),
+            CaptureQueriesContext(connection) as queries,
+        ):
+            export = exporting.Export(exporting.filter_entities(Entity.objects.all()), 'ndjson')
+            chunks = list(export)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(export.entities, 6)
+        # One query for the entities, three prefetch queries for each chunk
+        self.assertEqual(len(queries), 1 + 3 * 3)
+
+    def test_view(self):
+        url = reverse('djeography:export')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.login(username='test', password='test')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        get_user_model().objects.filter(username='test').update(is_staff=True)
+        response = self.client.get(url, {'format': 'ndjson', 'gzip': '1', 'published': '0'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="djeography.ndjson.gz"',
+        )
+        lines = gzip.decompress(b''.join(response.streaming_content)).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [self.entity.pk])
+
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 400)
+
+
+class FakeGeocoder(geocoding.GeocodingBackend):
+    name = 'fake'
+    concurrency = 2
+
+    def __init__(self, places, fail=()):
+        self.places = places
+        self.fail = fail
+        self.calls = []
+        self.running = self.max_running = 0
+
+    async def geocode(self, query):
+        self.calls.append(query.key)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.001)
+        self.running -= 1
+        if query.city in self.fail:
+            raise geocoding.GeocodingError(query.city)
+        return self.places.get(query.city)
+
+
+class GeocodingTest(EntityPopulatedTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.backend = FakeGeocoder({'Milano': (45.46, 9.19), 'Roma': (41.9, 12.5)})
+
+    def test_query_key(self):
+        query = geocoding.GeocodeQuery(' Via  Città ', '1', 'FORLÌ', 'FC')
+        self.assertEqual(query.key, 'via citta 1, forli, fc')
+
+    def test_results_are_cached(self):
+        queries = [
+            geocoding.GeocodeQuery('', '', 'Milano', 'MI'),
+            geocoding.GeocodeQuery('', '', 'milano', 'MI'),
+            geocoding.GeocodeQuery('', '', 'Nowhere', 'RM'),
+        ]
+        results = geocoding.geocode(queries, self.backend)
+        self.assertEqual(results, {', milano, mi': (45.46, 9.19), ', nowhere, rm': None})
+        self.assertEqual(len(self.backend.calls), 2)
+        self.assertEqual(GeocodeResult.objects.count(), 2)
+
+        # Found and not found results are not asked again
+        self.assertEqual(geocoding.geocode(queries, self.backend), results)
+        self.assertEqual(len(self.backend.calls), 2)
+
+    def test_failures_are_not_cached(self):
+        backend = FakeGeocoder({}, fail={'Roma'})
+        query = geocoding.GeocodeQuery('', '', 'Roma', 'RM')
+        self.assertEqual(geocoding.geocode([query], backend), {})
+        self.assertFalse(GeocodeResult.objects.exists())
+
+    def test_concurrency_and_rate(self):
+        queries = [geocoding.GeocodeQuery('', '', f'City {i}', 'RM') for i in range(6)]
+        self.backend.rate = 100
+        start = time.monotonic()
+        geocoding.geocode(queries, self.backend)
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 100)
+        self.assertLessEqual(self.backend.max_running, 2)
+        self.assertEqual(len(self.backend.calls), 6)
+
+    def test_default_backend(self):
+        with mock.patch.object(geocoding, '_backend', None):
+            self.assertIsInstance(geocoding.get_backend(), geocoding.NominatimBackend)
+        with self.assertRaises(TypeError):
+            geocoding.GeocodingBackend()
+
+    def test_gazetteer_backend(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as file:
+            file.write('name,province,latitude,longitude\nForlì,FC,44.22,12.04\n')
+        self.addCleanup(Path(file.name).unlink)
+        backend = geocoding.GazetteerBackend(file.name)
+        results = geocoding.geocode(
+            [
+                geocoding.GeocodeQuery('Corso Garibaldi', '3', 'forli', 'fc'),
+                geocoding.GeocodeQuery('', '', 'Forlì', 'RM'),
+            ],
+            backend,
+        )
+        self.assertEqual(list(results.values()), [(44.22, 12.04), None])
+        # Another file does not reuse the cached results
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as other:
+            other.write('name,province,latitude,longitude\nForlì,FC,44.2,12.0\n')
+        self.addCleanup(Path(other.name).unlink)
+        other_backend = geocoding.GazetteerBackend(other.name)
+        self.assertNotEqual(other_backend.name, backend.name)
+        query = geocoding.GeocodeQuery('', '', 'Forlì', 'FC')
+        self.assertEqual(geocoding.geocode([query], other_backend), {query.key: (44.2, 12.0)})
+
+    def test_nominatim_backend(self):
+        response = mock.MagicMock()
+        response.__enter__.return_value = BytesIO(b'[{"lat": "45.46", "lon": "9.19"}]')
+        with mock.patch('urllib.request.urlopen', return_value=response) as urlopen:
+            results = geocoding.geocode(
+                [geocoding.GeocodeQuery('Via Dante', '2', 'Milano', 'MI')],
+                geocoding.NominatimBackend(),
+            )
+        self.assertEqual(list(results.values()), [(45.46, 9.19)])
+        request = urlopen.call_args.args[0]
+        self.assertIn('q=Via+Dante+2%2C+Milano%2C+Milano', request.full_url)
+        self.assertEqual(request.get_header('User-agent'), 'djeography')
+
+        with mock.patch('urllib.request.urlopen', side_effect=OSError('offline')):
+            results = geocoding.geocode(
+                [geocoding.GeocodeQuery('Via Dante', '3', 'Milano', 'MI')],
+                geocoding.NominatimBackend(),
+            )
+        self.assertEqual(results, {})
+
+    def test_import_and_command(self):
+        csv_file = Path(tempfile.mkdtemp()) / 'data.csv'
+        self.addCleanup(shutil.rmtree, csv_file.parent)
+        csv_file.write_text(
+            'title,category,city,province\nA,test,Milano,MI\nB,test,Roma,RM\nC,test,Nowhere,RM\n',
+        )
+        out = StringIO()
+        call_command('import_entities', str(csv_file), stdout=out, stderr=StringIO())
+        self.assertIn('3 indirizzi senza coordinate', out.getvalue())
+        self.assertEqual(Address.objects.filter(coords__isnull=True).count(), 3)
+
+        out = StringIO()
+        with (
+            mock.patch.object(geocoding, '_backend', self.backend),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            call_command('geocode_addresses', '--batch-size', '2', stdout=out)
+        self.assertIn('2 indirizzi localizzati, 1 non trovati', out.getvalue())
+        address = Address.objects.get(entity__title='B')
+        self.assertEqual((address.latitude, address.longitude), (41.9, 12.5))
+        self.assertEqual(address.coords, {'type': 'Point', 'coordinates': [12.5, 41.9]})
+
+        # During the import, with the results already cached
+        with mock.patch.object(geocoding, '_backend', self.backend):
+            call_command(
+                'import_entities',
+                str(csv_file),
+                '--geocode',
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        self.assertEqual(len(self.backend.calls), 3)
+        self.assertEqual(Address.objects.filter(entity__title='A', latitude=45.46).count(), 2)
+        self.assertEqual(Address.objects.filter(coords__isnull=True).count(), 2)
+
+
+class GazetteerTest(TestCase):
+    def setUp(self):
+        self.gazetteer = gazetteer.Gazetteer(
+            [
+                gazetteer.Place('Reggio di Calabria', 'RC', 38.11, 15.65),
+                gazetteer.Place("Reggio nell'Emilia", 'RE', 44.7, 10.63),
+                gazetteer.Place('Forlì', 'FC', 44.22, 12.04),
+                gazetteer.Place('Bolzano/Bozen', 'BZ', 46.5, 11.35),
+                gazetteer.Place('San Marco', 'SA', 40.27, 15.0),
+                gazetteer.Place('San Marco', 'CE', 41.1, 14.27),
+                gazetteer.Place('Marcon', 'VE', 45.56, 12.3),
+            ],
+        )
+
+    def names(self, text, **kwargs):
+        return [place.name for place in self.gazetteer.search(text, **kwargs)]
+
+    def test_prefix_search(self):
+        self.assertEqual(self.names('reg'), ['Reggio di Calabria', "Reggio nell'Emilia"])
+        self.assertEqual(self.names('reg', limit=1), ['Reggio di Calabria'])
+        self.assertEqual(self.names('xyz'), [])
+        self.assertEqual(self.names('  '), [])
+
+    def test_accents_and_punctuation(self):
+        self.assertEqual(self.names('FORLI'), ['Forlì'])
+        self.assertEqual(self.names('forlì'), ['Forlì'])
+        self.assertEqual(self.names("reggio nell emilia"), ["Reggio nell'Emilia"])
+
+    def test_word_and_alternative_names(self):
+        self.assertEqual(self.names('calab'), ['Reggio di Calabria'])
+        self.assertEqual(self.names('bozen'), ['Bolzano/Bozen'])
+
+    def test_name_prefix_ranks_first(self):
+        # "Marcon" starts with the text, "San Marco" only contains a word that does
+        self.assertEqual(self.names('marco'), ['Marcon', 'San Marco', 'San Marco'])
+
+    def test_lookup(self):
+        self.assertEqual(self.gazetteer.lookup('bozen').province, 'BZ')
+        self.assertEqual(self.gazetteer.lookup('San Marco', 'ce').latitude, 41.1)
+        # Ambiguous without the province
+        self.assertIsNone(self.gazetteer.lookup('San Marco'))
+        self.assertIsNone(self.gazetteer.lookup('Forlì', 'RM'))
+
+    def test_bundled_file_covers_every_province(self):
+        places = gazetteer.get().places
+        provinces = {code for code, _ in app_settings['PROV_CHOICES']}
+        self.assertEqual({place.province for place in places}, provinces)
+        self.assertEqual(gazetteer.get().lookup('Bolzano', 'BZ').name, 'Bolzano/Bozen')
+
+    def test_search_is_fast(self):
+        places = gazetteer.get()
+        start = time.perf_counter()
+        for _ in range(100):
+            places.search('sa')
+        self.assertLess((time.perf_counter() - start) / 100, 0.001)
+
+    def test_places_view(self):
+        response = self.client.get(reverse('djeography:places'), {'q': 'aquil'})
+        self.assertEqual(response.status_code, 200)
+        place = gazetteer.get().lookup("L'Aquila")
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    'name': "L'Aquila",
+                    'province': 'AQ',
+                    'province_name': dict(app_settings['PROV_CHOICES'])['AQ'],
+                    'lat': place.latitude,
+                    'lng': place.longitude,
+                },
+            ],
+        )
+        self.assertIn('public', response['Cache-Control'])
+        response = self.client.get(reverse('djeography:places'), {'q': 'a', 'limit': 3})
+        self.assertEqual(len(response.json()), 3)
+        # Capital cities starting with "a": the limit is capped at 20
+        response = self.client.get(reverse('djeography:places'), {'q': 'a', 'limit': 100})
+        self.assertEqual(len(response.json()), 10)
+        response = self.client.get(reverse('djeography:places'), {'q': 'a', 'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('djeography:places')).json(), [])
+
+    def test_gazetteer_backend_uses_bundled_file(self):
+        backend = geocoding.GazetteerBackend()
+        query = geocoding.GeocodeQuery('Via Roma', '1', 'Bolzano', 'BZ')
+        place = gazetteer.get().lookup('Bolzano')
+        self.assertEqual(asyncio.run(backend.geocode(query)), (place.latitude, place.longitude))
+
+
+def write_boundaries(features: dict) -> Path:
+    """Write a GeoJSON file with one square per province code."""
+    path = Path(tempfile.mkdtemp()) / 'provinces.geojson'
+    path.write_text(
+        json.dumps(
+            {
+                'type': 'FeatureCollection',
+                'features': [
+                    {
+                        'type': 'Feature',
+                        'properties': {'sigla': code},
+                        'geometry': {
+                            'type': 'Polygon',
+                            'coordinates': [
+                                [[w, s], [e, s], [e, n], [w, n], [w, s]],
+                            ],
+                        },
+                    }
+                    for code, (w, s, e, n) in features.items()
+                ],
+            },
+        ),
+    )
+    return path
+
+
+class ProvincesTest(EntityPopulatedTestCase):
+    def setUp(self):
+        super().setUp()
+        path = write_boundaries({'RM': (12, 41.5, 13, 42.5), 'MI': (8.9, 45.2, 9.5, 45.7)})
+        self.addCleanup(shutil.rmtree, path.parent)
+        patcher = mock.patch.dict(app_settings, {'PROVINCE_BOUNDARIES': str(path)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = provinces.ProvinceIndex(
+            [
+                # Two adjacent squares; the second one has a hole
+                ('AA', [(0, 0), (1, 0), (1, 1), (0, 1)]),
+                ('BB', [(1, 0), (2, 0), (2, 1), (1, 1), (1, 0)]),
+                ('BB', [(1.4, 0.4), (1.6, 0.4), (1.6, 0.6), (1.4, 0.6)]),
+                # An island, part of the first province
+                ('AA', [(3, 3), (3.2, 3), (3.1, 3.2)]),
+            ],
+            cell_size=0.1,
+        )
+
+    def test_locate(self):
+        self.assertEqual(self.index.locate(0.5, 0.5), 'AA')
+        self.assertEqual(self.index.locate(0.5, 1.2), 'BB')
+        self.assertEqual(self.index.locate(0.999, 0.999), 'AA')
+        self.assertEqual(self.index.locate(3.05, 3.1), 'AA')
+        self.assertIsNone(self.index.locate(0.5, 1.5))
+        self.assertIsNone(self.index.locate(2, 2))
+        self.assertIsNone(self.index.locate(-1, 0.5))
+
+    def test_interior_cells_are_cached(self):
+        self.assertEqual(self.index.locate(0.55, 0.55), 'AA')
+        self.assertEqual(self.index.locate(0.51, 0.52), 'AA')
+        self.assertIn('AA', self.index.interior.values())
+
+    def test_boundaries_file(self):
+        rome = {'type': 'Point', 'coordinates': [12.5, 41.9]}
+        self.assertEqual(provinces.province_of(rome), 'RM')
+        self.assertIsNone(provinces.province_of({'type': 'Point', 'coordinates': [-3.7, 40.4]}))
+        self.assertIsNone(provinces.province_of(None))
+
+    def test_disabled_without_boundaries(self):
+        rome = {'type': 'Point', 'coordinates': [12.5, 41.9]}
+        with mock.patch.dict(app_settings, {'PROVINCE_BOUNDARIES': None}):
+            self.assertIsNone(provinces.get())
+            self.assertIsNone(provinces.province_of(rome))
+            with self.assertRaisesMessage(ValueError, 'has no province'):
+                Address.objects.create(entity=self.entity, city='Roma', coords=rome)
+            with self.assertRaisesMessage(ValidationError, 'Indica la provincia'):
+                Address(entity=self.entity, city='Roma', coords=rome).full_clean()
+            with self.assertRaisesMessage(CommandError, 'PROVINCE_BOUNDARIES'):
+                call_command('check_provinces', stdout=StringIO())
+        # With boundaries, full_clean derives the province before checking required fields
+        address = Address(entity=self.entity, city='Roma', coords=rome)
+        address.full_clean()
+        self.assertEqual(address.province, 'RM')
+
+    def test_read_geojson(self):
+        path = Path(tempfile.mkdtemp()) / 'provinces.geojson'
+        self.addCleanup(shutil.rmtree, path.parent)
+        square = [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]
+        path.write_text(
+            json.dumps(
+                {
+                    'type': 'FeatureCollection',
+                    'features': [
+                        {
+                            'type': 'Feature',
+                            'properties': {'prov_acr': 'aa'},
+                            'geometry': {'type': 'MultiPolygon', 'coordinates': [square]},
+                        },
+                    ],
+                },
+            ),
+        )
+        self.assertEqual(
+            list(provinces.read_geojson(path)),
+            [('AA', [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (0.0, 0.0)])],
+        )
+
+    def test_locate_is_fast(self):
+        # A grid of 110 provinces over Italy, with 200 vertices each
+        side = [i / 50 for i in range(50)]
+        boundaries = []
+        for row in range(10):
+            for column in range(11):
+                w, s = 7 + column, 37 + row
+                ring = [(w + t, s) for t in side] + [(w + 1, s + t) for t in side]
+                ring += [(w + 1 - t, s + 1) for t in side] + [(w, s + 1 - t) for t in side]
+                boundaries.append((f'{row}{column}', ring))
+        index = provinces.ProvinceIndex(boundaries)
+        points = [(37 + i % 97 / 10, 7 + i % 113 / 10) for i in range(20000)]
+        start = time.perf_counter()
+        for lat, lng in points:
+            index.locate(lat, lng)
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_address_province_from_coords(self):
+        milan = gazetteer.get().lookup('Milano')
+        coords = {'type': 'Point', 'coordinates': [milan.longitude, milan.latitude]}
+        address = Address.objects.create(entity=self.entity, city='Milano', coords=coords)
+        self.assertEqual(address.province, 'MI')
+        # The given province is kept
+        address = Address.objects.create(
+            entity=self.entity,
+            city='Milano',
+            province='MB',
+            coords=coords,
+        )
+        self.assertEqual(address.province, 'MB')
+        with self.assertRaisesMessage(ValidationError, 'Indica la provincia'):
+            Address(entity=self.entity, city='Milano').full_clean()
+
+    def test_import_derives_province(self):
+        path = Path(tempfile.mkdtemp()) / 'data.csv'
+        self.addCleanup(shutil.rmtree, path.parent)
+        path.write_text(
+            'title,category,city,province,latitude,longitude\n'
+            'A,test,Roma,,41.9,12.5\n'
+            'B,test,Roma,MI,41.9,12.5\n'
+            'C,test,Roma,,,\n',
+        )
+        out, err = StringIO(), StringIO()
+        call_command('import_entities', str(path), stdout=out, stderr=err)
+        self.assertEqual(Address.objects.get(entity__title='A').province, 'RM')
+        self.assertIn('1 indirizzi con la provincia diversa', out.getvalue())
+        self.assertIn('Riga 4: provincia sconosciuta: (vuota)', err.getvalue())
+
+    def test_check_provinces_command(self):
+        rome = {'type': 'Point', 'coordinates': [12.5, 41.9]}
+        right = Address.objects.create(entity=self.entity, city='Roma', province='RM', coords=rome)
+        wrong = Address.objects.create(
+            entity=self.pub_entity,
+            city='Roma',
+            province='MI',
+            coords=rome,
+        )
+        Address.objects.create(entity=self.entity, city='Nowhere', province='RM')
+
+        out = StringIO()
+        call_command('check_provinces', '--batch-size', '1', stdout=out)
+        self.assertIn(f'Indirizzo {wrong.pk}: MI, dalle coordinate RM', out.getvalue())
+        self.assertIn('2 indirizzi controllati, 1 con la provincia diversa', out.getvalue())
+        wrong.refresh_from_db()
+        self.assertEqual(wrong.province, 'MI')
+
+        scope = versions.entity_scope(self.pub_entity.pk)
+        before = versions.get_versions(scope)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('check_provinces', '--fix', stdout=StringIO())
+        wrong.refresh_from_db()
+        self.assertEqual(wrong.province, 'RM')
+        self.assertNotEqual(versions.get_versions(scope), before)
+        right.refresh_from_db()
+        self.assertEqual(right.province, 'RM')